@@ -6,12 +6,24 @@ from concurrent.futures import ThreadPoolExecutor
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils import executor
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated, RetryAfter
 from dotenv import load_dotenv
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import shutil
 import hashlib
+import html
+import tempfile
+import gzip
+import lzma
+import re
+import bisect
+import heapq
+import math
+import functools
+import contextvars
+from collections import OrderedDict, deque
 import threading  # ДОБАВЛЕНО для блокировок
 import time  # ДОБАВЛЕНО для блокировок
 
@@ -44,11 +56,114 @@ API_TOKEN = os.getenv("BOT_TOKEN")
 if not API_TOKEN:
     raise ValueError("Не найден BOT_TOKEN в .env")
 
-bot = Bot(token=API_TOKEN, parse_mode="HTML")
+# --- ИСХОДЯЩАЯ ОЧЕРЕДЬ С ПРИОРИТЕТАМИ ---
+# Все отправки бота проходят через одну очередь под общим лимитом API.
+# Классы: интерактивные ответы > уведомления (фоновые задачи) > массовые рассылки.
+# Внутри класса чаты обслуживаются по кругу, в одном чате — строго по порядку.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 1
+PRIORITY_BULK = 2
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "30"))  # Общий лимит запросов-отправок в секунду
+OUTBOUND_MAX_RETRIES = 2
+QUEUED_METHOD_PREFIXES = ("send", "copy", "forward", "edit")
+
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+class OutboundQueue:
+    def __init__(self, rate):
+        self.rate = rate
+        self.lanes = [OrderedDict() for _ in range(PRIORITY_BULK + 1)]  # chat_id -> deque запросов
+        self.busy = set()       # Чаты, у которых запрос уже в полете
+        self.limiter = None
+        self.wakeup = None
+        self.task = None
+    
+    def _ensure_started(self):
+        if self.task is None:
+            self.limiter = RateLimiter(self.rate, 0)
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self._run())
+    
+    def submit(self, priority, chat_id, call):
+        """Поставить запрос в очередь; возвращает future с результатом"""
+        self._ensure_started()
+        future = asyncio.get_event_loop().create_future()
+        self.lanes[priority].setdefault(chat_id, deque()).append([future, call, 0])
+        self.wakeup.set()
+        return future
+    
+    def _has_ready(self):
+        return any(chat_id not in self.busy for lane in self.lanes for chat_id in lane)
+    
+    def _take(self):
+        """Следующий запрос: старший класс, первый свободный чат по кругу"""
+        for priority, lane in enumerate(self.lanes):
+            for chat_id, items in lane.items():
+                if chat_id in self.busy:
+                    continue
+                item = items.popleft()
+                if items:
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+                return priority, chat_id, item
+        return None
+    
+    async def _run(self):
+        while True:
+            if not self._has_ready():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.limiter.acquire(None)
+            taken = self._take()
+            if taken is None:
+                continue
+            priority, chat_id, item = taken
+            if item[0].done():
+                continue  # Отправитель уже отменил ожидание
+            self.busy.add(chat_id)
+            asyncio.ensure_future(self._execute(priority, chat_id, item))
+    
+    async def _execute(self, priority, chat_id, item):
+        future, call, attempts = item
+        try:
+            result = await call()
+            if not future.done():
+                future.set_result(result)
+        except RetryAfter as e:
+            self.limiter.pause(e.timeout)
+            if attempts < OUTBOUND_MAX_RETRIES:
+                item[2] += 1
+                self.lanes[priority].setdefault(chat_id, deque()).appendleft(item)
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.busy.discard(chat_id)
+            self.wakeup.set()
+
+class QueuedBot(Bot):
+    """Bot, у которого отправки идут через приоритетную очередь"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = OutboundQueue(OUTBOUND_RATE)
+    
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None or not method.startswith(QUEUED_METHOD_PREFIXES):
+            return await super().request(method, data, files, **kwargs)
+        call = functools.partial(super().request, method, data, files, **kwargs)
+        return await self.outbound.submit(send_priority.get(), str(chat_id), call)
+
+bot = QueuedBot(token=API_TOKEN, parse_mode="HTML")
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
 USERS_FILE = "users.json"
+USERS_JOURNAL_FILE = "users.journal"  # Построчные изменения отдельных пользователей поверх users.json
 ASSIGNMENTS_FILE = "assignments.json"  # НОВЫЙ ФАЙЛ ДЛЯ ЗАДАНИЙ
 LEVELS_ORDER = ["НП", "СВ", "ВТ", "АВТ", "ГТ"]
 OLGA_ID = 64434196
@@ -81,49 +196,878 @@ class FileLock:
 
 file_lock = FileLock()
 
+# Номер последней записанной версии каждого файла: транзакция, прочитавшая более старую версию,
+# при фиксации получает конфликт и повторяется на свежих данных, а обычное сохранение отказывает
+storage_versions = {}
+
+def is_stale(filename, data):
+    """Данные прочитаны до последней записи файла (сохранять их — потерять чужие изменения)"""
+    return data.get("version", 0) != storage_versions.get(filename, 0)
+
+# --- ВРЕМЕННЫЕ МЕТКИ ---
+# Все даты в users.json и assignments.json хранятся как целые миллисекунды от эпохи:
+# сортировка и выборки по диапазону — простое сравнение чисел, без разбора строк.
+USER_TIMESTAMP_FIELDS = ("registration_date", "active_today", "last_activity",
+                         "mentor_change_request", "level_change_request")
+
+def now_ms():
+    """Текущее время в миллисекундах от эпохи"""
+    return int(time.time() * 1000)
+
+def timestamp_to_ms(value):
+    """Перевод строкового времени старого формата (str(datetime) или str(date)) в миллисекунды"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return 0
+
+def ms_to_datetime(value):
+    return datetime.fromtimestamp(value / 1000)
+
+def day_start_ms(day=None):
+    """Начало суток (локальное время) в миллисекундах"""
+    return int(datetime.combine(day or date.today(), datetime.min.time()).timestamp() * 1000)
+
+@functools.lru_cache(maxsize=8192)
+def _format_minute(minute, fmt):
+    return datetime.fromtimestamp(minute * 60).strftime(fmt)
+
+def format_ms(value, fmt="%d.%m.%Y %H:%M", default="?"):
+    """Форматирование времени для отображения (кэш по минутам: повторные рендеры не пересчитывают)"""
+    if not value:
+        return default
+    return _format_minute(int(value) // 60000, fmt)
+
+def normalize_user_timestamps(user):
+    """Строковые даты пользователя → мс; возвращает число исправленных полей"""
+    changed = 0
+    for field in USER_TIMESTAMP_FIELDS:
+        value = user.get(field)
+        if isinstance(value, str):
+            user[field] = timestamp_to_ms(value)
+            changed += 1
+    return changed
+
+def normalize_assignment_timestamps(data):
+    """Строковые даты заданий и решений → мс; возвращает число исправленных полей"""
+    changed = 0
+    records = list(data.get("assignments", {}).values()) + list(data.get("solutions", {}).values())
+    for assignment in data.get("assignments", {}).values():
+        records.extend(assignment.get("solutions_sent", []))
+    for record in records:
+        if isinstance(record, dict) and isinstance(record.get("timestamp"), str):
+            record["timestamp"] = timestamp_to_ms(record["timestamp"])
+            changed += 1
+    return changed
+
+def migrate_timestamps():
+    """Однократная миграция файлов со строковыми датами (загрузка уже нормализует, остается сохранить)"""
+    if os.path.exists(USERS_FILE):
+        with open(USERS_FILE, "r", encoding="utf-8") as f:
+            raw_users = json.load(f).get("users", {})
+        if any(normalize_user_timestamps(dict(u)) for u in raw_users.values() if isinstance(u, dict)):
+            save_users(load_users())
+            log_info("🔄 Даты пользователей переведены в числовой формат")
+    
+    if os.path.exists(ASSIGNMENTS_FILE):
+        with open(ASSIGNMENTS_FILE, "r", encoding="utf-8") as f:
+            raw_assignments = json.load(f)
+        if normalize_assignment_timestamps(raw_assignments):
+            save_assignments(load_assignments())
+            log_info("🔄 Даты заданий и решений переведены в числовой формат")
+
 # --- Функция для разбивки длинных сообщений на части ---
-async def safe_send_message(chat_id, text, reply_markup=None, parse_mode="HTML"):
-    """Безопасная отправка сообщений с разбивкой на части"""
-    if len(text) <= 4096:
-        # Если сообщение короткое, отправляем как есть
-        await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+TELEGRAM_TEXT_LIMIT = 4096  # Лимит Telegram в UTF-16 единицах видимого текста (после разбора HTML)
+HTML_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|[^<&]+|[<&]")
+HTML_TAG_RE = re.compile(r"<\s*(/?)\s*([a-zA-Z][\w-]*)")
+
+def utf16_len(text):
+    """Длина так, как ее считает Telegram (символы вне BMP — две единицы)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def _fit_prefix(text, room):
+    """Сколько символов text помещается в room единиц UTF-16 (по возможности — до пробела)"""
+    if len(text) == utf16_len(text):
+        cut = min(room, len(text))
     else:
-        # Разбиваем на части по 4000 символов (с запасом)
-        parts = []
-        current_part = ""
+        cut, used = 0, 0
+        for char in text:
+            used += 2 if ord(char) > 0xFFFF else 1
+            if used > room:
+                break
+            cut += 1
+    space = max(text.rfind(" ", 0, cut), text.rfind("\n", 0, cut))
+    if space >= cut // 2 and cut < len(text):
+        cut = space + 1
+    return cut
+
+def split_message(text, limit=TELEGRAM_TEXT_LIMIT, html_mode=True):
+    """Разбивка текста на части не длиннее limit за один проход
+    
+    Режем по границам строк; слишком длинная строка режется по пробелу или жестко.
+    В HTML-режиме теги не разрываются: открытые на границе теги закрываются в конце
+    части и открываются заново в начале следующей, сущности (&amp;) не делятся.
+    """
+    # Строки как списки единиц (текст, вид, видимая длина)
+    lines, line = [], []
+    tokens = HTML_TOKEN_RE.findall(text) if html_mode else [text]
+    for token in tokens:
+        if html_mode and token.startswith("<") and token.endswith(">") and len(token) > 1:
+            line.append((token, "tag", 0))
+        elif html_mode and token.startswith("&") and token.endswith(";") and len(token) > 1:
+            line.append((token, "entity", 2 if token.startswith("&#") else 1))
+        else:
+            pieces = token.split("\n")
+            for i, piece in enumerate(pieces):
+                if i < len(pieces) - 1:
+                    piece += "\n"
+                if piece:
+                    line.append((piece, "text", utf16_len(piece)))
+                if i < len(pieces) - 1:
+                    lines.append(line)
+                    line = []
+    if line:
+        lines.append(line)
+    
+    chunks = []
+    parts = []
+    size = 0
+    stack = []  # Открытые теги: (имя, исходный открывающий тег)
+    
+    def flush():
+        nonlocal parts, size
+        body = "".join(parts)
+        if size > 0 and body.strip():
+            chunks.append(body + "".join(f"</{name}>" for name, _ in reversed(stack)))
+        parts = [opening for _, opening in stack]
+        size = 0
+    
+    def add(unit, kind, visible):
+        nonlocal size
+        if kind == "tag":
+            match = HTML_TAG_RE.match(unit)
+            if match and match.group(1):
+                for i in range(len(stack) - 1, -1, -1):
+                    if stack[i][0] == match.group(2).lower():
+                        del stack[i]
+                        break
+            elif match:
+                stack.append((match.group(2).lower(), unit))
+        parts.append(unit)
+        size += visible
+    
+    for line in lines:
+        line_size = sum(visible for _, _, visible in line)
+        if size > 0 and size + line_size > limit:
+            flush()
+        if size + line_size <= limit:
+            for unit in line:
+                add(*unit)
+            continue
+        
+        # Строка длиннее лимита — режем по единицам
+        for unit, kind, visible in line:
+            if kind != "text":
+                if size + visible > limit:
+                    flush()
+                add(unit, kind, visible)
+                continue
+            while unit:
+                room = limit - size
+                if visible <= room:
+                    add(unit, kind, visible)
+                    break
+                cut = _fit_prefix(unit, room) if room > 0 else 0
+                if cut:
+                    add(unit[:cut], kind, utf16_len(unit[:cut]))
+                    unit = unit[cut:]
+                    visible = utf16_len(unit)
+                flush()
+    flush()
+    return chunks
+
+async def safe_send_message(chat_id, text, reply_markup=None, parse_mode="HTML"):
+    """Безопасная отправка сообщений с разбивкой на части
+    
+    Части уходят подряд через исходящую очередь (порядок в чате сохраняется),
+    клавиатура — у первой части.
+    """
+    chunks = split_message(text, html_mode=(parse_mode or "").upper() == "HTML") or [text]
+    for i, chunk in enumerate(chunks):
+        await bot.send_message(chat_id, chunk, reply_markup=reply_markup if i == 0 else None, parse_mode=parse_mode)
+
+# --- ДВИЖОК РАССЫЛКИ ---
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))                  # Сообщений в секунду всего (лимит API ~30)
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1"))  # Секунд между сообщениями в один чат
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))      # Одновременных запросов
+BROADCAST_MAX_RETRIES = 3
+
+class RateLimiter:
+    """Token bucket: общий лимит сообщений в секунду + интервал для каждого чата
+    
+    Работает в одном event loop, между проверкой и списанием токена нет await,
+    поэтому отдельная блокировка не нужна.
+    """
+    def __init__(self, rate, per_chat_interval):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.per_chat_interval = per_chat_interval
+        self.chat_next = {}       # chat_id -> когда в этот чат можно писать снова
+        self.paused_until = 0.0   # Глобальная пауза после RetryAfter
+    
+    async def acquire(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if wait <= 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                chat_wait = self.chat_next.get(chat_id, 0) - now
+                if chat_wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.chat_next[chat_id] = now + self.per_chat_interval
+                    if len(self.chat_next) > 10000:
+                        self.chat_next = {cid: t for cid, t in self.chat_next.items() if t > now}
+                    return
+                wait = max(chat_wait, (1 - self.tokens) / self.rate)
+            await asyncio.sleep(wait)
+    
+    def pause(self, seconds):
+        """Telegram попросил подождать (flood wait) — останавливаем все отправки"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+broadcast_limiter = RateLimiter(BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL)
+
+async def send_with_retry(send, chat_id, limiter=None):
+    """Одна отправка через лимитер с повтором после RetryAfter"""
+    limiter = limiter or broadcast_limiter
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        await limiter.acquire(chat_id)
+        try:
+            return await send(chat_id)
+        except RetryAfter as e:
+            if attempt == BROADCAST_MAX_RETRIES - 1:
+                raise
+            log_warning(f"⏳ Flood wait {e.timeout} с (чат {chat_id})")
+            limiter.pause(e.timeout)
+
+async def run_broadcast(recipients, send, on_result=None, concurrency=None, stop=None):
+    """Рассылка send(chat_id) по получателям пулом из concurrency воркеров
+    
+    on_result(chat_id, status, error) вызывается после каждой отправки,
+    status: sent / blocked (бот заблокирован, чат удален) / failed.
+    stop() — проверяется перед каждой отправкой (пауза/отмена), необработанные
+    получатели просто не попадают в результаты.
+    Возвращает счетчики по статусам.
+    """
+    counts = {"sent": 0, "blocked": 0, "failed": 0}
+    pending = iter(recipients)
+    
+    async def worker():
+        send_priority.set(PRIORITY_BULK)  # Контекст воркера свой, вызывающий не затрагивается
+        for chat_id in pending:
+            if stop is not None and stop():
+                break
+            error = None
+            try:
+                await send_with_retry(send, chat_id)
+                status = "sent"
+            except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+                status, error = "blocked", e
+            except Exception as e:
+                status, error = "failed", e
+                log_info(f"Ошибка отправки {chat_id}: {e}")
+            counts[status] += 1
+            if on_result is not None:
+                result = on_result(chat_id, status, error)
+                if asyncio.iscoroutine(result):
+                    await result
+    
+    workers = max(1, min(concurrency or BROADCAST_CONCURRENCY, len(recipients)))
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return counts
+
+def copy_sender(source, caption=None, reply_markup=None):
+    """Отправка копии исходного сообщения [chat_id, message_id] — любой тип контента без перекодирования"""
+    from_chat_id, message_id = source
+    return lambda uid: bot.copy_message(uid, from_chat_id, message_id, caption=caption, reply_markup=reply_markup)
+
+# Типы, которые можно собрать в альбом (send_media_group)
+ALBUM_MEDIA_TYPES = {
+    "photo": types.InputMediaPhoto,
+    "video": types.InputMediaVideo,
+    "document": types.InputMediaDocument,
+    "audio": types.InputMediaAudio,
+}
+
+# Что Telegram принимает в одной группе: фото с видео, документы только с документами, аудио только с аудио
+ALBUM_MEDIA_GROUPS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+ALBUM_MAX_ITEMS = 10
+
+def album_sender(album, caption=None):
+    """Отправка альбома; album — список [тип, file_id, подпись]
+    
+    caption заменяет подпись первого элемента (подпись альбома в Telegram — у первого медиа)
+    и размечается HTML, как обычные сообщения бота; подписи элементов уходят как есть.
+    Несовместимые соседние элементы уходят отдельными группами по порядку, одиночный — обычным сообщением.
+    """
+    parts = []  # [(группа, [(тип, file_id, подпись, parse_mode)])]
+    for i, (content_type, file_id, item_caption) in enumerate(album):
+        group = ALBUM_MEDIA_GROUPS.get(content_type)
+        if group is None:
+            continue
+        item = (content_type, file_id, caption, "HTML") if i == 0 and caption is not None else \
+            (content_type, file_id, item_caption, None)
+        if parts and parts[-1][0] == group and len(parts[-1][1]) < ALBUM_MAX_ITEMS:
+            parts[-1][1].append(item)
+        else:
+            parts.append((group, [item]))
+    if not parts:
+        return None
+    
+    sends = []
+    for _, items in parts:
+        if len(items) == 1:
+            content_type, file_id, item_caption, _ = items[0]
+            sends.append(payload_sender(content_type, file_id, item_caption))
+        else:
+            media = [ALBUM_MEDIA_TYPES[content_type](file_id, caption=item_caption, parse_mode=parse_mode)
+                     for content_type, file_id, item_caption, parse_mode in items]
+            sends.append(functools.partial(lambda media, uid: bot.send_media_group(uid, media), media))
+    if len(sends) == 1:
+        return sends[0]
+    
+    async def send(uid):
+        for send_part in sends:
+            await send_part(uid)
+    return send
+
+def payload_sender(content_type, payload, caption=None, reply_markup=None):
+    """Функция отправки сохраненного содержимого (тип, file_id/текст, подпись) одному получателю"""
+    if content_type == "text":
+        return lambda uid: bot.send_message(uid, payload, reply_markup=reply_markup)
+    if content_type == "photo":
+        return lambda uid: bot.send_photo(uid, payload, caption=caption, reply_markup=reply_markup)
+    if content_type == "video":
+        return lambda uid: bot.send_video(uid, payload, caption=caption, reply_markup=reply_markup)
+    if content_type == "document":
+        return lambda uid: bot.send_document(uid, payload, caption=caption, reply_markup=reply_markup)
+    if content_type == "voice":
+        return lambda uid: bot.send_voice(uid, payload, caption=caption, reply_markup=reply_markup)
+    if content_type == "audio":
+        return lambda uid: bot.send_audio(uid, payload, caption=caption, reply_markup=reply_markup)
+    if content_type == "animation":
+        return lambda uid: bot.send_animation(uid, payload, caption=caption, reply_markup=reply_markup)
+    if content_type == "video_note":
+        return lambda uid: bot.send_video_note(uid, payload, reply_markup=reply_markup)
+    if content_type == "sticker":
+        return lambda uid: bot.send_sticker(uid, payload, reply_markup=reply_markup)
+    if content_type == "location":
+        return lambda uid: bot.send_location(uid, payload[0], payload[1], reply_markup=reply_markup)
+    if content_type == "contact":
+        return lambda uid: bot.send_contact(uid, payload[0], payload[1] or payload[0], reply_markup=reply_markup)
+    return None
+
+# --- СОХРАНЯЕМЫЕ ЗАДАЧИ РАССЫЛКИ ---
+# Рассылка — задача в broadcasts.json: содержимое, получатели со статусом и курсор.
+# Ключ идемпотентности — пара (задача, получатель): статус получателя переводится
+# в "sending" и сохраняется на диск ДО запроса к API. После перезапуска такие
+# получатели помечаются "unknown" и повторно не отправляются (не более одного раза).
+# Ход рассылки (курсор, состояние, статусы пачки) дописывается строкой в журнал задачи
+# broadcast_logs/<job_id>.jsonl; broadcasts.json целиком переписывается только при создании,
+# запуске и завершении задачи — тогда же журналы, уже вошедшие в снимок, удаляются.
+BROADCASTS_FILE = "broadcasts.json"
+BROADCAST_LOG_DIR = "broadcast_logs"
+BROADCAST_BATCH_SIZE = 50
+BROADCAST_RECORD_BATCHES = 10  # Итоги скольких пачек копить до записи в users.json / assignments.json
+BROADCAST_KEEP_DAYS = 30  # Сколько дней хранить завершенные задачи
+
+broadcast_jobs = {}
+broadcast_pending = {}  # job_id -> еще не записанные итоги пачек {"results", "reasons", "batches"}
+
+def load_broadcasts():
+    """Загрузка задач рассылки в память (при запуске)"""
+    global broadcast_jobs
+    if not os.path.exists(BROADCASTS_FILE):
+        broadcast_jobs = {}
+        return broadcast_jobs
+    try:
+        with open(BROADCASTS_FILE, "r", encoding="utf-8") as f:
+            broadcast_jobs = json.load(f).get("jobs", {})
+    except Exception as e:
+        log_error(f"❌ Ошибка загрузки {BROADCASTS_FILE}: {e}")
+        broadcast_jobs = {}
+    
+    for job in broadcast_jobs.values():
+        replay_broadcast_log(job)
+    
+    # Старые завершенные задачи больше не нужны
+    expire_ms = now_ms() - BROADCAST_KEEP_DAYS * 86400 * 1000
+    for job_id in [job_id for job_id, job in broadcast_jobs.items()
+                   if job.get("state") in ("done", "cancelled") and job.get("finished", job.get("created", 0)) < expire_ms]:
+        del broadcast_jobs[job_id]
+    return broadcast_jobs
+
+def save_broadcasts():
+    """Атомарная запись всех задач рассылки (снимок включает журналы — они удаляются)"""
+    if not file_lock.acquire(BROADCASTS_FILE):
+        return False
+    try:
+        temp_file = f"{BROADCASTS_FILE}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump({"jobs": broadcast_jobs}, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_file, BROADCASTS_FILE)
+        if os.path.isdir(BROADCAST_LOG_DIR):
+            for name in os.listdir(BROADCAST_LOG_DIR):
+                os.remove(os.path.join(BROADCAST_LOG_DIR, name))
+        return True
+    except Exception as e:
+        log_error(f"❌ Ошибка сохранения {BROADCASTS_FILE}: {e}")
+        return False
+    finally:
+        file_lock.release(BROADCASTS_FILE)
+
+def broadcast_log_path(job_id):
+    return os.path.join(BROADCAST_LOG_DIR, f"{job_id}.jsonl")
+
+def log_broadcast_progress(job, statuses=None):
+    """Дописать в журнал задачи курсор, состояние и изменившиеся статусы получателей"""
+    entry = {"cursor": job["cursor"], "state": job["state"], "recorded": job.get("recorded", job["cursor"])}
+    if statuses:
+        entry["r"] = statuses
+    try:
+        os.makedirs(BROADCAST_LOG_DIR, exist_ok=True)
+        with open(broadcast_log_path(job["job_id"]), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        return True
+    except OSError as e:
+        log_error(f"❌ Ошибка записи журнала рассылки {job['job_id']}: {e}")
+        return False
+
+def replay_broadcast_log(job):
+    """Применить к задаче из снимка записи ее журнала"""
+    path = broadcast_log_path(job["job_id"])
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log_error(f"⚠️ Поврежденная строка журнала {path} пропущена")
+                continue
+            job["cursor"] = entry["cursor"]
+            job["state"] = entry["state"]
+            job["recorded"] = entry["recorded"]
+            job["recipients"].update(entry.get("r", {}))
+
+def create_broadcast_job(kind, admin_id, recipients, content_type, payload, caption=None, **extra):
+    """Новая задача рассылки (kind: message — обычная рассылка, assignment — задание, reminder — напоминание о сроке)"""
+    # Несколько задач за одну миллисекунду (напоминания о сроках одного тика) получают суффикс
+    base_id = job_id = f"bc_{now_ms()}_{admin_id}"
+    suffix = 1
+    while job_id in broadcast_jobs or os.path.exists(broadcast_log_path(job_id)):
+        suffix += 1
+        job_id = f"{base_id}_{suffix}"
+    job = {
+        "job_id": job_id,
+        "kind": kind,
+        "admin_id": str(admin_id),
+        "created": now_ms(),
+        "state": "running",
+        "content_type": content_type,
+        "payload": payload,
+        "caption": caption,
+        "cursor": 0,
+    }
+    set_job_recipients(job, recipients)
+    job.update(extra)
+    broadcast_jobs[job_id] = job
+    save_broadcasts()
+    return job
+
+def set_job_recipients(job, recipients, users_data=None):
+    """Список получателей задачи (все в статусе pending)"""
+    job["order"] = [str(uid) for uid in recipients]
+    job["recipients"] = {uid: "pending" for uid in job["order"]}
+    job["recorded"] = 0  # До какой позиции order итоги записаны в users.json / assignments.json
+    # Ранее недоступные, попавшие в рассылку на перепроверку
+    if users_data is None:
+        users_data = load_users()["users"]
+    job["probing"] = [uid for uid in job["order"] if users_data.get(uid, {}).get("unreachable")]
+
+def broadcast_job_counts(job):
+    """Счетчики получателей задачи по статусам"""
+    counts = {"pending": 0, "sending": 0, "sent": 0, "failed": 0, "blocked": 0, "unknown": 0}
+    for status in job["recipients"].values():
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+def broadcast_job_sender(job):
+    """Функция отправки для задачи (по ее типу)"""
+    if job["kind"] == "assignment":
+        return assignment_job_sender(job)
+    if job["kind"] == "reminder":
+        return reminder_job_sender(job)
+    if job.get("album"):
+        return album_sender(job["album"])
+    if job.get("source"):
+        return copy_sender(job["source"])
+    return payload_sender(job["content_type"], job["payload"], job.get("caption"))
+
+# Приостановленная задача не опрашивает состояние, а ждет, пока ее разбудит broadcast_control
+job_wakeups = {}
+
+async def wait_while_paused(job):
+    """Ждать продолжения или отмены приостановленной задачи"""
+    event = job_wakeups.setdefault(job["job_id"], asyncio.Event())
+    while job["state"] == "paused":
+        event.clear()
+        await event.wait()
+
+def wake_broadcast_job(job_id):
+    """Разбудить задачу после смены состояния"""
+    event = job_wakeups.get(job_id)
+    if event is not None:
+        event.set()
+
+def broadcast_batch_done(job, results, reasons):
+    """Итоги пачки копятся и записываются раз в BROADCAST_RECORD_BATCHES пачек"""
+    pending = broadcast_pending.setdefault(job["job_id"], {"results": {}, "reasons": {}, "batches": 0})
+    pending["results"].update(results)
+    pending["reasons"].update(reasons)
+    pending["batches"] += 1
+    if pending["batches"] >= BROADCAST_RECORD_BATCHES:
+        flush_broadcast_results(job)
+
+def flush_broadcast_results(job):
+    """Записать накопленные итоги: недоступные получатели, для заданий — получатели задания"""
+    pending = broadcast_pending.pop(job["job_id"], None)
+    if pending is None:
+        return False
+    results = pending["results"]
+    probing = set(job.get("probing", []))
+    recovered = [uid for uid, status in results.items() if status == "sent" and uid in probing]
+    update_reachability(pending["reasons"], recovered)
+    if job["kind"] == "assignment":
+        record_assignment_recipients(job, results)
+    job["recorded"] = job["cursor"]
+    return True
+
+def record_interrupted_results(job):
+    """После перезапуска записать итоги, не попавшие в файлы до остановки (только получатели задания)"""
+    if job["kind"] != "assignment":
+        return
+    results = {}
+    for uid in job["order"][job.get("recorded", job["cursor"]):job["cursor"]]:
+        status = job["recipients"].get(uid)
+        if status in ("sent", "failed", "blocked"):
+            results[uid] = status
+    record_assignment_recipients(job, results)
+    job["recorded"] = job["cursor"]
+
+async def run_broadcast_job(job, reporter=None):
+    """Выполнение (или продолжение) задачи рассылки пачками по BROADCAST_BATCH_SIZE
+    
+    Состояние задачи: running → done; paused (ждем продолжения); cancelled.
+    reporter — ProgressReporter для обновления сообщения администратора.
+    """
+    send = broadcast_job_sender(job)
+    order = job["order"]
+    
+    while job["state"] in ("running", "paused") and job["cursor"] < len(order):
+        if job["state"] == "paused":
+            if flush_broadcast_results(job):
+                log_broadcast_progress(job)
+            if reporter is not None:
+                await reporter.update()
+            await wait_while_paused(job)
+            continue
         
-        # Разбиваем по строкам, чтобы не обрезать слова
-        lines = text.split('\n')
+        start = job["cursor"]
+        batch = [uid for uid in order[start:start + BROADCAST_BATCH_SIZE]
+                 if job["recipients"].get(uid) == "pending"]
         
-        for line in lines:
-            # Если добавление строки не превысит лимит
-            if len(current_part) + len(line) + 1 <= 4000:
-                current_part += line + '\n'
-            else:
-                # Сохраняем текущую часть и начинаем новую
-                if current_part:
-                    parts.append(current_part)
-                current_part = line + '\n'
-        
-        # Добавляем последнюю часть
-        if current_part:
-            parts.append(current_part)
-        
-        # Отправляем все части
-        for i, part in enumerate(parts):
-            if i == 0 and reply_markup is not None:
-                # Клавиатуру добавляем только к первой части
-                await bot.send_message(chat_id, part, reply_markup=reply_markup, parse_mode=parse_mode)
-            else:
-                await bot.send_message(chat_id, part, parse_mode=parse_mode)
-            
-            # Небольшая задержка между отправками
-            if i < len(parts) - 1:
-                await asyncio.sleep(0.1)
+        # Сначала помечаем пачку как "отправляется" и сохраняем — только потом шлем
+        for uid in batch:
+            job["recipients"][uid] = "sending"
+        job["cursor"] = min(len(order), start + BROADCAST_BATCH_SIZE)
+        log_broadcast_progress(job, dict.fromkeys(batch, "sending"))
+        
+        results = {}
+        reasons = {}
         
-        # Уведомляем, если сообщение было разбито
-        if len(parts) > 1:
-            await bot.send_message(chat_id, f"📄 *Сообщение разбито на {len(parts)} части*", parse_mode="Markdown")
+        async def on_result(chat_id, status, error):
+            results[str(chat_id)] = status
+            job["recipients"][str(chat_id)] = status
+            if status == "blocked":
+                reasons[str(chat_id)] = unreachable_reason(error)
+            if reporter is not None:
+                await reporter.update()
+        
+        if send is None:
+            results = {uid: "failed" for uid in batch}
+        elif batch:
+            await run_broadcast(batch, send, on_result, stop=lambda: job["state"] != "running")
+        
+        # Остановленные паузой/отменой до отправки возвращаются в очередь
+        untouched = [uid for uid in batch if uid not in results]
+        for uid in untouched:
+            job["recipients"][uid] = "pending"
+        if untouched:
+            job["cursor"] = start
+        
+        broadcast_batch_done(job, results, reasons)
+        job["recipients"].update(results)
+        log_broadcast_progress(job, {**results, **dict.fromkeys(untouched, "pending")})
+    
+    if flush_broadcast_results(job):
+        log_broadcast_progress(job)
+    if job["state"] in ("running", "cancelled"):
+        cancelled = job["state"] == "cancelled" and "pending" in job["recipients"].values()
+        job["state"] = "cancelled" if cancelled else "done"
+        job["finished"] = now_ms()
+        save_broadcasts()
+    job_wakeups.pop(job["job_id"], None)
+    return broadcast_job_counts(job)
+
+class ProgressReporter:
+    """Сообщение о ходе рассылки: правки не чаще раза в interval секунд или шага step"""
+    def __init__(self, job, title, interval=2.0, step=0.05):
+        self.job = job
+        self.title = title
+        self.interval = interval
+        self.step = step
+        self.started = time.monotonic()
+        self.done_at_start = None
+        self.last_edit = 0.0
+        self.last_fraction = 0.0
+        self.last_state = None
+        self.last_render = None
+    
+    def _progress(self):
+        counts = broadcast_job_counts(self.job)
+        total = len(self.job["order"])
+        done = total - counts["pending"] - counts["sending"]
+        return counts, total, done
+    
+    def render(self):
+        counts, total, done = self._progress()
+        if self.done_at_start is None:
+            self.done_at_start = done
+        percent = int(done * 100 / total) if total else 100
+        bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
+        
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        rate = (done - self.done_at_start) / elapsed
+        
+        paused = self.job["state"] == "paused"
+        text = f"{self.title}{' — ⏸ ПАУЗА' if paused else ''}\n\n"
+        text += f"{bar} {percent}% ({done} из {total})\n\n"
+        text += f"• Отправлено: {counts['sent']}\n"
+        text += f"• Ошибок: {counts['failed']}\n"
+        text += f"• Заблокировали бота: {counts['blocked']}\n"
+        if not paused and rate > 0:
+            remaining = total - done
+            text += f"• Скорость: {rate:.1f} сообщ./с\n"
+            text += f"• Осталось: ~{int(remaining / rate)} с\n"
+        
+        job_id = self.job["job_id"]
+        kb = InlineKeyboardMarkup(row_width=2)
+        kb.add(
+            InlineKeyboardButton("▶️ Продолжить", callback_data=f"broadcast_resume:{job_id}") if paused
+            else InlineKeyboardButton("⏸ Пауза", callback_data=f"broadcast_pause:{job_id}"),
+            InlineKeyboardButton("⏹ Отменить", callback_data=f"broadcast_cancel:{job_id}")
+        )
+        return text, kb
+    
+    async def update(self, force=False):
+        report = self.job.get("report")
+        if not report:
+            return
+        # Для проверки шага хватает курсора (без пересчета всех статусов на каждую отправку)
+        total = len(self.job["order"])
+        fraction = self.job["cursor"] / total if total else 1.0
+        now = time.monotonic()
+        state_changed = self.job["state"] != self.last_state
+        if not (force or state_changed or now - self.last_edit >= self.interval
+                or fraction - self.last_fraction >= self.step):
+            return
+        
+        self.last_edit = now
+        self.last_fraction = fraction
+        self.last_state = self.job["state"]
+        text, kb = self.render()
+        rendered = (text, json.dumps(kb.to_python(), sort_keys=True))
+        if rendered == self.last_render:
+            return  # Тот же текст и кнопки — правка вернула бы только MessageNotModified
+        self.last_render = rendered
+        try:
+            await bot.edit_message_text(text, chat_id=report[0], message_id=report[1], reply_markup=kb)
+        except Exception:
+            pass  # Сообщение не изменилось или удалено — прогресс не критичен
+
+async def resume_broadcast_jobs():
+    """Продолжение незавершенных рассылок после перезапуска"""
+    for job in list(broadcast_jobs.values()):
+        if job.get("state") not in ("running", "paused"):
+            continue
+        interrupted = [uid for uid, status in job["recipients"].items() if status == "sending"]
+        for uid in interrupted:
+            job["recipients"][uid] = "unknown"  # Запрос мог уйти — не повторяем
+        record_interrupted_results(job)
+        save_broadcasts()
+        log_info(f"🔁 Продолжаю рассылку {job['job_id']}: осталось "
+                 f"{broadcast_job_counts(job)['pending']}, статус неизвестен у {len(interrupted)}")
+        asyncio.get_event_loop().create_task(finish_background_job(job, "🔁 Рассылка после перезапуска"))
+
+async def finish_background_job(job, title):
+    """Довести рассылку до конца в фоне и сообщить администратору"""
+    send_priority.set(PRIORITY_NOTIFICATION)
+    try:
+        counts = await run_broadcast_job(job, ProgressReporter(job, title))
+        text = (f"{title}: <b>{'отменена' if job['state'] == 'cancelled' else 'завершена'}</b>\n\n"
+                f"• Отправлено: {counts['sent']}\n"
+                f"• Не отправлено: {counts['failed'] + counts['blocked']}"
+                + (f" (заблокировали бота: {counts['blocked']})" if counts["blocked"] else ""))
+        if counts["pending"]:
+            text += f"\n• Отменено до отправки: {counts['pending']}"
+        if counts["unknown"]:
+            text += f"\n• Статус неизвестен (прервано перезапуском): {counts['unknown']}"
+        if job["kind"] == "assignment":
+            text += f"\n• Задание: <code>{job['assignment_id']}</code>"
+        await bot.send_message(int(job["admin_id"]), text)
+    except Exception as e:
+        log_error(f"❌ Ошибка фоновой рассылки {job.get('job_id')}: {e}")
+
+# --- ОТЛОЖЕННЫЕ РАССЫЛКИ ---
+# Запланированная задача хранится в broadcasts.json в состоянии scheduled с run_at (мс)
+# и запросом аудитории; получатели вычисляются в момент запуска.
+SCHEDULER_INTERVAL = 30  # Секунд между проверками
+
+def parse_schedule_time(text, now=None):
+    """Время из "ДД.ММ.ГГГГ ЧЧ:ММ", "ДД.ММ ЧЧ:ММ" или "ЧЧ:ММ" (ближайшее) → мс; None если не разобрать"""
+    now = now or datetime.now()
+    text = " ".join((text or "").split())
+    for fmt in ("%d.%m.%Y %H:%M", "%d.%m %H:%M", "%H:%M"):
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%d.%m %H:%M":
+            # Дата без года, уже прошедшая в этом году, — ближайшая, то есть в следующем
+            parsed = parsed.replace(year=now.year)
+            if parsed <= now:
+                parsed = parsed.replace(year=now.year + 1)
+        elif fmt == "%H:%M":
+            parsed = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+            if parsed <= now:
+                parsed += timedelta(days=1)
+        return int(parsed.timestamp() * 1000)
+    return None
+
+async def activate_scheduled_job(job):
+    """Перевод запланированной задачи в работу: аудитория, задание, сообщение о ходе"""
+    users_data = load_users()["users"]
+    recipients, _ = select_audience(job.get("audience") or {}, users_data)
+    
+    if job["kind"] == "assignment":
+        recipients = [uid for uid in recipients if int(uid) not in [OLGA_ID, YOUR_ADMIN_ID]]
+        assignment_info = create_assignment(job["admin_id"], job["content_type"], job["payload"],
+                                            job.get("caption"), job.get("album"), job.get("levels"))
+        if assignment_info is None:
+            job["state"] = "cancelled"
+            job["finished"] = now_ms()
+            save_broadcasts()
+            await bot.send_message(int(job["admin_id"]), "❌ Не удалось создать запланированное задание")
+            return False
+        job["assignment_id"] = assignment_info["assignment_id"]
+        job["admin_name"] = assignment_info["admin_name"]
+    
+    set_job_recipients(job, recipients, users_data)
+    job["state"] = "running"
+    job["started"] = now_ms()
+    try:
+        status = await bot.send_message(int(job["admin_id"]), f"🕒 Запускаю запланированную рассылку на {len(recipients)} получателей...")
+        job["report"] = [status.chat.id, status.message_id]
+    except Exception as e:
+        log_error(f"⚠️ Не удалось уведомить о запуске рассылки {job['job_id']}: {e}")
+    save_broadcasts()
+    return True
+
+async def broadcast_scheduler():
+    """Запуск запланированных рассылок по времени"""
+    send_priority.set(PRIORITY_NOTIFICATION)
+    while True:
+        try:
+            for job in list(broadcast_jobs.values()):
+                if job.get("state") == "scheduled" and job.get("run_at", 0) <= now_ms():
+                    if await activate_scheduled_job(job):
+                        asyncio.ensure_future(finish_background_job(job, "🕒 Запланированная рассылка"))
+        except Exception as e:
+            log_error(f"❌ Ошибка планировщика рассылок: {e}")
+        await asyncio.sleep(SCHEDULER_INTERVAL)
+
+# --- НЕДОСТУПНЫЕ ПОЛУЧАТЕЛИ ---
+# Пользователь, заблокировавший бота (или удаленный), помечается в users.json:
+# unreachable — причина, unreachable_since — когда впервые, unreachable_probe — последняя попытка.
+# В рассылки такие пользователи не попадают, кроме редкой перепроверки.
+UNREACHABLE_REPROBE_DAYS = int(os.getenv("UNREACHABLE_REPROBE_DAYS", "30"))
+UNREACHABLE_REASONS = (
+    (BotBlocked, "blocked"),
+    (UserDeactivated, "deactivated"),
+    (ChatNotFound, "chat_not_found"),
+)
+
+def unreachable_reason(error):
+    for error_class, reason in UNREACHABLE_REASONS:
+        if isinstance(error, error_class):
+            return reason
+    return None
+
+def is_reachable(user, now=None):
+    """Можно ли включать пользователя в рассылку (недоступных — раз в UNREACHABLE_REPROBE_DAYS)"""
+    if not user.get("unreachable"):
+        return True
+    now = now or now_ms()
+    return now - (user.get("unreachable_probe") or 0) >= UNREACHABLE_REPROBE_DAYS * 86400 * 1000
+
+def update_reachability(unreachable, recovered):
+    """Отметить недоступных {uid: причина} и снять отметку с recovered (одна запись users.json)"""
+    if not unreachable and not recovered:
+        return
+    data = load_users()
+    users = data["users"]
+    now = now_ms()
+    
+    for uid, reason in unreachable.items():
+        u = users.get(uid)
+        if u is None:
+            continue
+        if not u.get("unreachable"):
+            u["unreachable_since"] = now
+        u["unreachable"] = reason
+        u["unreachable_probe"] = now
+    
+    for uid in recovered:
+        u = users.get(uid)
+        if u is not None:
+            for field in ("unreachable", "unreachable_since", "unreachable_probe"):
+                u.pop(field, None)
+    
+    save_users(data, changed=list(unreachable) + list(recovered))
+    if unreachable:
+        log_info(f"🚫 Отмечено недоступных получателей: {len(unreachable)}")
+
+def reachability_counts(users):
+    """(доступные, недоступные) для статистики"""
+    unreachable = sum(1 for u in users.values() if u.get("unreachable"))
+    return len(users) - unreachable, unreachable
 
 # --- УЛУЧШЕННАЯ БЕЗОПАСНАЯ ЗАГРУЗКА И СОХРАНЕНИЕ ---
 def recover_corrupted_file():
@@ -142,13 +1086,15 @@ def recover_corrupted_file():
             with open(USERS_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
             
+            # Восстановленные данные становятся текущей версией файла
+            data["version"] = storage_versions.setdefault(USERS_FILE, data.get("version", 0))
             return data
         except Exception as e:
             log_error(f"❌ Не удалось восстановить из backup: {e}")
     
     # Создаем новый файл
     log_info("Создаю новый файл users.json")
-    return {"users": {}}
+    return {"users": {}, "version": storage_versions.get(USERS_FILE, 0)}
 
 def load_users():
     """Загрузка пользователей с автоматическим исправлением проблем и блокировкой"""
@@ -176,10 +1122,14 @@ def load_users():
             log_error("Некорректная структура users.json: отсутствует ключ 'users'")
             return {"users": {}}
         
+        # Изменения отдельных пользователей из журнала поверх снимка
+        users_journal.replay(data)
+        
         # Исправляем данные при загрузке
         users = data["users"]
         fixed_count = 0
         duplicates_removed = 0
+        timestamps_converted = 0
         
         for user_id in list(users.keys()):
             user = users[user_id]
@@ -213,7 +1163,12 @@ def load_users():
                 # Добавляем отсутствующий chat_id
                 user["chat_id"] = user_id
                 fixed_count += 1
+            
+            # Строковые даты старого формата → миллисекунды
+            timestamps_converted += normalize_user_timestamps(user)
         
+        if timestamps_converted > 0:
+            log_info(f"Переведено в числовой формат дат: {timestamps_converted}")
         if fixed_count > 0:
             log_info(f"Исправлено {fixed_count} chat_id")
         if duplicates_removed > 0:
@@ -221,6 +1176,7 @@ def load_users():
         
         user_count = len(users)
         log_info(f"✅ Загружено пользователей: {user_count}")
+        storage_versions.setdefault(USERS_FILE, data.get("version", 0))
         return data
         
     except json.JSONDecodeError as e:
@@ -244,8 +1200,11 @@ def load_users():
         # Исправление race condition: всегда освобождаем блокировку
         file_lock.release(USERS_FILE)
 
-def save_users(data):
-    """Сохранение пользователей с атомарной операцией и блокировкой"""
+def save_users(data, changed=None):
+    """Сохранение пользователей с атомарной операцией и блокировкой
+    
+    changed — ID измененных пользователей для обновления индексов (None — неизвестно каких).
+    """
     if "users" not in data:
         log_error("❌ Попытка сохранить данные без ключа 'users'")
         return False
@@ -256,6 +1215,11 @@ def save_users(data):
         return False
     
     try:
+        if is_stale(USERS_FILE, data):
+            log_error(f"❌ users.json изменен после загрузки этих данных (версия {data.get('version', 0)}, "
+                      f"файл {storage_versions.get(USERS_FILE, 0)}), сохранение отменено")
+            return False
+        
         user_count = len(data["users"])
         log_info(f"🔄 Сохранение {user_count} пользователей...")
         
@@ -269,11 +1233,12 @@ def save_users(data):
             except Exception as e:
                 log_error(f"⚠️ Не удалось создать backup: {e}")
         
-        # Сохраняем во временный файл
+        # Сохраняем во временный файл (с новым номером версии)
         temp_file = f"{USERS_FILE}.tmp"
         try:
+            version = data.get("version", 0) + 1
             with open(temp_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+                json.dump({**data, "version": version}, f, ensure_ascii=False, indent=2)
             
             # Проверяем что сохранили корректно
             with open(temp_file, "rb") as f:
@@ -292,7 +1257,11 @@ def save_users(data):
             else:  # Unix/Linux
                 os.rename(temp_file, USERS_FILE)
             
+            data["version"] = version
+            storage_versions[USERS_FILE] = version
+            users_journal.truncate(data.get("journal_seq", 0))
             log_info(f"✅ Сохранено {user_count} пользователей")
+            reindex_users(data["users"], changed)
             return True
             
         except Exception as e:
@@ -324,17 +1293,27 @@ def load_assignments():
     # Исправление race condition: добавляем блокировку файла
     if not file_lock.acquire(ASSIGNMENTS_FILE):
         log_error("❌ Не удалось получить блокировку для загрузки assignments.json")
-        return {"assignments": {}, "solutions": {}, "conversations": {}, "assignment_recipients": {}}
+        return {"assignments": {}, "solutions": {}, "conversations": [], "assignment_recipients": {}, "assignment_status": {}, "mentor_inbox": {}, "student_assignments": {}, "mentor_metrics": {}}
     
     try:
         if not os.path.exists(ASSIGNMENTS_FILE):
-            return {"assignments": {}, "solutions": {}, "conversations": {}, "assignment_recipients": {}}
+            return {"assignments": {}, "solutions": {}, "conversations": [], "assignment_recipients": {}, "assignment_status": {}, "mentor_inbox": {}, "student_assignments": {}, "mentor_metrics": {}}
         
         with open(ASSIGNMENTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
+        
+        # Старый формат переписки и строковые даты переводим при загрузке
+        migrate_conversations(data)
+        normalize_assignment_timestamps(data)
+        migrate_assignment_status(data)
+        migrate_student_assignments(data)
+        migrate_mentor_inbox(data)
+        migrate_mentor_metrics(data)
+        storage_versions.setdefault(ASSIGNMENTS_FILE, data.get("version", 0))
+        return data
     except Exception as e:
         log_error(f"❌ Ошибка загрузки assignments.json: {e}")
-        return {"assignments": {}, "solutions": {}, "conversations": {}, "assignment_recipients": {}}
+        return {"assignments": {}, "solutions": {}, "conversations": [], "assignment_recipients": {}, "assignment_status": {}, "mentor_inbox": {}, "student_assignments": {}, "mentor_metrics": {}}
     finally:
         file_lock.release(ASSIGNMENTS_FILE)
 
@@ -343,9 +1322,16 @@ def save_assignments(data):
     # Исправление: добавляем атомарную операцию и блокировку как в save_users()
     if not file_lock.acquire(ASSIGNMENTS_FILE):
         log_error("❌ Не удалось получить блокировку для сохранения assignments.json")
+        reset_menu_counters()
         return False
     
     try:
+        if is_stale(ASSIGNMENTS_FILE, data):
+            log_error(f"❌ assignments.json изменен после загрузки этих данных (версия {data.get('version', 0)}, "
+                      f"файл {storage_versions.get(ASSIGNMENTS_FILE, 0)}), сохранение отменено")
+            reset_menu_counters()
+            return False
+        
         # Backup текущего файла
         backup_name = None
         if os.path.exists(ASSIGNMENTS_FILE):
@@ -356,11 +1342,12 @@ def save_assignments(data):
             except Exception as e:
                 log_error(f"⚠️ Не удалось создать backup assignments: {e}")
         
-        # Сохраняем во временный файл
+        # Сохраняем во временный файл (с новым номером версии)
         temp_file = f"{ASSIGNMENTS_FILE}.tmp"
         try:
+            version = data.get("version", 0) + 1
             with open(temp_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+                json.dump({**data, "version": version}, f, ensure_ascii=False, indent=2)
             
             # Проверяем что можем загрузить обратно
             with open(temp_file, "r", encoding="utf-8") as f:
@@ -368,9 +1355,11 @@ def save_assignments(data):
             
             # Атомарная замена
             os.replace(temp_file, ASSIGNMENTS_FILE)
+            data["version"] = version
+            storage_versions[ASSIGNMENTS_FILE] = version
             
             log_info(f"✅ Сохранено assignments: {len(data.get('assignments', {}))} заданий, "
-                    f"{len(data.get('conversations', {}))} сообщений")
+                    f"{len(data.get('conversations', []))} сообщений")
             return True
             
         except Exception as e:
@@ -391,94 +1380,1169 @@ def save_assignments(data):
                 except:
                     pass
             
+            reset_menu_counters()
             return False
     finally:
         file_lock.release(ASSIGNMENTS_FILE)
 
-# --- ФУНКЦИИ ДЛЯ СОХРАНЕНИЯ И ПОЛУЧЕНИЯ ПЕРЕПИСКИ ---
-def save_conversation_message(from_id, to_id, message, assignment_id=None, is_assignment_related=False):
-    """Сохранение сообщения в историю переписки (ИСПРАВЛЕНО: добавлено сохранение ВСЕХ типов сообщений)"""
-    assignments_data = load_assignments()
+# --- ЕДИНИЦА РАБОТЫ ---
+TRANSACTION_RETRIES = 3
+
+class UnitOfWork:
+    """Изменения обработчика копятся в памяти и записываются одним сохранением на файл
     
-    message_id = f"msg_{from_id}_{to_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    uow = UnitOfWork()
+    uow.assignments[...] = ...; uow.stage("assignments")
+    uow.users["users"][uid] = ...; uow.stage("users", user_ids=[uid])
+    uow.commit()  # каждый измененный файл — одна атомарная запись
     
-    users_data = load_users()["users"]
-    from_user = users_data.get(from_id, {})
-    to_user = users_data.get(to_id, {})
-    
-    from_name = f"{from_user.get('name', '?')} {from_user.get('surname', '')}".strip()
-    to_name = f"{to_user.get('name', '?')} {to_user.get('surname', '')}".strip()
-    
-    message_data = {
-        "message_id": message_id,
-        "from_user_id": from_id,
-        "from_user_name": from_name,
-        "to_user_id": to_id,
-        "to_user_name": to_name,
-        "timestamp": str(datetime.now()),
-        "content_type": message.content_type,
-        "assignment_id": assignment_id,
-        "is_assignment_related": is_assignment_related
-    }
+    При фиксации версии всех прочитанных файлов сверяются с последними записанными:
+    если кто-то успел сохранить файл раньше, commit() возвращает False и ставит conflict.
+    """
+    def __init__(self):
+        self._users = None
+        self._assignments = None
+        self.dirty = set()
+        self.changed_users = set()   # None — изменены неизвестно какие пользователи
+        self.conflict = False
+    
+    @property
+    def users(self):
+        if self._users is None:
+            self._users = load_users()
+        return self._users
+    
+    @property
+    def assignments(self):
+        if self._assignments is None:
+            self._assignments = load_assignments()
+        return self._assignments
+    
+    def stage(self, *names, user_ids=None):
+        """Отметить коллекции ("users", "assignments") как измененные; user_ids — кого из пользователей меняли"""
+        self.dirty.update(names)
+        if "users" in names and self.changed_users is not None:
+            self.changed_users = None if user_ids is None else self.changed_users | {str(uid) for uid in user_ids}
+    
+    def _collections(self):
+        """Прочитанные коллекции: (имя, файл, данные) в постоянном порядке блокировки"""
+        loaded = [("users", USERS_FILE, self._users), ("assignments", ASSIGNMENTS_FILE, self._assignments)]
+        return [item for item in loaded if item[2] is not None]
+    
+    def commit(self):
+        """Записать все измененные коллекции разом; False при конфликте версий или ошибке записи"""
+        if not self.dirty:
+            return True
+        if self._commit():
+            return True
+        if "assignments" in self.dirty:
+            reset_menu_counters()  # Счетчики могли учесть незаписанные изменения
+        return False
     
-    # ИСПРАВЛЕНО: Сохраняем содержимое ВСЕХ типов сообщений
-    if message.content_type == "text":
-        message_data["text"] = message.text
-    elif message.content_type == "photo":
-        message_data["photo_id"] = message.photo[-1].file_id
-        message_data["caption"] = message.caption
-    elif message.content_type == "document":
-        message_data["document_id"] = message.document.file_id
-        message_data["caption"] = message.caption
-    elif message.content_type == "voice":
-        message_data["voice_id"] = message.voice.file_id
-    elif message.content_type == "video":
-        message_data["video_id"] = message.video.file_id
-        message_data["caption"] = message.caption
-    elif message.content_type == "video_note":
-        message_data["video_note_id"] = message.video_note.file_id
-    elif message.content_type == "sticker":
-        message_data["sticker_id"] = message.sticker.file_id
-    elif message.content_type == "audio":
-        message_data["audio_id"] = message.audio.file_id
-        message_data["caption"] = message.caption
-    elif message.content_type == "location":
-        message_data["latitude"] = message.location.latitude
-        message_data["longitude"] = message.location.longitude
-    elif message.content_type == "contact":
-        message_data["phone_number"] = message.contact.phone_number
-        message_data["first_name"] = message.contact.first_name
-        message_data["last_name"] = message.contact.last_name
+    def _commit(self):        
+        collections = self._collections()
+        users_written = "users" in self.dirty
+        locked = []
+        temp_files = []
+        try:
+            for _, filename, _ in collections:
+                if not file_lock.acquire(filename):
+                    return False
+                locked.append(filename)
+            
+            # Проверка версий: все, что прочитано, не должно было измениться
+            for name, filename, data in collections:
+                if is_stale(filename, data):
+                    log_warning(f"⚠️ Конфликт версий {filename}: транзакция будет повторена")
+                    self.conflict = True
+                    return False
+            
+            # Сначала все временные файлы, затем замены — файлы меняются вместе
+            written = [(name, filename, data) for name, filename, data in collections if name in self.dirty]
+            for name, filename, data in written:
+                temp_file = f"{filename}.txn"
+                temp_files.append(temp_file)
+                version = data.get("version", 0) + 1
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    json.dump({**data, "version": version}, f, ensure_ascii=False, indent=2)
+                with open(temp_file, "r", encoding="utf-8") as f:
+                    json.load(f)
+            
+            for name, filename, data in written:
+                if os.path.exists(filename):
+                    backup_prefix = os.path.splitext(filename)[0]
+                    shutil.copy2(filename, f"{backup_prefix}_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+            for (name, filename, data), temp_file in zip(written, temp_files):
+                os.replace(temp_file, filename)
+                data["version"] = data.get("version", 0) + 1
+                storage_versions[filename] = data["version"]
+            if users_written:
+                users_journal.truncate(self._users.get("journal_seq", 0))
+            
+            log_info(f"✅ Транзакция сохранена: {', '.join(name for name, _, _ in written)}")
+            self.dirty.clear()
+        except Exception as e:
+            log_error(f"❌ Ошибка сохранения транзакции: {e}")
+            return False
+        finally:
+            for temp_file in temp_files:
+                if os.path.exists(temp_file):
+                    try:
+                        os.remove(temp_file)
+                    except OSError:
+                        pass
+            for filename in locked:
+                file_lock.release(filename)
+        
+        if users_written:
+            reindex_users(self._users["users"], self.changed_users)
+        return True
+
+async def run_transaction(work, retries=TRANSACTION_RETRIES):
+    """Выполнить work(uow) и зафиксировать; при конфликте версий повторить на свежих данных
+    
+    work читает и меняет данные только через uow (может быть корутиной) и возвращает
+    результат для обработчика. Возвращает (успех, результат).
+    """
+    for attempt in range(retries + 1):
+        uow = UnitOfWork()
+        result = work(uow)
+        if asyncio.iscoroutine(result):
+            result = await result
+        if uow.commit():
+            return True, result
+        if not uow.conflict:
+            return False, result
+    log_error(f"❌ Транзакция не прошла после {retries + 1} попыток из-за конфликтов")
+    return False, None
+
+# --- ЖУРНАЛ ЗАПИСЕЙ ---
+# Мелкие изменения одного пользователя (активность, уровень) не переписывают users.json целиком:
+# они дописываются строкой в журнал, а снимок переписывается только при сжатии журнала.
+# Журнал пишет один писатель под собственной блокировкой (обработчики и так выполняются
+# по очереди в одном цикле событий): дописывание строки дешевое, поэтому отдельных
+# блокировок по пользователям нет. Блокировку users.json берут только операции над всем
+# снимком: загрузка, полное сохранение (оно же сжатие журнала) и backup.
+JOURNAL_COMPACT_RECORDS = int(os.getenv("JOURNAL_COMPACT_RECORDS", "500"))  # Записей до сжатия в снимок
+
+class RecordJournal:
+    """Журнал изменений записей коллекции: {"seq", "id", "set", "unset"} по строке
+    
+    Снимок хранит journal_seq — номер последней учтенной записи; при загрузке поверх
+    снимка применяются только более новые записи, при полном сохранении учтенные удаляются.
+    """
+    def __init__(self, path, collection):
+        self.path = path
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.seq = None
+        self.count = 0
+    
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    log_error(f"⚠️ Поврежденная строка журнала {self.path} пропущена")
+        return entries
+    
+    def _ensure_seq(self, snapshot_seq=0):
+        if self.seq is None:
+            entries = self._read()
+            self.count = len(entries)
+            self.seq = max([snapshot_seq] + [entry["seq"] for entry in entries])
+    
+    def replay(self, data):
+        """Применить к загруженному снимку записи новее его journal_seq"""
+        records = data[self.collection]
+        with self.lock:
+            entries = self._read()
+            self._ensure_seq(data.get("journal_seq", 0))
+        for entry in entries:
+            if entry["seq"] <= data.get("journal_seq", 0):
+                continue
+            record = records.get(entry["id"])
+            if isinstance(record, dict):
+                record.update(entry.get("set", {}))
+                for field in entry.get("unset", []):
+                    record.pop(field, None)
+            data["journal_seq"] = entry["seq"]
+        return data
+    
+    def append(self, record_id, fields=None, unset=()):
+        """Дописать изменение записи; True, если журнал пора сжать"""
+        with self.lock:
+            self._ensure_seq()
+            self.seq += 1
+            entry = {"seq": self.seq, "id": str(record_id)}
+            if fields:
+                entry["set"] = fields
+            if unset:
+                entry["unset"] = list(unset)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.count += 1
+            return self.count >= JOURNAL_COMPACT_RECORDS
+    
+    def truncate(self, saved_seq):
+        """Убрать записи, уже вошедшие в сохраненный снимок"""
+        with self.lock:
+            entries = [entry for entry in self._read() if entry["seq"] > saved_seq]
+            temp_file = f"{self.path}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temp_file, self.path)
+            self.count = len(entries)
+
+users_journal = RecordJournal(USERS_JOURNAL_FILE, "users")
+
+def update_user_record(user_id, fields=None, unset=(), users=None):
+    """Изменить поля одного пользователя без полной перезаписи users.json
+    
+    users — уже загруженный словарь обработчика: изменение сразу видно и в нем.
+    """
+    user_id = str(user_id)
+    try:
+        compact = users_journal.append(user_id, fields, unset)
+    except OSError as e:
+        log_error(f"❌ Ошибка записи журнала пользователей: {e}")
+        return False
+    if users is not None and user_id in users:
+        users[user_id].update(fields or {})
+        for field in unset:
+            users[user_id].pop(field, None)
+    reindex_users(users, [user_id] if users is not None else None)
+    if compact:
+        compact_users_journal()
+    return True
+
+def touch_user(user_id, users=None):
+    """Отметить активность пользователя (только для уже зарегистрированных)"""
+    if users is not None and str(user_id) not in users:
+        return False
+    return update_user_record(user_id, {"active_today": now_ms()}, users=users)
+
+def compact_users_journal():
+    """Сжать журнал в снимок: полное сохранение users.json убирает учтенные записи"""
+    data = load_users()
+    if data.get("users") and save_users(data, changed=()):
+        log_info(f"🗜 Журнал пользователей сжат до записи {data.get('journal_seq', 0)}")
+
+# --- ФУНКЦИИ ДЛЯ СОХРАНЕНИЯ И ПОЛУЧЕНИЯ ПЕРЕПИСКИ ---
+# Компактная запись сообщения в "conversations" (список в порядке времени):
+#   f  — ID отправителя (int)          t — ID получателя (int)
+#   ts — время, мс от эпохи (int)       k — тип контента (индекс в CONTENT_TYPE_CODES)
+#   p  — полезная нагрузка: текст, file_id, [широта, долгота] или [телефон, имя]
+#   c  — подпись к медиа (если есть)    a — ID задания (если есть)
+#   r  — 1, если это ответ наставника на решение
+# Имена собеседников не хранятся — они подставляются при отображении.
+CONTENT_TYPE_CODES = [
+    "text", "photo", "document", "voice", "video", "video_note",
+    "sticker", "audio", "location", "contact", "animation", "other",
+]
+CONTENT_TYPE_INDEX = {name: code for code, name in enumerate(CONTENT_TYPE_CODES)}
+CONTENT_TYPE_LABELS = {
+    "photo": "[Фото]", "document": "[Документ]", "voice": "[Голосовое]", "video": "[Видео]",
+    "video_note": "[Видеосообщение]", "sticker": "[Стикер]", "audio": "[Аудио]",
+    "location": "[Геопозиция]", "contact": "[Контакт]", "animation": "[GIF]", "other": "[Сообщение]",
+}
+# Поля старого формата с file_id для каждого типа
+LEGACY_FILE_FIELDS = {
+    "photo": "photo_id", "document": "document_id", "voice": "voice_id", "video": "video_id",
+    "video_note": "video_note_id", "sticker": "sticker_id", "audio": "audio_id",
+}
+
+def message_payload(message):
+    """Тип контента и полезная нагрузка сообщения Telegram без лишних полей"""
+    content_type = message.content_type
+    if content_type == "text":
+        return content_type, message.text, None
+    if content_type == "photo":
+        return content_type, message.photo[-1].file_id, message.caption
+    if content_type == "location":
+        return content_type, [message.location.latitude, message.location.longitude], None
+    if content_type == "contact":
+        contact_name = f"{message.contact.first_name or ''} {message.contact.last_name or ''}".strip()
+        return content_type, [message.contact.phone_number, contact_name], None
+    media = getattr(message, content_type, None) if content_type in CONTENT_TYPE_INDEX else None
+    if media is not None and getattr(media, "file_id", None):
+        return content_type, media.file_id, message.caption
+    return "other", None, None
+
+def make_conversation_record(from_id, to_id, content_type, payload=None, caption=None,
+                             assignment_id=None, is_reply=False, timestamp=None):
+    """Сборка компактной записи (пустые поля не сохраняются)"""
+    record = {
+        "f": int(from_id),
+        "t": int(to_id),
+        "ts": timestamp if timestamp is not None else now_ms(),
+        "k": CONTENT_TYPE_INDEX.get(content_type, CONTENT_TYPE_INDEX["other"]),
+    }
+    if payload is not None:
+        record["p"] = payload
+    if caption:
+        record["c"] = caption
+    if assignment_id:
+        record["a"] = assignment_id
+    if is_reply:
+        record["r"] = 1
+    return record
+
+def migrate_conversation_record(msg):
+    """Перевод записи старого формата (полные имена, str(datetime), raw) в компактную
+    
+    None, если у записи нет отправителя или получателя (такую не перевести).
+    """
+    if "ts" in msg and "f" in msg:
+        return msg
+    content_type = msg.get("content_type", "other")
+    if msg.get("from_mentor"):
+        from_id, to_id = msg.get("mentor_id"), msg.get("student_id")
     else:
-        # Для всех остальных типов сохраняем минимальную информацию
-        message_data["content_type"] = message.content_type
-        message_data["raw"] = str(message)
+        from_id, to_id = msg.get("from_user_id"), msg.get("to_user_id")
+    if not str(from_id).lstrip("-").isdigit() or not str(to_id).lstrip("-").isdigit():
+        return None
+    
+    if content_type == "text":
+        payload = msg.get("text")
+    elif content_type == "location":
+        payload = [msg.get("latitude"), msg.get("longitude")]
+    elif content_type == "contact":
+        payload = [msg.get("phone_number"), f"{msg.get('first_name') or ''} {msg.get('last_name') or ''}".strip()]
+    else:
+        payload = msg.get(LEGACY_FILE_FIELDS.get(content_type, ""))
+    
+    return make_conversation_record(
+        from_id, to_id, content_type if payload is not None else "other", payload,
+        caption=msg.get("caption"),
+        assignment_id=msg.get("assignment_id"),
+        is_reply=msg.get("from_mentor", False),
+        timestamp=timestamp_to_ms(msg.get("timestamp")),
+    )
+
+def migrate_conversations(assignments_data):
+    """Старый словарь conversations → компактный список, отсортированный по времени"""
+    conversations = assignments_data.get("conversations")
+    if isinstance(conversations, dict):
+        migrated = []
+        for msg_id, msg in conversations.items():
+            record = migrate_conversation_record(msg) if isinstance(msg, dict) else None
+            if record is None:
+                # Непереводимые записи не теряем — откладываем как есть для ручного разбора
+                assignments_data.setdefault("conversations_invalid", {})[msg_id] = msg
+                continue
+            migrated.append(record)
+        migrated.sort(key=lambda rec: rec["ts"])
+        assignments_data["conversations"] = migrated
+        log_info(f"🔄 Переписка переведена в компактный формат: {len(migrated)} сообщений")
+        invalid = len(conversations) - len(migrated)
+        if invalid:
+            log_warning(f"⚠️ Записей переписки без отправителя или получателя: {invalid} (отложены в conversations_invalid)")
+        return True
+    if conversations is None:
+        assignments_data["conversations"] = []
+    return False
+
+def conversation_content_type(record):
+    code = record.get("k", 0)
+    return CONTENT_TYPE_CODES[code] if 0 <= code < len(CONTENT_TYPE_CODES) else "other"
+
+def conversation_preview(record):
+    """Текстовое представление записи для просмотра диалогов"""
+    content_type = conversation_content_type(record)
+    if content_type == "text":
+        return record.get("p") or ""
+    label = CONTENT_TYPE_LABELS.get(content_type, "[Сообщение]")
+    if content_type == "location" and record.get("p"):
+        label += f" {record['p'][0]}, {record['p'][1]}"
+    elif content_type == "contact" and record.get("p"):
+        label += f" {record['p'][1]} {record['p'][0]}"
+    if record.get("c"):
+        label += f" {record['c']}"
+    return label
+
+def user_display_name(users_data, user_id):
+    """Имя пользователя для отображения (имена в переписке не хранятся)"""
+    u = users_data.get(str(user_id), {})
+    return f"{u.get('name', '?')} {u.get('surname', '')}".strip()
+
+def save_conversation_message(from_id, to_id, message, assignment_id=None, is_assignment_related=False):
+    """Сохранение сообщения в историю переписки (компактная запись: ID, время, тип, file_id/текст)"""
+    assignments_data = load_assignments()
+    
+    content_type, payload, caption = message_payload(message)
+    record = make_conversation_record(
+        from_id, to_id, content_type, payload, caption,
+        assignment_id=assignment_id if is_assignment_related else None
+    )
     
-    assignments_data.setdefault("conversations", {})[message_id] = message_data
+    assignments_data.setdefault("conversations", []).append(record)
     
     # Сохраняем обновленные данные с атомарной операцией
     return save_assignments(assignments_data)
 
-def get_conversation_history(user1_id, user2_id, limit=50):
-    """Получение истории переписки между двумя пользователями"""
+def conversation_participants(record):
+    """Отправитель и получатель сообщения (строковые ID, как ключи users.json)"""
+    return str(record["f"]), str(record["t"])
+
+def conversation_pair_key(user1_id, user2_id):
+    """Ключ пары собеседников, не зависящий от порядка"""
+    return ":".join(sorted([str(user1_id), str(user2_id)]))
+
+def conversation_record_key(record):
+    """Идентичность записи (для отбрасывания дублей после прерванной архивации)"""
+    return (record["ts"], record["f"], record["t"], record["k"])
+
+def get_conversation_history(user1_id, user2_id, limit=50, offset=0):
+    """Получение истории переписки между двумя пользователями
+    
+    offset — сколько самых новых сообщений пропустить (листание назад).
+    Если в оперативном хранилище сообщений не хватает, история
+    дочитывается из архивных сегментов.
+    """
     assignments_data = load_assignments()
-    conversations = assignments_data.get("conversations", {})
+    conversations = assignments_data.get("conversations", [])
+    pair = {int(user1_id), int(user2_id)}
     
-    # Фильтруем сообщения между этими пользователями
-    history = []
-    for msg_id, msg in conversations.items():
-        if (msg["from_user_id"] == user1_id and msg["to_user_id"] == user2_id) or \
-           (msg["from_user_id"] == user2_id and msg["to_user_id"] == user1_id):
-            history.append(msg)
+    # Список уже упорядочен по времени (старые сначала)
+    history = [rec for rec in conversations if {rec["f"], rec["t"]} == pair]
     
-    # Сортируем по времени (старые сначала)
-    history.sort(key=lambda x: x.get("timestamp", ""))
+    # Не хватает сообщений — идем в архив (от новых месяцев к старым)
+    needed = offset + limit if limit > 0 else None
+    if needed is None or len(history) < needed:
+        history = read_archived_history(conversation_pair_key(user1_id, user2_id), needed, history)
     
     # Возвращаем последние N сообщений (ИСПРАВЛЕНО: увеличиваем лимит для полной истории)
-    if limit > 0 and len(history) > limit:
-        return history[-limit:]
+    end = len(history) - offset
+    if end <= 0:
+        return []
+    if limit > 0:
+        return history[max(0, end - limit):end]
+    return history[:end]
+
+def count_conversation_history(user1_id, user2_id):
+    """Общее число сообщений пары (оперативные + архивные) без распаковки архива"""
+    pair = {int(user1_id), int(user2_id)}
+    conversations = load_assignments().get("conversations", [])
+    hot_count = sum(1 for rec in conversations if {rec["f"], rec["t"]} == pair)
+    pair_key = conversation_pair_key(user1_id, user2_id)
+    segments = load_archive_index().get("segments", {})
+    return hot_count + sum(seg.get("pairs", {}).get(pair_key, 0) for seg in segments.values())
+
+# --- АРХИВ СТАРЫХ ДИАЛОГОВ ---
+CONVERSATION_PAGE_SIZE = 50
+ARCHIVE_DIR = "archive"
+ARCHIVE_INDEX_FILE = os.path.join(ARCHIVE_DIR, "index.json")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))       # Старше скольких дней переносим в архив
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "lzma")        # lzma или zlib
+ARCHIVE_CODECS = {
+    "lzma": (lzma.open, ".jsonl.xz"),
+    "zlib": (gzip.open, ".jsonl.gz"),
+}
+
+def load_archive_index():
+    """Загрузка индекса архивных сегментов"""
+    if not os.path.exists(ARCHIVE_INDEX_FILE):
+        return {"segments": {}}
+    try:
+        with open(ARCHIVE_INDEX_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        log_error(f"❌ Ошибка загрузки индекса архива: {e}")
+        return {"segments": {}}
+
+def save_archive_index(index):
+    """Атомарное сохранение индекса архива"""
+    temp_file = f"{ARCHIVE_INDEX_FILE}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, ARCHIVE_INDEX_FILE)
+
+def open_archive_segment(segment, mode="rt", file_name=None):
+    """Открыть сегмент архива тем кодеком, которым он был записан"""
+    codec = segment.get("codec", "lzma")
+    opener = ARCHIVE_CODECS.get(codec, ARCHIVE_CODECS["lzma"])[0]
+    return opener(os.path.join(ARCHIVE_DIR, file_name or segment["file"]), mode, encoding="utf-8")
+
+def iter_archive_segment(segment):
+    """Построчное чтение сегмента (в памяти одно сообщение за раз)"""
+    try:
+        with open_archive_segment(segment) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = migrate_conversation_record(json.loads(line))
+                    if record is not None:
+                        yield record
+    except FileNotFoundError:
+        log_error(f"❌ Сегмент архива не найден: {segment.get('file')}")
+
+def read_archived_history(pair_key, needed, history):
+    """Дополнить историю пары сообщениями из архива, пока не наберется needed штук"""
+    segments = load_archive_index().get("segments", {})
+    pair = {int(user_id) for user_id in pair_key.split(":")}
+    seen = {conversation_record_key(rec) for rec in history}
+    
+    for month in sorted(segments, reverse=True):
+        if needed is not None and len(history) >= needed:
+            break
+        segment = segments[month]
+        if not segment.get("pairs", {}).get(pair_key):
+            continue
+        
+        archived = []
+        for rec in iter_archive_segment(segment):
+            if {rec["f"], rec["t"]} != pair:
+                continue
+            rec_key = conversation_record_key(rec)
+            if rec_key in seen:
+                continue  # Повтор после прерванной архивации
+            archived.append(rec)
+            seen.add(rec_key)
+        archived.sort(key=lambda rec: rec["ts"])
+        history = archived + history
+    
     return history
 
+def write_archive_segments(cutoff_ms):
+    """Дописать сообщения старше cutoff_ms в помесячные сжатые сегменты; (дописано, месяцев со старыми)
+    
+    Только файлы архива — assignments.json не меняется, поэтому шаг можно выполнять в потоке.
+    """
+    codec = ARCHIVE_COMPRESSION if ARCHIVE_COMPRESSION in ARCHIVE_CODECS else "lzma"
+    
+    conversations = load_assignments().get("conversations", [])
+    
+    # Группируем старые сообщения по месяцам
+    by_month = {}
+    for rec in conversations:
+        if rec["ts"] < cutoff_ms:
+            by_month.setdefault(ms_to_datetime(rec["ts"]).strftime("%Y-%m"), []).append(rec)
+    
+    if not by_month:
+        return 0, 0
+    
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    index = load_archive_index()
+    segments = index.setdefault("segments", {})
+    
+    archived = 0
+    for month, records in sorted(by_month.items()):
+        segment = segments.get(month)
+        # Сообщения не новее last_ts уже в сегменте (прошлый запуск не успел удалить их из файла)
+        if segment is not None:
+            records = [rec for rec in records if rec["ts"] > segment.get("last_ts", -1)]
+            if not records:
+                continue
+        if segment is None:
+            segment = segments[month] = {
+                "file": f"conversations_{month}{ARCHIVE_CODECS[codec][1]}",
+                "codec": codec,
+                "count": 0,
+                "pairs": {},
+            }
+        
+        # Дописываем новый сжатый поток в конец сегмента
+        with open_archive_segment(segment, "at") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+        
+        segment["count"] += len(records)
+        segment["last_ts"] = max(segment.get("last_ts", -1), max(rec["ts"] for rec in records))
+        for rec in records:
+            pair_key = conversation_pair_key(rec["f"], rec["t"])
+            segment["pairs"][pair_key] = segment["pairs"].get(pair_key, 0) + 1
+        archived += len(records)
+    
+    save_archive_index(index)
+    return archived, len(by_month)
+
+async def archive_old_conversations(max_age_days=None):
+    """Перенос сообщений старше max_age_days в помесячные сжатые сегменты
+    
+    Сначала в потоке дописываются сегменты и индекс, потом сообщения удаляются из
+    assignments.json транзакцией на основном цикле (изменения обработчиков между шагами
+    не теряются): при сбое между шагами сообщение останется в оперативном файле, а следующий
+    запуск не допишет его в сегмент повторно (по last_ts сегмента) и только удалит.
+    """
+    if max_age_days is None:
+        max_age_days = ARCHIVE_AFTER_DAYS
+    cutoff_ms = now_ms() - max_age_days * 86400 * 1000
+    
+    loop = asyncio.get_event_loop()
+    archived_count, months = await loop.run_in_executor(None, write_archive_segments, cutoff_ms)
+    if not months:
+        return 0
+    
+    # Удаляем заархивированное из оперативного хранилища
+    def remove_archived(uow):
+        conversations = uow.assignments.get("conversations", [])
+        uow.assignments["conversations"] = [rec for rec in conversations if rec["ts"] >= cutoff_ms]
+        uow.stage("assignments")
+    
+    ok, _ = await run_transaction(remove_archived)
+    if not ok:
+        log_error("❌ Архив записан, но не удалось очистить assignments.json — повторим при следующем запуске")
+        return 0
+    
+    log_info(f"🗄 Заархивировано сообщений: {archived_count} (месяцев: {months})")
+    return archived_count
+
+def migrate_archive_segments():
+    """Перезапись архивных сегментов старого формата в компактный (однократно)"""
+    index = load_archive_index()
+    segments = index.get("segments", {})
+    if index.get("format") == "compact" or not segments:
+        return 0
+    
+    for month, segment in sorted(segments.items()):
+        temp_name = f"{segment['file']}.tmp"
+        with open_archive_segment(segment, "wt", file_name=temp_name) as out:
+            for rec in iter_archive_segment(segment):
+                out.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(os.path.join(ARCHIVE_DIR, temp_name), os.path.join(ARCHIVE_DIR, segment["file"]))
+    
+    index["format"] = "compact"
+    save_archive_index(index)
+    log_info(f"🔄 Архивные сегменты переведены в компактный формат: {len(segments)}")
+    return len(segments)
+
+def migrate_conversation_storage():
+    """Однократная миграция переписки (оперативной и архивной) в компактный формат"""
+    if os.path.exists(ASSIGNMENTS_FILE):
+        with open(ASSIGNMENTS_FILE, "r", encoding="utf-8") as f:
+            legacy = isinstance(json.load(f).get("conversations"), dict)
+        if legacy:
+            save_assignments(load_assignments())
+    migrate_archive_segments()
+
+async def archive_job():
+    """Ежедневная архивация старых диалогов (ночью, вне пиковой нагрузки)"""
+    await asyncio.sleep(60)
+    while True:
+        try:
+            await archive_old_conversations()
+        except Exception as e:
+            log_error(f"❌ Ошибка архивации диалогов: {e}")
+        
+        now = datetime.now()
+        next_run = (now + timedelta(days=1)).replace(hour=4, minute=0, second=0, microsecond=0)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+# --- ВЫГРУЗКА ДИАЛОГА В ФАЙЛ ---
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "html")  # html или txt
+
+def iter_pair_records(user1_id, user2_id):
+    """Все сообщения пары по порядку: архивные месяцы, затем оперативное хранилище
+    
+    Записи отдаются по одной, целиком история в память не загружается.
+    """
+    pair = {int(user1_id), int(user2_id)}
+    pair_key = conversation_pair_key(user1_id, user2_id)
+    last_archived_ts = 0
+    
+    segments = load_archive_index().get("segments", {})
+    for month in sorted(segments):
+        segment = segments[month]
+        if not segment.get("pairs", {}).get(pair_key):
+            continue
+        for rec in iter_archive_segment(segment):
+            if {rec["f"], rec["t"]} != pair:
+                continue
+            if rec["ts"] < last_archived_ts:
+                continue  # Повтор после прерванной архивации
+            last_archived_ts = rec["ts"]
+            yield rec
+    
+    for rec in load_assignments().get("conversations", []):
+        if {rec["f"], rec["t"]} == pair and rec["ts"] > last_archived_ts:
+            yield rec
+
+def iter_conversation_export(user1_id, user2_id, users_data, fmt="html"):
+    """Генератор кусков файла выгрузки (HTML или простой текст)"""
+    user1_id, user2_id = str(user1_id), str(user2_id)
+    names = {user_id: user_display_name(users_data, user_id) for user_id in (user1_id, user2_id)}
+    
+    # Кто наставник в этой паре (если это пара наставник-ученик)
+    mentor_id = None
+    if users_data.get(user1_id, {}).get("mentor") == user2_id:
+        mentor_id = user2_id
+    elif users_data.get(user2_id, {}).get("mentor") == user1_id:
+        mentor_id = user1_id
+    
+    def sender_label(sender_id):
+        if mentor_id is None:
+            return f"👤 {names.get(sender_id, sender_id)}"
+        if sender_id == mentor_id:
+            return f"👤 НАСТАВНИК {names.get(sender_id, sender_id)}"
+        return f"👨‍🎓 УЧЕНИК {names.get(sender_id, sender_id)}"
+    
+    title = f"Диалог: {names[user1_id]} ↔ {names[user2_id]}"
+    exported_at = format_ms(now_ms())
+    
+    if fmt == "html":
+        yield ("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+               f"<title>{html.escape(title)}</title>"
+               "<style>body{font-family:sans-serif;max-width:800px;margin:auto}"
+               ".m{margin:8px 0;padding:6px 10px;border-radius:6px;background:#f1f1f1}"
+               ".r{background:#e3f0ff}.h{color:#555;font-size:0.85em}"
+               ".t{white-space:pre-wrap}</style></head><body>\n"
+               f"<h2>💬 {html.escape(title)}</h2><p class=\"h\">Выгружено: {exported_at}</p>\n")
+    else:
+        yield f"💬 {title}\nВыгружено: {exported_at}\n\n"
+    
+    count = 0
+    for rec in iter_pair_records(user1_id, user2_id):
+        count += 1
+        sender_id = conversation_participants(rec)[0]
+        header = f"{sender_label(sender_id)} ({format_ms(rec['ts'])})"
+        if fmt == "html":
+            css = "m r" if mentor_id is not None and sender_id == mentor_id else "m"
+            yield (f"<div class=\"{css}\"><div class=\"h\">{html.escape(header)}</div>"
+                   f"<div class=\"t\">{html.escape(conversation_preview(rec))}</div></div>\n")
+        else:
+            yield f"{header}:\n{conversation_preview(rec)}\n\n"
+    
+    if fmt == "html":
+        yield f"<p class=\"h\">Всего сообщений: {count}</p>\n</body></html>\n"
+    else:
+        yield f"Всего сообщений: {count}\n"
+
+def write_conversation_export(user1_id, user2_id, users_data, fmt="html"):
+    """Потоковая запись выгрузки во временный файл, возвращает путь к нему"""
+    fd, path = tempfile.mkstemp(prefix="dialog_", suffix=f".{fmt}")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        for chunk in iter_conversation_export(user1_id, user2_id, users_data, fmt):
+            f.write(chunk)
+    return path
+
+async def send_conversation_export(chat_id, user1_id, user2_id, users_data=None):
+    """Выгрузка всей переписки пары одним документом"""
+    if users_data is None:
+        users_data = load_users()["users"]
+    fmt = EXPORT_FORMAT if EXPORT_FORMAT in ("html", "txt") else "html"
+    
+    # Чтение архива и запись файла — в пуле потоков, чтобы не блокировать бота
+    loop = asyncio.get_event_loop()
+    path = await loop.run_in_executor(None, write_conversation_export, user1_id, user2_id, users_data, fmt)
+    try:
+        file_name = f"dialog_{user1_id}_{user2_id}_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+        caption = f"💬 Диалог: {user_display_name(users_data, user1_id)} ↔ {user_display_name(users_data, user2_id)}"
+        await bot.send_document(chat_id, types.InputFile(path, filename=file_name), caption=caption)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# --- ПОИСКОВЫЙ ИНДЕКС ПОЛЬЗОВАТЕЛЕЙ ---
+SEARCH_PAGE_SIZE = 8
+SEARCH_MAX_RESULTS = 200
+SEARCH_MIN_SIMILARITY = 0.3  # Минимальная доля общих триграмм для нечеткого совпадения
+
+# Латинские буквы, которые выглядят как кириллические, приводим к кириллице
+SEARCH_LOOKALIKES = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+    "o": "о", "p": "р", "t": "т", "x": "х", "y": "у", "ё": "е",
+})
+
+# Транслитерация для запросов, набранных целиком латиницей (olga → ольга)
+SEARCH_TRANSLIT = [
+    ("shch", "щ"), ("sch", "щ"), ("yo", "е"), ("zh", "ж"), ("kh", "х"), ("ts", "ц"), ("ch", "ч"),
+    ("sh", "ш"), ("yu", "ю"), ("ya", "я"), ("ju", "ю"), ("ja", "я"),
+    ("a", "а"), ("b", "б"), ("c", "к"), ("d", "д"), ("e", "е"), ("f", "ф"), ("g", "г"),
+    ("h", "х"), ("i", "и"), ("j", "й"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"),
+    ("o", "о"), ("p", "п"), ("q", "к"), ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"),
+    ("v", "в"), ("w", "в"), ("x", "кс"), ("y", "ы"), ("z", "з"),
+]
+SEARCH_TRANSLIT_RE = re.compile("|".join(latin for latin, _ in SEARCH_TRANSLIT))
+SEARCH_TRANSLIT_MAP = dict(SEARCH_TRANSLIT)
+
+def normalize_search_token(token):
+    """Латинское слово (можно с цифрами: olga12) транслитерируем, смешанное — чиним по похожим буквам"""
+    if re.fullmatch(r"[a-z0-9]+", token):
+        return SEARCH_TRANSLIT_RE.sub(lambda m: SEARCH_TRANSLIT_MAP[m.group(0)], token)
+    return token.translate(SEARCH_LOOKALIKES)
+
+def normalize_search_text(text):
+    """Нормализация текста для поиска: регистр, ё→е, латиница → кириллица"""
+    text = str(text or "").lower().replace("ё", "е")
+    return [normalize_search_token(token) for token in re.split(r"[^\w]+", text) if token]
+
+def search_trigrams(token):
+    """Триграммы слова с границами (чтобы начало слова весило больше); ID ищутся только по префиксу"""
+    if token.isdigit():
+        return set()
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class UserSearchIndex:
+    """Индекс пользователей по имени, фамилии и chat_id (префиксы + триграммы)"""
+    def __init__(self):
+        self.built = False
+        self.docs = {}             # uid -> ((имя, фамилия, chat_id, уровень), токены)
+        self.token_users = {}      # токен -> множество uid
+        self.sorted_tokens = []    # отсортированные токены для поиска по префиксу
+        self.trigram_tokens = {}   # триграмма -> множество токенов
+
+    def _add_token(self, token, uid):
+        users = self.token_users.get(token)
+        if users is None:
+            users = self.token_users[token] = set()
+            bisect.insort(self.sorted_tokens, token)
+            for gram in search_trigrams(token):
+                self.trigram_tokens.setdefault(gram, set()).add(token)
+        users.add(uid)
+
+    def _remove_token(self, token, uid):
+        users = self.token_users.get(token)
+        if users is None:
+            return
+        users.discard(uid)
+        if users:
+            return
+        del self.token_users[token]
+        pos = bisect.bisect_left(self.sorted_tokens, token)
+        if pos < len(self.sorted_tokens) and self.sorted_tokens[pos] == token:
+            del self.sorted_tokens[pos]
+        for gram in search_trigrams(token):
+            grams = self.trigram_tokens.get(gram)
+            if grams is not None:
+                grams.discard(token)
+                if not grams:
+                    del self.trigram_tokens[gram]
+
+    @staticmethod
+    def _signature(user):
+        return (user.get("name"), user.get("surname"), user.get("chat_id"), user.get("level"))
+
+    def update_user(self, uid, user):
+        """Добавить или переиндексировать пользователя"""
+        signature = self._signature(user)
+        old = self.docs.get(uid)
+        if old and old[0] == signature:
+            return
+        if old and old[0][:3] == signature[:3]:
+            self.docs[uid] = (signature, old[1])  # Изменился только уровень — токены те же
+            return
+        if old:
+            self.remove_user(uid)
+        tokens = set(normalize_search_text(f"{user.get('name', '')} {user.get('surname', '')}"))
+        tokens.add(str(uid))
+        for token in tokens:
+            self._add_token(token, uid)
+        self.docs[uid] = (signature, tokens)
+
+    def remove_user(self, uid):
+        old = self.docs.pop(uid, None)
+        if old:
+            for token in old[1]:
+                self._remove_token(token, uid)
+
+    def profile(self, uid):
+        """(имя, фамилия, уровень) проиндексированного пользователя без чтения users.json"""
+        doc = self.docs.get(uid)
+        if doc is None:
+            return None
+        name, surname, _, level = doc[0]
+        return name, surname, level
+
+    def reset(self):
+        """Сбросить индекс: он перестроится при следующем обращении"""
+        self.__init__()
+
+    def sync(self, users):
+        """Привести индекс в соответствие с текущими данными (переиндексируются только изменения)"""
+        if not self.built:
+            self._build(users)
+            return
+        for uid in [uid for uid in self.docs if uid not in users]:
+            self.remove_user(uid)
+        for uid, user in users.items():
+            if isinstance(user, dict):
+                self.update_user(uid, user)
+
+    def _build(self, users):
+        """Первичное построение: сортируем словарь токенов один раз"""
+        for uid, user in users.items():
+            if not isinstance(user, dict):
+                continue
+            tokens = set(normalize_search_text(f"{user.get('name', '')} {user.get('surname', '')}"))
+            tokens.add(str(uid))
+            for token in tokens:
+                self.token_users.setdefault(token, set()).add(uid)
+            self.docs[uid] = (self._signature(user), tokens)
+        self.sorted_tokens = sorted(self.token_users)
+        for token in self.sorted_tokens:
+            for gram in search_trigrams(token):
+                self.trigram_tokens.setdefault(gram, set()).add(token)
+        self.built = True
+
+    def _match_token(self, query_token):
+        """Оценки пользователей для одного слова запроса: точное > префикс > триграммы"""
+        scores = {}
+
+        def bump(uids, score):
+            for uid in uids:
+                if scores.get(uid, 0) < score:
+                    scores[uid] = score
+
+        # Префиксное совпадение (включает точное)
+        pos = bisect.bisect_left(self.sorted_tokens, query_token)
+        while pos < len(self.sorted_tokens) and self.sorted_tokens[pos].startswith(query_token):
+            token = self.sorted_tokens[pos]
+            bump(self.token_users[token], 3.0 if token == query_token else 2.0)
+            pos += 1
+
+        # Нечеткое совпадение по триграммам (опечатки)
+        query_grams = search_trigrams(query_token) if len(query_token) >= 3 else set()
+        if query_grams:
+            shared = {}
+            for gram in query_grams:
+                for token in self.trigram_tokens.get(gram, ()):
+                    shared[token] = shared.get(token, 0) + 1
+            for token, count in shared.items():
+                similarity = count / (len(query_grams) + len(token) + 1 - count)
+                if similarity >= SEARCH_MIN_SIMILARITY:
+                    bump(self.token_users[token], similarity)
+        return scores
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        """Поиск пользователей: все слова запроса должны совпасть (точно, по префиксу или нечетко)"""
+        query_tokens = normalize_search_text(query)
+        if not query_tokens:
+            return []
+
+        total = None
+        for query_token in query_tokens:
+            scores = self._match_token(query_token)
+            if total is None:
+                total = scores
+            else:
+                total = {uid: total[uid] + score for uid, score in scores.items() if uid in total}
+            if not total:
+                return []
+
+        ranked = heapq.nsmallest(limit, total.items(), key=lambda item: (-item[1], str(self.docs[item[0]][0][:2])))
+        return [uid for uid, _ in ranked]
+
+user_search_index = UserSearchIndex()
+
+def search_users(query, users=None):
+    """Поиск по индексу (индекс строится при первом обращении, дальше обновляется при изменениях)"""
+    if not user_search_index.built:
+        user_search_index.sync(users if users is not None else load_users()["users"])
+    return user_search_index.search(query)
+
+def reindex_users(users, uids=None):
+    """Обновить индексы пользователей после изменения: uids — кого меняли, None — неизвестно кого
+    
+    Вызывается там, где пользователи сохраняются, поэтому запросам не нужно сверять индекс со всем файлом.
+    """
+    indexes = [index for index in (user_search_index, audience_index) if index.built]
+    if uids is None:
+        for index in indexes:
+            index.reset()
+        return
+    for uid in uids:
+        user = users.get(str(uid)) if users is not None else None
+        for index in indexes:
+            if isinstance(user, dict):
+                index.update_user(str(uid), user)
+            else:
+                index.remove_user(str(uid))
+
+# --- АУДИТОРИЯ РАССЫЛОК ---
+# Запрос аудитории — словарь: levels (список), activity (["active"|"inactive", дней]),
+# mentor (ID — вся ветка наставника), has_mentor (True/False), include_unreachable.
+# Индекс хранит множества пользователей как битовые маски (int): условия
+# объединяются через & и |, подсчет и выборка не перебирают users.json.
+class AudienceIndex:
+    def __init__(self):
+        self.built = False
+        self.slots = {}          # uid -> номер бита
+        self.uids = []           # номер бита -> uid
+        self.free_slots = []
+        self.docs = {}           # uid -> сигнатура проиндексированных полей
+        self.all_bits = 0
+        self.level_bits = {}
+        self.mentor_bits = 0     # У кого есть наставник
+        self.unreachable = {}    # бит -> время последней попытки доставки
+        self.children = {}       # наставник -> множество учеников
+        self.mentor_of = {}
+        self.seen = []           # отсортированный список (последняя активность, бит)
+        self.seen_by_slot = {}
+    
+    @staticmethod
+    def _signature(user):
+        last_seen = max(user.get("last_activity") or 0, user.get("active_today") or 0)
+        return (user.get("level"), user.get("mentor"), last_seen,
+                user.get("unreachable"), user.get("unreachable_probe"))
+    
+    def update_user(self, uid, user):
+        signature = self._signature(user)
+        if self.docs.get(uid) == signature:
+            return
+        if uid in self.docs:
+            self.remove_user(uid)
+        
+        slot = self.free_slots.pop() if self.free_slots else len(self.uids)
+        if slot == len(self.uids):
+            self.uids.append(uid)
+        else:
+            self.uids[slot] = uid
+        self.slots[uid] = slot
+        self.docs[uid] = signature
+        
+        level, mentor, last_seen, unreachable, probe = signature
+        bit = 1 << slot
+        self.all_bits |= bit
+        self.level_bits[level] = self.level_bits.get(level, 0) | bit
+        if mentor:
+            self.mentor_bits |= bit
+            self.children.setdefault(mentor, set()).add(uid)
+            self.mentor_of[uid] = mentor
+        if unreachable:
+            self.unreachable[slot] = probe or 0
+        bisect.insort(self.seen, (last_seen, slot))
+        self.seen_by_slot[slot] = last_seen
+    
+    def remove_user(self, uid):
+        signature = self.docs.pop(uid, None)
+        if signature is None:
+            return
+        slot = self.slots.pop(uid)
+        bit = 1 << slot
+        self.all_bits &= ~bit
+        self.level_bits[signature[0]] &= ~bit
+        self.mentor_bits &= ~bit
+        mentor = self.mentor_of.pop(uid, None)
+        if mentor:
+            self.children[mentor].discard(uid)
+        self.unreachable.pop(slot, None)
+        last_seen = self.seen_by_slot.pop(slot)
+        del self.seen[bisect.bisect_left(self.seen, (last_seen, slot))]
+        self.uids[slot] = None
+        self.free_slots.append(slot)
+    
+    def sync(self, users):
+        """Переиндексировать только изменившихся пользователей"""
+        for uid in [uid for uid in self.docs if uid not in users]:
+            self.remove_user(uid)
+        for uid, user in users.items():
+            if isinstance(user, dict):
+                self.update_user(uid, user)
+        self.built = True
+    
+    def reset(self):
+        """Сбросить индекс: он перестроится при следующем обращении"""
+        self.__init__()
+    
+    def bits_of(self, uids):
+        bits = 0
+        for uid in uids:
+            if uid in self.slots:
+                bits |= 1 << self.slots[uid]
+        return bits
+    
+    def active_bits(self, since_ms):
+        """Пользователи с активностью не раньше since_ms"""
+        bits = 0
+        for _, slot in self.seen[bisect.bisect_left(self.seen, (since_ms, -1)):]:
+            bits |= 1 << slot
+        return bits
+    
+    def branch_bits(self, mentor_id):
+        """Вся ветка наставника (ученики, их ученики и т.д.)"""
+        branch, stack = set(), [str(mentor_id)]
+        while stack:
+            for student_id in self.children.get(stack.pop(), ()):
+                if student_id not in branch:
+                    branch.add(student_id)
+                    stack.append(student_id)
+        return self.bits_of(branch)
+    
+    def unreachable_bits(self, now=None):
+        """Недоступные, которым еще рано перепроверять доставку (см. is_reachable)"""
+        now = now or now_ms()
+        reprobe_ms = UNREACHABLE_REPROBE_DAYS * 86400 * 1000
+        bits = 0
+        for slot, probe in self.unreachable.items():
+            if now - probe < reprobe_ms:
+                bits |= 1 << slot
+        return bits
+    
+    def evaluate(self, query, now=None, exclude_unreachable=True):
+        """Битовая маска пользователей, подходящих под запрос"""
+        now = now or now_ms()
+        bits = self.all_bits
+        
+        levels = query.get("levels")
+        if levels:
+            level_mask = 0
+            for level in levels:
+                level_mask |= self.level_bits.get(level, 0)
+            bits &= level_mask
+        
+        activity = query.get("activity")
+        if activity:
+            kind, days = activity
+            active = self.active_bits(now - days * 86400 * 1000)
+            bits &= active if kind == "active" else ~active
+        
+        if query.get("mentor"):
+            bits &= self.branch_bits(query["mentor"])
+        
+        if query.get("has_mentor") is True:
+            bits &= self.mentor_bits
+        elif query.get("has_mentor") is False:
+            bits &= ~self.mentor_bits
+        
+        if exclude_unreachable and not query.get("include_unreachable"):
+            bits &= ~self.unreachable_bits(now)
+        return bits
+    
+    @staticmethod
+    def count(bits):
+        return bin(bits).count("1")
+    
+    def decode(self, bits):
+        """Маска → список uid"""
+        result = []
+        raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        for byte_index, byte in enumerate(raw):
+            if byte:
+                base = byte_index * 8
+                for offset in range(8):
+                    if byte >> offset & 1:
+                        result.append(self.uids[base + offset])
+        return result
+
+audience_index = AudienceIndex()
+
+def ensure_audience_index(users=None):
+    """Построить индекс при первом обращении (дальше его обновляет reindex_users)"""
+    if not audience_index.built:
+        audience_index.sync(users if users is not None else load_users()["users"])
+
+def select_audience(query, users=None):
+    """(получатели, сколько исключено как недоступные) для запроса аудитории"""
+    ensure_audience_index(users)
+    now = now_ms()
+    bits = audience_index.evaluate(query, now)
+    skipped = audience_index.count(audience_index.evaluate(query, now, exclude_unreachable=False) & ~bits)
+    return audience_index.decode(bits), skipped
+
+def count_audience(query, users=None):
+    """Только число получателей (предпросмотр без выборки списка)"""
+    ensure_audience_index(users)
+    return audience_index.count(audience_index.evaluate(query))
+
 # --- МЕНЮ КОМАНД ---
 async def set_bot_commands():
     commands = [
@@ -493,6 +2557,8 @@ async def set_bot_commands():
         types.BotCommand("admin", "👑 Админ-панель"),
         types.BotCommand("stats", "📊 Статистика"),
         types.BotCommand("broadcast", "📢 Рассылка"),
+        types.BotCommand("scheduled", "🕒 Запланированные рассылки"),
+        types.BotCommand("mentor_stats", "⏱ Нагрузка наставников"),
         types.BotCommand("check_data", "🔧 Проверить данные"),
         types.BotCommand("fix_data", "🛠 Исправить данные"),
         types.BotCommand("register_superadmin", "👑 Зарегистрировать суперадмина"),
@@ -521,6 +2587,11 @@ class Form(StatesGroup):
     admin_choose_levels = State()
     change_level = State()            # Для смены уровня
     change_mentor = State()           # Для смены наставника
+    search_query = State()            # Поиск пользователя (админ)
+    audience = State()                # Конструктор аудитории рассылки
+    audience_mentor = State()         # Ввод наставника для рассылки по ветке
+    schedule_time = State()           # Ввод времени отложенной рассылки
+    assignment_deadline = State()     # Ввод срока сдачи задания
 
 # НОВЫЕ СОСТОЯНИЯ ДЛЯ ЗАДАНИЙ
 class AssignmentStates(StatesGroup):
@@ -552,6 +2623,7 @@ async def admin_main_menu(user_id):
         kb.add(InlineKeyboardButton("👤 Зарегистрироваться", callback_data="register_as_admin"))
     
     kb.add(InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast"))
+    kb.add(InlineKeyboardButton("⏱ Нагрузка наставников", callback_data="mentor_metrics"))
     
     if user_id == YOUR_ADMIN_ID:
         kb.add(InlineKeyboardButton("🌐 Все пользователи", callback_data="all_users"))
@@ -619,25 +2691,28 @@ async def admin_stats(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
+    today_ms = day_start_ms()
     
     total = len(users)
-    new_today = sum(1 for u in users.values() if u.get("registration_date") == today_str)
-    active_today = sum(1 for u in users.values() if u.get("active_today") == today_str)
+    new_today = sum(1 for u in users.values() if (u.get("registration_date") or 0) >= today_ms)
+    active_today = sum(1 for u in users.values() if (u.get("active_today") or 0) >= today_ms)
     with_mentor = sum(1 for u in users.values() if u.get("mentor"))
     without_mentor = total - with_mentor
+    reachable, unreachable = reachability_counts(users)
     
     text = f"📊 <b>Статистика бота</b>\n\n"
     text += f"• Всего пользователей: {total}\n"
     text += f"• Новых сегодня: {new_today}\n"
     text += f"• Активных сегодня: {active_today}\n"
     text += f"• С наставником: {with_mentor}\n"
-    text += f"• Без наставника: {without_mentor}\n\n"
+    text += f"• Без наставника: {without_mentor}\n"
+    text += f"• Доступны для рассылок: {reachable}\n"
+    text += f"• Недоступны (заблокировали бота): {unreachable}\n\n"
     
     text += "<b>По уровням:</b>\n"
     for level in LEVELS_ORDER:
         level_users = [u for u in users.values() if u.get("level") == level]
-        level_active = sum(1 for u in level_users if u.get("active_today") == today_str)
+        level_active = sum(1 for u in level_users if (u.get("active_today") or 0) >= today_ms)
         text += f"• {level}: {len(level_users)} чел. (активных: {level_active})\n"
     
     await callback.message.answer(text)
@@ -650,19 +2725,19 @@ async def admin_activity(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
+    today_ms = day_start_ms()
     
     active_users = []
     inactive_users = []
     
     for uid, u in users.items():
         full_name = f"{u['name']} {u.get('surname','')}".strip()
-        if u.get("active_today") == today_str:
+        if (u.get("active_today") or 0) >= today_ms:
             active_users.append(full_name)
         else:
             inactive_users.append(full_name)
     
-    text = f"📈 <b>Активность пользователей ({today_str})</b>\n\n"
+    text = f"📈 <b>Активность пользователей ({date.today():%d.%m.%Y})</b>\n\n"
     text += f"<b>✅ Активны ({len(active_users)}):</b>\n"
     text += ", ".join(active_users) if active_users else "—"
     text += f"\n\n<b>❌ Не активны ({len(inactive_users)}):</b>\n"
@@ -679,11 +2754,11 @@ async def admin_new_today(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
+    today_ms = day_start_ms()
     
     new_users = []
     for uid, u in users.items():
-        if u.get("registration_date") == today_str:
+        if (u.get("registration_date") or 0) >= today_ms:
             full_name = f"{u['name']} {u.get('surname','')}".strip()
             mentor_info = ""
             if u.get("mentor") and u["mentor"] in users:
@@ -693,7 +2768,7 @@ async def admin_new_today(callback: types.CallbackQuery):
                     mentor_info = f" → {mentor_name}"
             new_users.append(f"{full_name}{mentor_info}")
     
-    text = f"🆕 <b>Новые пользователи сегодня ({today_str})</b>\n\n"
+    text = f"🆕 <b>Новые пользователи сегодня ({date.today():%d.%m.%Y})</b>\n\n"
     if new_users:
         for i, user_info in enumerate(new_users, 1):
             text += f"{i}. {user_info}\n"
@@ -710,28 +2785,109 @@ async def admin_search(callback: types.CallbackQuery):
         return
     
     await callback.message.answer("🔍 <b>Поиск пользователя</b>\n\nВведите имя, фамилию или ID пользователя:")
-    await callback.answer("Функция в разработке", show_alert=True)
+    await Form.search_query.set()
 
-# --- НОВЫЙ ОБРАБОТЧИК: ПРОСМОТР ВСЕХ ДИАЛОГОВ (для суперадмина) ---
-@dp.callback_query_handler(lambda c: c.data == "admin_view_conversations")
-async def admin_view_conversations_handler(callback: types.CallbackQuery):
-    """Просмотр всех диалогов в системе"""
-    user_id = callback.from_user.id
+def build_search_page(query, results, page):
+    """Страница результатов поиска с кнопками профилей (имена и уровни — из индекса)"""
+    pages = max(1, (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    start = page * SEARCH_PAGE_SIZE
     
-    if user_id not in [OLGA_ID, YOUR_ADMIN_ID]:
-        await callback.answer("Доступ только для администраторов", show_alert=True)
-        return
+    text = f"🔍 <b>Результаты поиска:</b> {html.escape(query)}\n\n"
+    text += f"Найдено: {len(results)}"
+    if len(results) >= SEARCH_MAX_RESULTS:
+        text += "+ (уточните запрос)"
+    text += f" | Страница {page + 1}/{pages}"
     
-    # Показываем сообщение о загрузке
-    await callback.answer("🔄 Загружаю диалоги...", show_alert=False)
+    kb = InlineKeyboardMarkup(row_width=2)
+    for uid in results[start:start + SEARCH_PAGE_SIZE]:
+        profile = user_search_index.profile(uid)
+        if not profile:
+            continue
+        name, surname, level = profile
+        full_name = f"{name} {surname or ''}".strip()
+        kb.add(InlineKeyboardButton(
+            f"👤 {full_name} — {level or '—'} ({uid})"[:64],
+            callback_data=f"student_profile:{uid}:SEARCH"
+        ))
     
-    # Загружаем данные
-    assignments_data = load_assignments()
-    users_data = load_users()["users"]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅", callback_data=f"search_page:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("➡", callback_data=f"search_page:{page + 1}"))
+    if nav:
+        kb.row(*nav)
+    kb.add(InlineKeyboardButton("🔍 Новый поиск", callback_data="admin_search"))
+    kb.add(InlineKeyboardButton("⬅ Назад", callback_data="admin_panel"))
+    return text, kb
+
+@dp.message_handler(state=Form.search_query)
+async def admin_search_query(message: types.Message, state):
+    """Админ ввел поисковый запрос"""
+    if message.from_user.id != YOUR_ADMIN_ID:
+        await state.finish()
+        return
     
-    conversations = assignments_data.get("conversations", {})
+    query = (message.text or "").strip()[:100]
+    results = search_users(query)
     
-    if not conversations:
+    # Запрос храним в данных состояния, чтобы листать страницы и возвращаться из профиля
+    await state.finish()
+    await state.update_data(search_query=query, search_page=0)
+    
+    if not results:
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("🔍 Новый поиск", callback_data="admin_search"))
+        await message.answer(f"🔍 По запросу <b>{html.escape(query)}</b> ничего не найдено.", reply_markup=kb)
+        return
+    
+    text, kb = build_search_page(query, results, 0)
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("search_page:"))
+async def admin_search_page(callback: types.CallbackQuery, state):
+    """Листание результатов поиска"""
+    if callback.from_user.id != YOUR_ADMIN_ID:
+        await callback.answer("Доступ только для суперадмина", show_alert=True)
+        return
+    
+    data = await state.get_data()
+    query = data.get("search_query")
+    if not query:
+        await callback.answer("Поиск устарел, выполните его заново", show_alert=True)
+        return
+    
+    page = int(callback.data.split(":")[1])
+    results = search_users(query)
+    await state.update_data(search_page=page)
+    
+    text, kb = build_search_page(query, results, page)
+    if callback.message.text and callback.message.text.startswith("🔍 Результаты поиска"):
+        await callback.message.edit_text(text, reply_markup=kb)
+    else:
+        await callback.message.answer(text, reply_markup=kb)
+
+# --- НОВЫЙ ОБРАБОТЧИК: ПРОСМОТР ВСЕХ ДИАЛОГОВ (для суперадмина) ---
+@dp.callback_query_handler(lambda c: c.data == "admin_view_conversations")
+async def admin_view_conversations_handler(callback: types.CallbackQuery):
+    """Просмотр всех диалогов в системе"""
+    user_id = callback.from_user.id
+    
+    if user_id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        await callback.answer("Доступ только для администраторов", show_alert=True)
+        return
+    
+    # Показываем сообщение о загрузке
+    await callback.answer("🔄 Загружаю диалоги...", show_alert=False)
+    
+    # Загружаем данные
+    assignments_data = load_assignments()
+    users_data = load_users()["users"]
+    
+    conversations = assignments_data.get("conversations", [])
+    
+    if not conversations:
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("🔄 Обновить", callback_data="admin_view_conversations"))
         kb.add(InlineKeyboardButton("⬅ Назад", callback_data="back_to_admin_main"))
@@ -758,9 +2914,8 @@ async def superadmin_view_all_conversations(callback: types.CallbackQuery, conve
     # Группируем диалоги по парам пользователей
     conversation_pairs = {}
     
-    for msg_id, msg in conversations.items():
-        from_id = msg["from_user_id"]
-        to_id = msg["to_user_id"]
+    for msg in conversations:
+        from_id, to_id = conversation_participants(msg)
         pair_key = tuple(sorted([from_id, to_id]))
         
         if pair_key not in conversation_pairs:
@@ -781,16 +2936,17 @@ async def superadmin_view_all_conversations(callback: types.CallbackQuery, conve
                 "user2_id": to_id,
                 "user2_name": to_name,
                 "is_mentor_student": is_mentor_student,
-                "last_message": msg.get("timestamp", ""),
+                "last_message": 0,
                 "message_count": 0
             }
         
         conversation_pairs[pair_key]["message_count"] += 1
+        conversation_pairs[pair_key]["last_message"] = msg["ts"]  # Список упорядочен по времени
     
     # Сортируем по последнему сообщению (новые сначала)
     sorted_pairs = sorted(
         conversation_pairs.values(), 
-        key=lambda x: x.get("last_message", ""), 
+        key=lambda x: x["last_message"], 
         reverse=True
     )
     
@@ -800,15 +2956,7 @@ async def superadmin_view_all_conversations(callback: types.CallbackQuery, conve
     
     # Показываем первые 15 диалогов
     for i, pair in enumerate(sorted_pairs[:15], 1):
-        timestamp = pair.get("last_message", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                time_str = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                time_str = timestamp[:16]
-        else:
-            time_str = "??"
+        time_str = format_ms(pair["last_message"], "%d.%m.%Y %H:%M")
         
         # Добавляем метку для диалогов наставник-ученик
         mentor_tag = "👨‍🏫→👨‍🎓 " if pair["is_mentor_student"] else ""
@@ -851,9 +2999,8 @@ async def admin_view_mentor_conversations(callback: types.CallbackQuery, convers
     # Группируем диалоги по парам наставник-ученик
     conversation_pairs = {}
     
-    for msg_id, msg in conversations.items():
-        from_id = msg["from_user_id"]
-        to_id = msg["to_user_id"]
+    for msg in conversations:
+        from_id, to_id = conversation_participants(msg)
         
         # Определяем, кто наставник, а кто ученик
         from_user = users_data.get(from_id, {})
@@ -887,11 +3034,12 @@ async def admin_view_mentor_conversations(callback: types.CallbackQuery, convers
                 "mentor_name": mentor_name,
                 "student_id": student_id,
                 "student_name": student_name,
-                "last_message": msg.get("timestamp", ""),
+                "last_message": 0,
                 "message_count": 0
             }
         
         conversation_pairs[pair_key]["message_count"] += 1
+        conversation_pairs[pair_key]["last_message"] = msg["ts"]  # Список упорядочен по времени
     
     if not conversation_pairs:
         kb = InlineKeyboardMarkup()
@@ -910,7 +3058,7 @@ async def admin_view_mentor_conversations(callback: types.CallbackQuery, convers
     # Сортируем по последнему сообщению (новые сначала)
     sorted_pairs = sorted(
         conversation_pairs.values(), 
-        key=lambda x: x.get("last_message", ""), 
+        key=lambda x: x["last_message"], 
         reverse=True
     )
     
@@ -920,15 +3068,7 @@ async def admin_view_mentor_conversations(callback: types.CallbackQuery, convers
     
     # Показываем первые 10 диалогов
     for i, pair in enumerate(sorted_pairs[:10], 1):
-        timestamp = pair.get("last_message", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                time_str = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                time_str = timestamp[:16]
-        else:
-            time_str = "??"
+        time_str = format_ms(pair["last_message"], "%d.%m.%Y %H:%M")
         
         text += f"{i}. 👤 <b>{pair['mentor_name']}</b> → 👨‍🎓 <b>{pair['student_name']}</b>\n"
         text += f"   📝 Сообщений: {pair['message_count']}\n"
@@ -965,7 +3105,7 @@ async def admin_view_mentor_conversations_only_handler(callback: types.CallbackQ
     assignments_data = load_assignments()
     users_data = load_users()["users"]
     
-    conversations = assignments_data.get("conversations", {})
+    conversations = assignments_data.get("conversations", [])
     
     if not conversations:
         await callback.message.answer("💬 Нет сохраненных диалогов")
@@ -974,9 +3114,8 @@ async def admin_view_mentor_conversations_only_handler(callback: types.CallbackQ
     # Группируем диалоги по парам наставник-ученик
     conversation_pairs = {}
     
-    for msg_id, msg in conversations.items():
-        from_id = msg["from_user_id"]
-        to_id = msg["to_user_id"]
+    for msg in conversations:
+        from_id, to_id = conversation_participants(msg)
         
         # Определяем, кто наставник, а кто ученик
         from_user = users_data.get(from_id, {})
@@ -1010,11 +3149,12 @@ async def admin_view_mentor_conversations_only_handler(callback: types.CallbackQ
                 "mentor_name": mentor_name,
                 "student_id": student_id,
                 "student_name": student_name,
-                "last_message": msg.get("timestamp", ""),
+                "last_message": 0,
                 "message_count": 0
             }
         
         conversation_pairs[pair_key]["message_count"] += 1
+        conversation_pairs[pair_key]["last_message"] = msg["ts"]  # Список упорядочен по времени
     
     if not conversation_pairs:
         await callback.message.answer(
@@ -1024,21 +3164,13 @@ async def admin_view_mentor_conversations_only_handler(callback: types.CallbackQ
         return
     
     # Сортируем по последнему сообщению
-    sorted_pairs = sorted(conversation_pairs.values(), key=lambda x: x.get("last_message", ""), reverse=True)
+    sorted_pairs = sorted(conversation_pairs.values(), key=lambda x: x["last_message"], reverse=True)
     
     text = f"👨‍🏫 <b>Диалоги наставников с учениками</b>\n\n"
     text += f"Всего диалогов: {len(sorted_pairs)}\n\n"
     
     for i, pair in enumerate(sorted_pairs[:15], 1):
-        timestamp = pair.get("last_message", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                time_str = dt.strftime("%d.%m %H:%M")
-            except:
-                time_str = timestamp[:16]
-        else:
-            time_str = "??"
+        time_str = format_ms(pair["last_message"], "%d.%m %H:%M")
         
         text += f"{i}. 👤 <b>{pair['mentor_name']}</b> → 👨‍🎓 <b>{pair['student_name']}</b>\n"
         text += f"   📝 {pair['message_count']} сообщ. | ⏰ {time_str}\n\n"
@@ -1071,9 +3203,11 @@ async def superadmin_view_conversation_handler(callback: types.CallbackQuery):
     parts = callback.data.split(":")
     user1_id = parts[1]
     user2_id = parts[2]
+    page = int(parts[3]) if len(parts) > 3 else 0
     
-    # Получаем историю переписки
-    history = get_conversation_history(user1_id, user2_id, limit=50)
+    # Получаем историю переписки (страница 0 — самые новые сообщения)
+    history = get_conversation_history(user1_id, user2_id, limit=CONVERSATION_PAGE_SIZE,
+                                       offset=page * CONVERSATION_PAGE_SIZE)
     
     if not history:
         await callback.answer("История переписки пуста", show_alert=True)
@@ -1107,44 +3241,31 @@ async def superadmin_view_conversation_handler(callback: types.CallbackQuery):
     text = f"{title}\n\n"
     
     for msg in history:
-        timestamp = msg.get("timestamp", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                time_str = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                time_str = timestamp[:16]
-        else:
-            time_str = "??"
-        
-        sender_name = msg.get("from_user_name", "?")
+        time_str = format_ms(msg["ts"], "%d.%m.%Y %H:%M")
+        sender_name = user_display_name(users_data, msg["f"])
         
         # Определяем, кто отправитель
         if is_mentor_student:
-            if msg["from_user_id"] == (user1_id if user1.get("mentor") == user2_id else user2_id):
+            if conversation_participants(msg)[0] == (user1_id if user1.get("mentor") == user2_id else user2_id):
                 sender_display = f"<b>👤 НАСТАВНИК {sender_name} ({time_str}):</b>"
             else:
                 sender_display = f"<b>👨‍🎓 УЧЕНИК {sender_name} ({time_str}):</b>"
         else:
             sender_display = f"<b>👤 {sender_name} ({time_str}):</b>"
         
-        if msg["content_type"] == "text":
-            text += f"{sender_display}\n{msg.get('text', '')}\n\n"
-        elif msg["content_type"] == "photo":
-            caption = msg.get("caption", "")
-            text += f"{sender_display}\n[Фото] {caption}\n\n"
-        elif msg["content_type"] == "document":
-            caption = msg.get("caption", "")
-            text += f"{sender_display}\n[Документ] {caption}\n\n"
-        elif msg["is_assignment_related"]:
-            text += f"{sender_display}\n[Сообщение по заданию]\n\n"
+        text += f"{sender_display}\n{conversation_preview(msg)}\n\n"
     
     # Кнопки
     kb = InlineKeyboardMarkup()
+    if (page + 1) * CONVERSATION_PAGE_SIZE < count_conversation_history(user1_id, user2_id):
+        kb.add(InlineKeyboardButton("⏪ Более ранние сообщения",
+                                    callback_data=f"superadmin_view_conversation:{user1_id}:{user2_id}:{page + 1}"))
+    kb.add(InlineKeyboardButton("📄 Выгрузить весь диалог файлом",
+                                callback_data=f"export_conversation:{user1_id}:{user2_id}"))
     kb.add(InlineKeyboardButton("🔙 К списку диалогов", callback_data="admin_view_conversations"))
     kb.add(InlineKeyboardButton("📋 В админ-панель", callback_data="admin_panel"))
     
-    # Используем безопасную отправку
+    # Длинная страница уходит несколькими сообщениями; весь диалог файлом — только по кнопке выгрузки
     await safe_send_message(callback.from_user.id, text, reply_markup=kb)
 
 @dp.callback_query_handler(lambda c: c.data.startswith("admin_view_specific_conversation:"))
@@ -1157,9 +3278,11 @@ async def admin_view_specific_conversation_handler(callback: types.CallbackQuery
     parts = callback.data.split(":")
     mentor_id = parts[1]
     student_id = parts[2]
+    page = int(parts[3]) if len(parts) > 3 else 0
     
-    # Получаем историю переписки
-    history = get_conversation_history(mentor_id, student_id, limit=50)
+    # Получаем историю переписки (страница 0 — самые новые сообщения)
+    history = get_conversation_history(mentor_id, student_id, limit=CONVERSATION_PAGE_SIZE,
+                                       offset=page * CONVERSATION_PAGE_SIZE)
     
     if not history:
         await callback.answer("История переписки пуста", show_alert=True)
@@ -1174,43 +3297,49 @@ async def admin_view_specific_conversation_handler(callback: types.CallbackQuery
     text = f"💬 <b>Диалог: {mentor_name} ↔ {student_name}</b>\n\n"
     
     for msg in history:
-        timestamp = msg.get("timestamp", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                time_str = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                time_str = timestamp[:16]
-        else:
-            time_str = "??"
-        
-        sender_name = msg.get("from_user_name", "?")
+        time_str = format_ms(msg["ts"], "%d.%m.%Y %H:%M")
+        sender_name = user_display_name(users_data, msg["f"])
         
         # Определяем, кто отправитель
-        if msg["from_user_id"] == mentor_id:
+        if conversation_participants(msg)[0] == mentor_id:
             sender_display = f"<b>👤 НАСТАВНИК {sender_name} ({time_str}):</b>"
         else:
             sender_display = f"<b>👨‍🎓 УЧЕНИК {sender_name} ({time_str}):</b>"
         
-        if msg["content_type"] == "text":
-            text += f"{sender_display}\n{msg.get('text', '')}\n\n"
-        elif msg["content_type"] == "photo":
-            caption = msg.get("caption", "")
-            text += f"{sender_display}\n[Фото] {caption}\n\n"
-        elif msg["content_type"] == "document":
-            caption = msg.get("caption", "")
-            text += f"{sender_display}\n[Документ] {caption}\n\n"
-        elif msg["is_assignment_related"]:
-            text += f"{sender_display}\n[Сообщение по заданию]\n\n"
+        text += f"{sender_display}\n{conversation_preview(msg)}\n\n"
     
     # Кнопки
     kb = InlineKeyboardMarkup()
+    if (page + 1) * CONVERSATION_PAGE_SIZE < count_conversation_history(mentor_id, student_id):
+        kb.add(InlineKeyboardButton("⏪ Более ранние сообщения",
+                                    callback_data=f"admin_view_specific_conversation:{mentor_id}:{student_id}:{page + 1}"))
+    kb.add(InlineKeyboardButton("📄 Выгрузить весь диалог файлом",
+                                callback_data=f"export_conversation:{mentor_id}:{student_id}"))
     kb.add(InlineKeyboardButton("⬅ К списку диалогов", callback_data="admin_view_conversations"))
     kb.add(InlineKeyboardButton("📋 В админ-панель", callback_data="admin_panel"))
     
-    # Используем безопасную отправку
+    # Длинная страница уходит несколькими сообщениями; весь диалог файлом — только по кнопке выгрузки
     await safe_send_message(callback.from_user.id, text, reply_markup=kb)
 
+@dp.callback_query_handler(lambda c: c.data.startswith("export_conversation:"))
+async def export_conversation_handler(callback: types.CallbackQuery):
+    """Выгрузка всей переписки пары (включая архив) одним файлом"""
+    if callback.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        await callback.answer("Доступ только для администраторов", show_alert=True)
+        return
+    
+    _, user1_id, user2_id = callback.data.split(":")
+    if count_conversation_history(user1_id, user2_id) == 0:
+        await callback.answer("История переписки пуста", show_alert=True)
+        return
+    
+    await callback.answer("⏳ Готовлю файл с перепиской...")
+    try:
+        await send_conversation_export(callback.from_user.id, user1_id, user2_id)
+    except Exception as e:
+        log_error(f"❌ Ошибка выгрузки диалога {user1_id}-{user2_id}: {e}")
+        await callback.message.answer("❌ Не удалось выгрузить диалог")
+
 # --- НОВАЯ КОМАНДА /dialogs ДЛЯ ПРОСМОТРА ДИАЛОГОВ ---
 @dp.message_handler(commands=["dialogs"], state="*")
 async def dialogs_command(message: types.Message, state=None):
@@ -1323,12 +3452,12 @@ async def register_admin(callback: types.CallbackQuery):
         "surname": "",
         "level": "ГТ",  # Высший уровень
         "chat_id": user_id,
-        "registration_date": str(date.today()),
-        "active_today": str(date.today()),
+        "registration_date": now_ms(),
+        "active_today": now_ms(),
         "is_superadmin": True  # Флаг суперадмина
     }
     
-    if save_users(data):
+    if save_users(data, changed=[user_id]):
         await callback.answer("✅ Вы зарегистрированы как Суперадмин", show_alert=True)
         await admin_main_menu(callback.from_user.id)
     else:
@@ -1355,18 +3484,29 @@ async def register_superadmin_command(message: types.Message, state=None):
         "surname": "",
         "level": "ГТ",
         "chat_id": user_id,
-        "registration_date": str(date.today()),
-        "active_today": str(date.today()),
+        "registration_date": now_ms(),
+        "active_today": now_ms(),
         "is_superadmin": True
     }
     
-    if save_users(data):
+    if save_users(data, changed=[user_id]):
         await message.answer("✅ Вы успешно зарегистрированы как Суперадмин!")
         await admin_main_menu(message.from_user.id)
     else:
         await message.answer("❌ Ошибка регистрации")
 
 # --- BUTTON: ОБЫЧНОЕ МЕНЮ НАСТАВНИКА ---
+def student_menu_keyboard(user_id):
+    """Общие кнопки главного меню: профиль и задания, полученные как учеником (со счетчиком несданных)"""
+    counters = get_menu_counters(user_id)
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile"))
+    if counters["assignments"]:
+        pending = counters["pending"]
+        kb.add(InlineKeyboardButton("📚 Мои задания" + (f" ({pending})" if pending else ""),
+                                    callback_data="my_assignments"))
+    return kb
+
 async def mentor_main_menu(user_id):
     data = load_users()
     users = data["users"]
@@ -1380,13 +3520,18 @@ async def mentor_main_menu(user_id):
         await admin_main_menu(user_id)
         return
     
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile"))
+    counters = get_menu_counters(user_id)
+    kb = student_menu_keyboard(user_id)
     
     if has_students or is_admin:
         kb.add(InlineKeyboardButton("👥 Мои ученики", callback_data="show_my_students"))
-        # ДОБАВЛЕНО: Кнопка для просмотра решений учеников
-        kb.add(InlineKeyboardButton("📥 Ответы учеников", callback_data="view_student_solutions"))
+        # ДОБАВЛЕНО: Кнопка для просмотра решений учеников (со счетчиком новых)
+        unread = counters["unread"]
+        kb.add(InlineKeyboardButton("📥 Ответы учеников" + (f" ({unread} 🆕)" if unread else ""),
+                                    callback_data="view_student_solutions"))
+        digest = users.get(str(user_id), {}).get("digest_minutes")
+        kb.add(InlineKeyboardButton(f"🗂 Уведомления: сводка раз в {digest} мин" if digest else "🔔 Уведомления: сразу",
+                                    callback_data="toggle_digest"))
     
     await bot.send_message(user_id, "📋 <b>Главное меню</b>", reply_markup=kb)
 
@@ -1397,13 +3542,10 @@ async def help_command(message: types.Message, state=None):
         await state.finish()
     
     user_id = message.from_user.id
-    today_str = str(date.today())
     data = load_users()
     users = data["users"]
     
-    if str(user_id) in users:
-        users[str(user_id)]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
     
     help_text = """
 <b>📚 Справка по командам бота:</b>
@@ -1438,13 +3580,10 @@ async def menu_command(message: types.Message, state=None):
         await state.finish()
     
     user_id = message.from_user.id
-    today_str = str(date.today())
     data = load_users()
     users = data["users"]
     
-    if str(user_id) in users:
-        users[str(user_id)]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
     
     # СУПЕРАДМИН всегда получает админ-меню
     if user_id in [OLGA_ID, YOUR_ADMIN_ID]:
@@ -1455,9 +3594,7 @@ async def menu_command(message: types.Message, state=None):
             if has_students:
                 await mentor_main_menu(user_id)
             else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile"))
-                await message.answer("📋 <b>Главное меню</b>", reply_markup=kb)
+                await message.answer("📋 <b>Главное меню</b>", reply_markup=student_menu_keyboard(user_id))
         else:
             await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
 
@@ -1470,11 +3607,8 @@ async def profile_command(message: types.Message, state=None):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
-    
     if user_id in users:
-        users[user_id]["active_today"] = today_str
-        save_users(data)
+        touch_user(user_id, users)
     else:
         await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
         return
@@ -1494,7 +3628,7 @@ async def profile_command(message: types.Message, state=None):
     text += f"• Имя: <b>{u['name']} {u.get('surname','')}</b>\n"
     text += f"• Уровень: <b>{u.get('level','—')}</b>\n"
     text += f"• Наставник: <b>{mentor_name}</b>\n"
-    text += f"• Дата регистрации: <b>{u.get('registration_date','—')}</b>\n"
+    text += f"• Дата регистрации: <b>{format_ms(u.get('registration_date'), '%d.%m.%Y', '—')}</b>\n"
     
     if student_count > 0:
         text += f"• Ваших учеников: <b>{student_count}</b>\n"
@@ -1519,17 +3653,13 @@ async def students_command(message: types.Message, state=None):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
-    
     is_admin = user_id in [OLGA_ID, YOUR_ADMIN_ID]
     
     if not is_admin and str(user_id) not in users:
         await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
         return
     
-    if str(user_id) in users:
-        users[str(user_id)]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
     
     has_students = any(u.get("mentor") == str(user_id) for u in users.values())
     
@@ -1575,25 +3705,28 @@ async def stats_command(message: types.Message, state=None):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
+    today_ms = day_start_ms()
     
     total = len(users)
-    new_today = sum(1 for u in users.values() if u.get("registration_date") == today_str)
-    active_today = sum(1 for u in users.values() if u.get("active_today") == today_str)
+    new_today = sum(1 for u in users.values() if (u.get("registration_date") or 0) >= today_ms)
+    active_today = sum(1 for u in users.values() if (u.get("active_today") or 0) >= today_ms)
     with_mentor = sum(1 for u in users.values() if u.get("mentor"))
     without_mentor = total - with_mentor
+    reachable, unreachable = reachability_counts(users)
     
     text = f"📊 <b>Статистика бота</b>\n\n"
     text += f"• Всего пользователей: {total}\n"
     text += f"• Новых сегодня: {new_today}\n"
     text += f"• Активных сегодня: {active_today}\n"
     text += f"• С наставником: {with_mentor}\n"
-    text += f"• Без наставника: {without_mentor}\n\n"
+    text += f"• Без наставника: {without_mentor}\n"
+    text += f"• Доступны для рассылок: {reachable}\n"
+    text += f"• Недоступны (заблокировали бота): {unreachable}\n\n"
     
     text += "<b>По уровням:</b>\n"
     for level in LEVELS_ORDER:
         level_users = [u for u in users.values() if u.get("level") == level]
-        level_active = sum(1 for u in level_users if u.get("active_today") == today_str)
+        level_active = sum(1 for u in level_users if (u.get("active_today") or 0) >= today_ms)
         text += f"• {level}: {len(level_users)} чел. (активных: {level_active})\n"
     
     await message.answer(text)
@@ -1612,6 +3745,8 @@ async def broadcast_command(message: types.Message, state=None):
         kb.add(InlineKeyboardButton("📋 По уровням", callback_data="broadcast_by_level"))
         kb.add(InlineKeyboardButton("✅ Только активные", callback_data="broadcast_active"))
         kb.add(InlineKeyboardButton("❌ Только неактивные", callback_data="broadcast_inactive"))
+        kb.add(InlineKeyboardButton("🎯 Конструктор аудитории", callback_data="broadcast_audience"))
+        kb.add(InlineKeyboardButton("🕒 Запланированные", callback_data="scheduled_list"))
         kb.add(InlineKeyboardButton("👥 Всем пользователям", callback_data="broadcast_all"))
         kb.add(InlineKeyboardButton("⬅ Назад", callback_data="back_main"))
         
@@ -1632,10 +3767,7 @@ async def start(message: types.Message, state=None):
     data = load_users()
     users = data["users"]
 
-    today_str = str(date.today())
-    if str(user_id) in users:
-        users[str(user_id)]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
 
     if state:
         await state.finish()
@@ -1663,9 +3795,7 @@ async def start(message: types.Message, state=None):
         if any(u.get("mentor") == str(user_id) for u in users.values()):
             await mentor_main_menu(user_id)
         else:
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile"))
-            await message.answer("📋 <b>Главное меню</b>", reply_markup=kb)
+            await message.answer("📋 <b>Главное меню</b>", reply_markup=student_menu_keyboard(user_id))
         return
 
     await message.answer("Введите ваше имя:")
@@ -1766,39 +3896,42 @@ async def choose_mentor(callback, state):
     user_id = str(callback.from_user.id)
     data_user = await state.get_data()
 
-    data = load_users()
-    users = data["users"]
-
-    # ПРОВЕРЯЕМ, существует ли уже пользователь
-    if user_id in users:
-        # Обновляем только нужные поля, сохраняем существующие данные
-        existing_user = users[user_id]
-        users[user_id] = {
-            "name": data_user["name"],
-            "surname": data_user.get("surname", existing_user.get("surname", "")),
-            "level": data_user["level"],
-            "pending_mentor": mentor_id,
-            "chat_id": user_id,
-            # Сохраняем существующие поля
-            "registration_date": existing_user.get("registration_date", str(date.today())),
-            "active_today": existing_user.get("active_today"),
-            "mentor": existing_user.get("mentor")  # Сохраняем старого наставника если есть
-        }
-        log_info(f"🔄 Обновлен существующий пользователь: {data_user['name']} (ID: {user_id})")
-    else:
-        # Создаем нового пользователя
-        users[user_id] = {
-            "name": data_user["name"],
-            "surname": data_user.get("surname", ""),
-            "level": data_user["level"],
-            "pending_mentor": mentor_id,
-            "chat_id": user_id,
-            "registration_date": str(date.today())
-        }
-        log_info(f"🆕 Создан новый пользователь: {data_user['name']} (ID: {user_id})")
-    
-    # СОХРАНЯЕМ ВСЕХ пользователей
-    if not save_users(data):
+    def register(uow):
+        users = uow.users["users"]
+        
+        # ПРОВЕРЯЕМ, существует ли уже пользователь
+        if user_id in users:
+            # Обновляем только нужные поля, сохраняем существующие данные
+            existing_user = users[user_id]
+            users[user_id] = {
+                "name": data_user["name"],
+                "surname": data_user.get("surname", existing_user.get("surname", "")),
+                "level": data_user["level"],
+                "pending_mentor": mentor_id,
+                "chat_id": user_id,
+                # Сохраняем существующие поля
+                "registration_date": existing_user.get("registration_date", now_ms()),
+                "active_today": existing_user.get("active_today"),
+                "mentor": existing_user.get("mentor")  # Сохраняем старого наставника если есть
+            }
+            log_info(f"🔄 Обновлен существующий пользователь: {data_user['name']} (ID: {user_id})")
+        else:
+            # Создаем нового пользователя
+            users[user_id] = {
+                "name": data_user["name"],
+                "surname": data_user.get("surname", ""),
+                "level": data_user["level"],
+                "pending_mentor": mentor_id,
+                "chat_id": user_id,
+                "registration_date": now_ms()
+            }
+            log_info(f"🆕 Создан новый пользователь: {data_user['name']} (ID: {user_id})")
+        uow.stage("users", user_ids=[user_id])
+        return users
+    
+    # СОХРАНЯЕМ одной транзакцией (при гонке с другим сохранением — повтор на свежих данных)
+    ok, users = await run_transaction(register)
+    if not ok:
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
 
@@ -1821,16 +3954,18 @@ async def choose_mentor(callback, state):
 async def mentor_accept(callback: types.CallbackQuery):
     chosen_user_id = callback.data.split(":")[1]
 
-    data = load_users()
-    users = data["users"]
-
-    mentor_id = users[chosen_user_id].get("pending_mentor")
-    users[chosen_user_id]["mentor"] = mentor_id
-    users[chosen_user_id].pop("pending_mentor", None)
+    def accept(uow):
+        users = uow.users["users"]
+        users[chosen_user_id]["mentor"] = users[chosen_user_id].get("pending_mentor")
+        users[chosen_user_id].pop("pending_mentor", None)
+        uow.stage("users", user_ids=[chosen_user_id])
+        return users
     
-    if not save_users(data):
+    ok, users = await run_transaction(accept)
+    if not ok:
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
+    mentor_id = users[chosen_user_id]["mentor"]
 
     await callback.message.edit_text(
         f"Вы приняли ученика <b>{users[chosen_user_id]['name']} {users[chosen_user_id].get('surname','')}</b>"
@@ -1852,7 +3987,7 @@ async def mentor_decline(callback: types.CallbackQuery):
 
     users[chosen_user_id].pop("pending_mentor", None)
     
-    if not save_users(data):
+    if not save_users(data, changed=[chosen_user_id]):
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
 
@@ -1941,9 +4076,9 @@ async def select_new_mentor(callback: types.CallbackQuery, state):
     
     # Сохраняем данные о запросе
     users[user_id]["pending_new_mentor"] = new_mentor_id
-    users[user_id]["mentor_change_request"] = str(datetime.now())
+    users[user_id]["mentor_change_request"] = now_ms()
     
-    if not save_users(data):
+    if not save_users(data, changed=[user_id]):
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
     
@@ -1970,29 +4105,33 @@ async def accept_new_mentor(callback: types.CallbackQuery):
     user_id = callback.data.split(":")[1]
     new_mentor_id = str(callback.from_user.id)
     
-    data = load_users()
-    users = data["users"]
-    
-    if user_id not in users:
-        await callback.answer("Ошибка: пользователь не найден", show_alert=True)
-        return
-    
-    # Проверяем, что запрос еще актуален
-    if users[user_id].get("pending_new_mentor") != new_mentor_id:
-        await callback.answer("Запрос устарел или недействителен", show_alert=True)
-        return
-    
-    # Сохраняем старого наставника для уведомления
-    old_mentor_id = users[user_id].get("mentor")
-    
-    # Меняем наставника
-    users[user_id]["mentor"] = new_mentor_id
-    users[user_id].pop("pending_new_mentor", None)
-    users[user_id].pop("mentor_change_request", None)
-    
-    if not save_users(data):
+    def change_mentor(uow):
+        users = uow.users["users"]
+        if user_id not in users:
+            return "Ошибка: пользователь не найден", None, users
+        
+        # Проверяем, что запрос еще актуален
+        if users[user_id].get("pending_new_mentor") != new_mentor_id:
+            return "Запрос устарел или недействителен", None, users
+        
+        # Сохраняем старого наставника для уведомления
+        old_mentor_id = users[user_id].get("mentor")
+        
+        # Меняем наставника
+        users[user_id]["mentor"] = new_mentor_id
+        users[user_id].pop("pending_new_mentor", None)
+        users[user_id].pop("mentor_change_request", None)
+        uow.stage("users", user_ids=[user_id])
+        return None, old_mentor_id, users
+    
+    ok, result = await run_transaction(change_mentor)
+    if not ok:
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
+    error, old_mentor_id, users = result
+    if error:
+        await callback.answer(error, show_alert=True)
+        return
     
     user_name = f"{users[user_id]['name']} {users[user_id].get('surname','')}".strip()
     
@@ -2031,7 +4170,7 @@ async def decline_new_mentor(callback: types.CallbackQuery):
     users[user_id].pop("pending_new_mentor", None)
     users[user_id].pop("mentor_change_request", None)
     
-    if not save_users(data):
+    if not save_users(data, changed=[user_id]):
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
     
@@ -2094,9 +4233,9 @@ async def select_new_level(callback: types.CallbackQuery, state):
     
     # Сохраняем запрос на изменение уровня
     users[user_id]["pending_level"] = new_level
-    users[user_id]["level_change_request"] = str(datetime.now())
+    users[user_id]["level_change_request"] = now_ms()
     
-    if not save_users(data):
+    if not save_users(data, changed=[user_id]):
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
     
@@ -2147,13 +4286,10 @@ async def confirm_level(callback: types.CallbackQuery):
         await callback.answer("Запрос устарел или недействителен", show_alert=True)
         return
     
-    # Меняем уровень
+    # Меняем уровень (запись только этого пользователя)
     old_level = users[user_id].get("level", "—")
-    users[user_id]["level"] = new_level
-    users[user_id].pop("pending_level", None)
-    users[user_id].pop("level_change_request", None)
-    
-    if not save_users(data):
+    if not update_user_record(user_id, {"level": new_level},
+                              unset=("pending_level", "level_change_request"), users=users):
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
     
@@ -2190,7 +4326,7 @@ async def reject_level(callback: types.CallbackQuery):
     users[user_id].pop("pending_level", None)
     users[user_id].pop("level_change_request", None)
     
-    if not save_users(data):
+    if not save_users(data, changed=[user_id]):
         await callback.answer("❌ Ошибка сохранения данных", show_alert=True)
         return
     
@@ -2217,11 +4353,7 @@ async def show_my_profile(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
-    
-    if user_id in users:
-        users[user_id]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
     
     if user_id not in users:
         await callback.answer("Вы не зарегистрированы", show_alert=True)
@@ -2242,7 +4374,7 @@ async def show_my_profile(callback: types.CallbackQuery):
     text += f"• Имя: <b>{u['name']} {u.get('surname','')}</b>\n"
     text += f"• Уровень: <b>{u.get('level','—')}</b>\n"
     text += f"• Наставник: <b>{mentor_name}</b>\n"
-    text += f"• Дата регистрации: <b>{u.get('registration_date','—')}</b>\n"
+    text += f"• Дата регистрации: <b>{format_ms(u.get('registration_date'), '%d.%m.%Y', '—')}</b>\n"
     
     if student_count > 0:
         text += f"• Ваших учеников: <b>{student_count}</b>\n"
@@ -2265,17 +4397,13 @@ async def my_students(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
-    
     is_admin = user_id in [OLGA_ID, YOUR_ADMIN_ID]
     
     if not is_admin and str(user_id) not in users:
         await callback.answer("Вы не зарегистрированы", show_alert=True)
         return
     
-    if str(user_id) in users:
-        users[str(user_id)]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
     
     has_students = any(u.get("mentor") == str(user_id) for u in users.values())
     
@@ -2315,9 +4443,7 @@ async def back_main(callback: types.CallbackQuery):
             if has_students:
                 await mentor_main_menu(user_id)
             else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile"))
-                await callback.message.answer("📋 <b>Главное меню</b>", reply_markup=kb)
+                await callback.message.answer("📋 <b>Главное меню</b>", reply_markup=student_menu_keyboard(user_id))
 
 @dp.callback_query_handler(lambda c: c.data.startswith("show_students:"))
 async def show_students(callback: types.CallbackQuery):
@@ -2327,11 +4453,7 @@ async def show_students(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
-    
-    if str(user_id) in users:
-        users[str(user_id)]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
 
     is_admin = user_id in [OLGA_ID, YOUR_ADMIN_ID]
     
@@ -2380,11 +4502,7 @@ async def my_full_branch(callback: types.CallbackQuery):
     data = load_users()
     users = data["users"]
     
-    today_str = str(date.today())
-    
-    if user_id in users:
-        users[user_id]["active_today"] = today_str
-        save_users(data)
+    touch_user(user_id, users)
     
     if not any(u.get("mentor") == user_id for u in users.values()):
         await callback.answer("У вас пока нет учеников", show_alert=True)
@@ -2528,6 +4646,10 @@ async def student_profile(callback: types.CallbackQuery):
     
     if source == "BRANCH":
         kb.add(InlineKeyboardButton("⬅ Назад к ветке", callback_data="my_full_branch"))
+    elif source == "SEARCH":
+        search_data = await dp.current_state(user=callback.from_user.id, chat=callback.from_user.id).get_data()
+        kb.add(InlineKeyboardButton("⬅ К результатам поиска",
+                                    callback_data=f"search_page:{search_data.get('search_page', 0)}"))
     elif source in LEVELS_ORDER:
         kb.add(InlineKeyboardButton("⬅ Назад", callback_data=f"show_students:{source}"))
     else:
@@ -2646,6 +4768,8 @@ async def admin_broadcast(callback: types.CallbackQuery):
         kb.add(InlineKeyboardButton("📋 По уровням", callback_data="broadcast_by_level"))
         kb.add(InlineKeyboardButton("✅ Только активные", callback_data="broadcast_active"))
         kb.add(InlineKeyboardButton("❌ Только неактивные", callback_data="broadcast_inactive"))
+        kb.add(InlineKeyboardButton("🎯 Конструктор аудитории", callback_data="broadcast_audience"))
+        kb.add(InlineKeyboardButton("🕒 Запланированные", callback_data="scheduled_list"))
         kb.add(InlineKeyboardButton("👥 Всем пользователям", callback_data="broadcast_all"))
         kb.add(InlineKeyboardButton("⬅ Назад", callback_data="back_main"))
         
@@ -2735,9 +4859,220 @@ async def cancel_broadcast(callback: types.CallbackQuery):
     await callback.message.edit_text("❌ Рассылка отменена.")
     await admin_main_menu(callback.from_user.id)
 
+# --- КОНСТРУКТОР АУДИТОРИИ ---
+AUDIENCE_ACTIVITY_PRESETS = [None, ["active", 1], ["active", 7], ["active", 30], ["inactive", 7], ["inactive", 30]]
+
+def describe_audience(query, users_data=None, mentor_name=None):
+    """Человекочитаемое описание запроса аудитории (имя наставника ветки — из users_data или готовое)"""
+    lines = [f"• Уровни: {', '.join(query['levels']) if query.get('levels') else 'все'}"]
+    activity = query.get("activity")
+    if not activity:
+        lines.append("• Активность: любая")
+    elif activity[0] == "active":
+        lines.append(f"• Активность: заходили за {activity[1]} дн.")
+    else:
+        lines.append(f"• Активность: не заходили {activity[1]}+ дн.")
+    has_mentor = query.get("has_mentor")
+    lines.append(f"• Наставник: {'есть' if has_mentor is True else 'нет' if has_mentor is False else 'не важно'}")
+    if query.get("mentor"):
+        if mentor_name is None:
+            mentor_name = user_display_name(users_data or {}, query["mentor"])
+        lines.append(f"• Ветка наставника: {mentor_name}")
+    lines.append(f"• Недоступные (заблокировали бота): {'включены' if query.get('include_unreachable') else 'исключены'}")
+    return "\n".join(lines)
+
+async def show_audience_builder(message, query, edit=False, mentor_name=None):
+    """Экран конструктора с предпросмотром числа получателей (по индексу, без чтения users.json)"""
+    text = "🎯 <b>Аудитория рассылки</b>\n\n"
+    text += describe_audience(query, mentor_name=mentor_name)
+    text += f"\n\n👥 <b>Получателей: {count_audience(query)}</b>"
+    
+    activity = query.get("activity")
+    activity_label = ("любая" if not activity else
+                      f"за {activity[1]} дн." if activity[0] == "active" else f"нет {activity[1]}+ дн.")
+    has_mentor = query.get("has_mentor")
+    
+    kb = InlineKeyboardMarkup(row_width=5)
+    kb.row(*[InlineKeyboardButton(f"{'✅' if lvl in query.get('levels', []) else ''}{lvl}",
+                                  callback_data=f"aud_level:{lvl}") for lvl in LEVELS_ORDER])
+    kb.add(InlineKeyboardButton(f"🕒 Активность: {activity_label}", callback_data="aud_activity"))
+    kb.add(InlineKeyboardButton(f"👤 Наставник: {'есть' if has_mentor is True else 'нет' if has_mentor is False else 'не важно'}",
+                                callback_data="aud_has_mentor"))
+    if query.get("mentor"):
+        kb.add(InlineKeyboardButton("🌳 Убрать ветку наставника", callback_data="aud_branch_clear"))
+    else:
+        kb.add(InlineKeyboardButton("🌳 Ветка наставника", callback_data="aud_branch"))
+    kb.add(InlineKeyboardButton(f"🚫 Недоступные: {'включены' if query.get('include_unreachable') else 'исключены'}",
+                                callback_data="aud_unreachable"))
+    kb.add(InlineKeyboardButton("✅ Далее — написать сообщение", callback_data="aud_done"))
+    kb.add(InlineKeyboardButton("❌ Отмена", callback_data="aud_cancel"))
+    
+    if edit:
+        try:
+            await message.edit_text(text, reply_markup=kb)
+            return
+        except Exception:
+            pass
+    await message.answer(text, reply_markup=kb)
+
+async def open_audience_builder(callback, state, query):
+    if callback.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        await callback.answer("Доступ запрещён", show_alert=True)
+        return
+    await state.finish()
+    await Form.audience.set()
+    await state.update_data(audience=query)
+    await show_audience_builder(callback.message, query)
+
+@dp.callback_query_handler(lambda c: c.data == "broadcast_audience", state="*")
+async def broadcast_audience(callback: types.CallbackQuery, state):
+    await open_audience_builder(callback, state, {})
+
+@dp.callback_query_handler(lambda c: c.data == "broadcast_active", state="*")
+async def broadcast_active(callback: types.CallbackQuery, state):
+    await open_audience_builder(callback, state, {"activity": ["active", 7]})
+
+@dp.callback_query_handler(lambda c: c.data == "broadcast_inactive", state="*")
+async def broadcast_inactive(callback: types.CallbackQuery, state):
+    await open_audience_builder(callback, state, {"activity": ["inactive", 7]})
+
+@dp.callback_query_handler(lambda c: c.data.startswith("aud_") and c.data not in ("aud_done", "aud_cancel", "aud_branch"),
+                           state=Form.audience)
+async def audience_toggle(callback: types.CallbackQuery, state):
+    """Изменение условий аудитории"""
+    data = await state.get_data()
+    query = dict(data.get("audience") or {})
+    action = callback.data
+    
+    if action.startswith("aud_level:"):
+        level = action.split(":", 1)[1]
+        levels = list(query.get("levels", []))
+        if level in levels:
+            levels.remove(level)
+        else:
+            levels.append(level)
+        query["levels"] = [lvl for lvl in LEVELS_ORDER if lvl in levels]
+    elif action == "aud_activity":
+        current = query.get("activity")
+        position = AUDIENCE_ACTIVITY_PRESETS.index(current) if current in AUDIENCE_ACTIVITY_PRESETS else 0
+        query["activity"] = AUDIENCE_ACTIVITY_PRESETS[(position + 1) % len(AUDIENCE_ACTIVITY_PRESETS)]
+    elif action == "aud_has_mentor":
+        query["has_mentor"] = {None: True, True: False, False: None}[query.get("has_mentor")]
+    elif action == "aud_branch_clear":
+        query.pop("mentor", None)
+    elif action == "aud_unreachable":
+        query["include_unreachable"] = not query.get("include_unreachable")
+    
+    await state.update_data(audience=query)
+    await callback.answer()
+    await show_audience_builder(callback.message, query, edit=True,
+                                mentor_name=data.get("audience_mentor_name") if query.get("mentor") else None)
+
+@dp.callback_query_handler(lambda c: c.data == "aud_branch", state=Form.audience)
+async def audience_branch(callback: types.CallbackQuery, state):
+    await Form.audience_mentor.set()
+    await callback.message.answer("🌳 Отправьте ID или имя наставника, по чьей ветке нужна рассылка:")
+
+AUDIENCE_MENTOR_CHOICES = 10   # Кнопок при неоднозначном поиске наставника
+
+@dp.message_handler(state=Form.audience_mentor)
+async def audience_branch_mentor(message: types.Message, state):
+    """Наставник для рассылки по ветке: точный ID или единственный найденный наставник, иначе выбор кнопками"""
+    query_text = (message.text or "").strip()
+    found = search_users(query_text) if query_text else []
+    if query_text in found:
+        await set_audience_mentor(message, state, query_text)
+        return
+    
+    ensure_audience_index()
+    mentors = [uid for uid in found if audience_index.children.get(uid)]
+    if len(found) == 1 and mentors:
+        await set_audience_mentor(message, state, mentors[0])
+        return
+    if not found:
+        await set_audience_mentor(message, state, None)
+        return
+    
+    # Несколько совпадений или найден не наставник — корень ветки выбирает администратор
+    kb = InlineKeyboardMarkup(row_width=1)
+    for uid in (mentors + [uid for uid in found if uid not in mentors])[:AUDIENCE_MENTOR_CHOICES]:
+        name, surname, _ = user_search_index.profile(uid)
+        kb.add(InlineKeyboardButton(f"{name} {surname or ''}".strip() + f" — учеников: {len(audience_index.children.get(uid, ()))}",
+                                    callback_data=f"aud_branch_pick:{uid}"))
+    kb.add(InlineKeyboardButton("❌ Отмена", callback_data="aud_cancel"))
+    await message.answer(f"🌳 Найдено: {len(found)}. Выберите наставника, по чьей ветке нужна рассылка:", reply_markup=kb)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("aud_branch_pick:"), state=Form.audience_mentor)
+async def audience_branch_pick(callback: types.CallbackQuery, state):
+    await callback.answer()
+    await set_audience_mentor(callback.message, state, callback.data.split(":", 1)[1])
+
+async def set_audience_mentor(message, state, mentor_id):
+    """Запомнить наставника ветки (None — не найден) и вернуться в конструктор аудитории"""
+    await Form.audience.set()
+    data = await state.get_data()
+    audience = dict(data.get("audience") or {})
+    mentor_name = data.get("audience_mentor_name")
+    profile = user_search_index.profile(mentor_id) if mentor_id is not None else None
+    if profile is None:
+        await message.answer("❌ Наставник не найден")
+    else:
+        # Имя запоминаем в состоянии, чтобы экран конструктора не читал users.json
+        name, surname, _ = profile
+        mentor_name = f"{name} {surname or ''}".strip()
+        audience["mentor"] = mentor_id
+        await state.update_data(audience=audience, audience_mentor_name=mentor_name)
+    await show_audience_builder(message, audience, mentor_name=mentor_name)
+
+@dp.callback_query_handler(lambda c: c.data == "aud_done", state=Form.audience)
+async def audience_done(callback: types.CallbackQuery, state):
+    data = await state.get_data()
+    if count_audience(data.get("audience") or {}) == 0:
+        await callback.answer("Под условия не подходит ни один пользователь", show_alert=True)
+        return
+    await Form.admin_message.set()
+    await callback.message.answer("Отправьте сообщение для рассылки (текст, фото, видео, документ, голос, альбом и т.д.).")
+
+@dp.callback_query_handler(lambda c: c.data == "aud_cancel", state=[Form.audience, Form.audience_mentor])
+async def audience_cancel(callback: types.CallbackQuery, state):
+    await state.finish()
+    await callback.message.edit_text("❌ Рассылка отменена.")
+    await admin_main_menu(callback.from_user.id)
+
+# --- СБОРКА АЛЬБОМОВ ---
+class MediaGroupCollector:
+    """Альбом приходит отдельными сообщениями с общим media_group_id — собираем их в один список"""
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self.groups = {}
+    
+    async def collect(self, message):
+        """Первому сообщению альбома (после паузы) возвращает весь альбом, остальным — None"""
+        group_id = message.media_group_id
+        if group_id in self.groups:
+            self.groups[group_id].append(message)
+            return None
+        self.groups[group_id] = [message]
+        await asyncio.sleep(self.delay)
+        return sorted(self.groups.pop(group_id), key=lambda m: m.message_id)
+
+media_group_collector = MediaGroupCollector()
+
+def album_items(messages):
+    """Альбом в виде [тип, file_id, подпись] для сохранения в задаче рассылки"""
+    return [list(message_payload(m)) for m in messages]
+
 # --- ОБРАБОТЧИК РАССЫЛКИ С ЗАДАНИЕМ ---
 @dp.message_handler(state=Form.admin_message, content_types=types.ContentTypes.ANY)
 async def admin_send_message(message, state):
+    # Альбом обрабатываем один раз, целиком
+    album = None
+    if message.media_group_id:
+        album = await media_group_collector.collect(message)
+        if album is None:
+            return
+        message = next((m for m in album if m.caption), album[0])
+    
     data = await state.get_data()
     selected_levels = data.get("selected_levels", [])
     broadcast_to_all = data.get("broadcast_to_all", False)
@@ -2746,30 +5081,29 @@ async def admin_send_message(message, state):
     recipients = []
     recipient_names = []
     
-    today_str = str(date.today())
-    
     # Проверяем, является ли отправитель Ольгой или суперадмином
     is_assignment_admin = message.from_user.id in [OLGA_ID, YOUR_ADMIN_ID]
     
     # Проверяем, является ли сообщение заданием (содержит ключевые слова)
     is_assignment = False
-    if is_assignment_admin and message.content_type == "text":
+    message_text = message.text or message.caption or ""
+    if is_assignment_admin and message_text:
         assignment_keywords = ["задание", "упражнение", "задача", "домашнее", "homework", "exercise", "task"]
-        if any(keyword in message.text.lower() for keyword in assignment_keywords):
+        if any(keyword in message_text.lower() for keyword in assignment_keywords):
             is_assignment = True
     
-    for uid, u in users_data.items():
-        if broadcast_to_all:
-            should_send = True
-        elif selected_levels:
-            should_send = u.get("level") in selected_levels
-        else:
-            should_send = False
-        
-        if should_send:
-            recipients.append(uid)
-            full_name = f"{u['name']} {u.get('surname','')}".strip()
-            recipient_names.append(full_name)
+    # Получатели — через индекс аудитории (уровни, активность, ветка и т.д.)
+    audience = data.get("audience")
+    if audience is None and (broadcast_to_all or selected_levels):
+        audience = {"levels": [] if broadcast_to_all else selected_levels}
+    if audience is not None:
+        recipients, skipped_unreachable = select_audience(audience, users_data)
+        selected_levels = audience.get("levels", [])
+        broadcast_to_all = not selected_levels
+    else:
+        skipped_unreachable = 0
+    recipient_names = [f"{users_data[uid]['name']} {users_data[uid].get('surname','')}".strip()
+                       for uid in recipients]
     
     # Если это задание от администратора, предлагаем отправить как задание
     if is_assignment and is_assignment_admin:
@@ -2778,11 +5112,17 @@ async def admin_send_message(message, state):
             InlineKeyboardButton("✅ Отправить как ЗАДАНИЕ", callback_data="send_as_assignment"),
             InlineKeyboardButton("📢 Просто рассылка", callback_data="confirm_send")
         )
+        kb.add(
+            InlineKeyboardButton("🕒 Задание позже", callback_data="schedule_send:assignment"),
+            InlineKeyboardButton("🕒 Рассылка позже", callback_data="schedule_send:message")
+        )
         kb.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel_send"))
         
         preview_text = f"📚 <b>ОБНАРУЖЕНО ЗАДАНИЕ ОТ АДМИНИСТРАТОРА</b>\n\n"
         
-        if broadcast_to_all:
+        if data.get("audience") is not None:
+            target = "выбранной аудитории\n" + describe_audience(audience, users_data)
+        elif broadcast_to_all:
             target = "ВСЕМ ученикам"
         elif selected_levels:
             target = f"ученикам уровней: {', '.join(selected_levels)}"
@@ -2791,11 +5131,16 @@ async def admin_send_message(message, state):
             
         preview_text += f"• Кому: {target}\n"
         preview_text += f"• Получателей-учеников: {len(recipients)}\n"
+        if skipped_unreachable:
+            preview_text += f"• Пропущено недоступных: {skipped_unreachable}\n"
         preview_text += f"• Тип: задание\n\n"
-        preview_text += f"<b>Текст задания:</b>\n{message.text[:300]}..."
+        if album:
+            preview_text += f"• Альбом: {len(album)} файлов\n\n"
+        preview_text += f"<b>Текст задания:</b>\n{message_text[:300]}..."
         
         await state.update_data(
             message_to_send=message,
+            album=album_items(album) if album else None,
             recipients=recipients,
             recipient_names=recipient_names,
             selected_levels=selected_levels,
@@ -2812,8 +5157,11 @@ async def admin_send_message(message, state):
         InlineKeyboardButton("✅ Отправить", callback_data="confirm_send"),
         InlineKeyboardButton("❌ Отмена", callback_data="cancel_send")
     )
+    kb.add(InlineKeyboardButton("🕒 Запланировать", callback_data="schedule_send:message"))
     
-    if broadcast_to_all:
+    if data.get("audience") is not None:
+        target = "выбранной аудитории\n" + describe_audience(audience, users_data)
+    elif broadcast_to_all:
         target = "ВСЕМ пользователям"
     elif selected_levels:
         target = f"уровням: {', '.join(selected_levels)}"
@@ -2823,7 +5171,9 @@ async def admin_send_message(message, state):
     preview_text = f"📢 <b>Подтверждение рассылки</b>\n\n"
     preview_text += f"• Кому: {target}\n"
     preview_text += f"• Получателей: {len(recipients)}\n"
-    preview_text += f"• Тип: {message.content_type}\n\n"
+    if skipped_unreachable:
+        preview_text += f"• Пропущено недоступных (заблокировали бота): {skipped_unreachable}\n"
+    preview_text += f"• Тип: {f'альбом ({len(album)} файлов)' if album else message.content_type}\n\n"
     
     if message.content_type == "text":
         preview_text += f"<b>Текст:</b>\n{message.text[:200]}..."
@@ -2832,6 +5182,7 @@ async def admin_send_message(message, state):
     
     await state.update_data(
         message_to_send=message,
+        album=album_items(album) if album else None,
         recipients=recipients,
         recipient_names=recipient_names,
         selected_levels=selected_levels,
@@ -2841,168 +5192,920 @@ async def admin_send_message(message, state):
     
     await message.answer(preview_text, reply_markup=kb)
 
-# --- ОТПРАВКА КАК ЗАДАНИЕ ---
-@dp.callback_query_handler(lambda c: c.data == "send_as_assignment", state=Form.admin_message)
-async def send_as_assignment(callback: types.CallbackQuery, state):
-    """Администратор отправляет задание ученикам"""
-    data = await state.get_data()
-    message = data.get("message_to_send")
-    selected_levels = data.get("selected_levels", [])
-    broadcast_to_all = data.get("broadcast_to_all", False)
+# --- СТАТУС ВЫПОЛНЕНИЯ ЗАДАНИЙ ---
+# assignment_status[id]: состояние каждого получателя и готовые счетчики по наставникам и в целом,
+# чтобы страница статуса не пересчитывала получателей и решения при каждом открытии
+ASSIGNMENT_STATES = ("sent", "submitted", "replied", "failed")
+
+def assignment_status(assignments_data, assignment_id):
+    """Индекс статусов задания (создается пустым при первом обращении)"""
+    return assignments_data.setdefault("assignment_status", {}).setdefault(
+        assignment_id, {"students": {}, "mentors": {}, "total": dict.fromkeys(ASSIGNMENT_STATES, 0)})
+
+def set_recipient_state(status, student_id, state, mentor_id=None):
+    """Перевести получателя в новое состояние, поправив счетчики; False, если ничего не изменилось"""
+    entry = status["students"].get(student_id)
+    if entry is not None:
+        if entry["state"] == state:
+            return False
+        old_counts = status["mentors"].get(str(entry.get("mentor_id")))
+        if old_counts is not None:
+            old_counts[entry["state"]] -= 1
+        status["total"][entry["state"]] -= 1
+        mentor_id = entry.get("mentor_id") if mentor_id is None else mentor_id
+    
+    status["students"][student_id] = {"state": state, "mentor_id": mentor_id}
+    counts = status["mentors"].setdefault(str(mentor_id), dict.fromkeys(ASSIGNMENT_STATES, 0))
+    counts[state] += 1
+    status["total"][state] += 1
+    return True
+
+def index_student_assignment(assignments_data, student_id, assignment_id):
+    """Добавить задание в список заданий ученика (вызывается, когда ученик впервые попал в статус задания)"""
+    assignments_data.setdefault("student_assignments", {}).setdefault(str(student_id), []).append(assignment_id)
+
+def mark_assignment_submitted(assignments_data, assignment_id, student_id, mentor_id):
+    """Ученик прислал решение (повторное решение ученика не считается вторым)"""
+    status = assignment_status(assignments_data, assignment_id)
+    if student_id not in status["students"]:
+        index_student_assignment(assignments_data, student_id, assignment_id)
+    changed = set_recipient_state(status, student_id, "submitted", mentor_id)
+    update_menu_counters(assignments_data, student_id)
+    return changed
+
+def mark_assignment_replied(assignments_data, assignment_id, student_id):
+    """Наставник ответил ученику по заданию"""
+    status = assignments_data.get("assignment_status", {}).get(assignment_id)
+    entry = status["students"].get(student_id) if status else None
+    if entry is None or entry["state"] == "failed":
+        return False
+    changed = set_recipient_state(status, student_id, "replied")
+    update_menu_counters(assignments_data, student_id)
+    return changed
+
+def migrate_student_assignments(assignments_data):
+    """Собрать списки заданий учеников из индекса статусов (в порядке создания заданий)"""
+    if "student_assignments" in assignments_data:
+        return False
+    assignments_data["student_assignments"] = {}
+    assignments = assignments_data.get("assignments", {})
+    ordered = sorted(assignments_data.get("assignment_status", {}),
+                     key=lambda aid: assignments.get(aid, {}).get("timestamp") or 0)
+    for assignment_id in ordered:
+        for student_id, entry in assignments_data["assignment_status"][assignment_id]["students"].items():
+            if entry["state"] != "failed":
+                index_student_assignment(assignments_data, student_id, assignment_id)
+    log_info(f"🔄 Собраны списки заданий: {len(assignments_data['student_assignments'])} учеников")
+    return True
+
+def migrate_assignment_status(assignments_data):
+    """Построить индекс статусов для заданий, созданных до его появления"""
+    statuses = assignments_data.setdefault("assignment_status", {})
+    missing = [aid for aid in assignments_data.get("assignments", {}) if aid not in statuses]
+    if not missing:
+        return False
     
-    await callback.message.edit_text(f"📚 Создаю задание...")
+    replied = {(rec.get("a"), str(rec["t"])) for rec in assignments_data.get("conversations", [])
+               if rec.get("r") and rec.get("a")}
+    all_recipients = assignments_data.get("assignment_recipients", {})
+    for assignment_id in missing:
+        status = assignment_status(assignments_data, assignment_id)
+        for recipient in all_recipients.get(assignment_id, []):
+            state = "sent" if recipient.get("status", "sent") == "sent" else "failed"
+            set_recipient_state(status, recipient["student_id"], state, recipient.get("mentor_id"))
+        for solution in assignments_data["assignments"][assignment_id].get("solutions_sent", []):
+            set_recipient_state(status, solution["student_id"], "submitted", solution.get("mentor_id"))
+        for student_id, entry in status["students"].items():
+            if entry["state"] == "submitted" and (assignment_id, student_id) in replied:
+                set_recipient_state(status, student_id, "replied")
+    log_info(f"🔄 Построен индекс статусов для {len(missing)} заданий")
+    return True
+
+# --- СРОКИ СДАЧИ ЗАДАНИЙ ---
+# assignment["deadline"] — срок сдачи (мс). Напоминания лежат в deadline_reminders — списке
+# [когда, ID задания, часов до срока], отсортированном по времени: планировщик берет только
+# наступившие записи с начала списка. Несдавшие — ученики в состоянии sent из индекса статусов.
+DEADLINE_REMINDER_HOURS = sorted({int(h) for h in os.getenv("DEADLINE_REMINDER_HOURS", "24,2").split(",") if h.strip()},
+                                 reverse=True)
+
+class NextDue:
+    """Ближайший срок фоновой задачи в памяти: файл читается, только когда срок наступил"""
     
-    # Загружаем данные
-    users_data = load_users()["users"]
+    def __init__(self):
+        self.at = None   # None — срок неизвестен, при следующей проверке прочитать файл
+    
+    def is_due(self, now):
+        return self.at is None or now >= self.at
+    
+    def lower(self, at):
+        """Новое событие не позже известного срока (только сдвигает срок раньше)"""
+        if self.at is not None and at < self.at:
+            self.at = at
+    
+    def set(self, at):
+        """Точный срок после прочтения файла (None — событий нет)"""
+        self.at = math.inf if at is None else at
+
+deadline_next_due = NextDue()
+
+def set_assignment_deadline(assignments_data, assignment_id, deadline, now=None):
+    """Установить (или снять при None) срок и перепланировать напоминания; возвращает их время"""
+    now = now or now_ms()
+    reminders = [r for r in assignments_data.get("deadline_reminders", []) if r[1] != assignment_id]
+    assignment = assignments_data["assignments"][assignment_id]
+    planned = []
+    if deadline is None:
+        assignment.pop("deadline", None)
+    else:
+        assignment["deadline"] = deadline
+        for hours in DEADLINE_REMINDER_HOURS:
+            due = deadline - hours * 3600000
+            if due > now:
+                bisect.insort(reminders, [due, assignment_id, hours])
+                planned.append(due)
+                deadline_next_due.lower(due)
+    assignments_data["deadline_reminders"] = reminders
+    return planned
+
+def take_due_reminders(assignments_data, now):
+    """Снять с начала списка наступившие напоминания"""
+    reminders = assignments_data.get("deadline_reminders", [])
+    count = bisect.bisect_right(reminders, [now, "\uffff", 0])
+    due = reminders[:count]
+    del reminders[:count]
+    return due
+
+def next_reminder_due(assignments_data):
+    """Время ближайшего оставшегося напоминания (None — напоминаний нет)"""
+    reminders = assignments_data.get("deadline_reminders", [])
+    return reminders[0][0] if reminders else None
+
+def pending_students(assignments_data, assignment_id):
+    """Ученики, получившие задание и еще не сдавшие: {ID ученика: ID наставника}"""
+    status = assignments_data.get("assignment_status", {}).get(assignment_id, {"students": {}})
+    return {sid: entry.get("mentor_id") for sid, entry in status["students"].items() if entry["state"] == "sent"}
+
+def reminder_job_sender(job):
+    """Напоминание ученику с кнопкой сдачи задания"""
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("📤 Отправить решение наставнику",
+                                callback_data=f"send_solution_to_mentor:{job['assignment_id']}"))
+    return payload_sender("text", job["payload"], reply_markup=kb)
+
+async def send_deadline_reminder(assignment_id, hours):
+    """Напомнить несдавшим (массовой рассылкой) и отправить наставникам сводку по их ученикам"""
+    send_priority.set(PRIORITY_NOTIFICATION)
     assignments_data = load_assignments()
+    assignment = assignments_data.get("assignments", {}).get(assignment_id)
+    if not assignment or not assignment.get("deadline"):
+        return
+    pending = pending_students(assignments_data, assignment_id)
+    if not pending:
+        return
     
-    # Создаем уникальный ID для задания
-    assignment_id = f"assignment_{message.from_user.id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    deadline = format_ms(assignment["deadline"])
+    title = assignment_title(assignment, 200)
+    users = load_users()["users"]
     
-    # Получаем имя администратора
-    admin_name = "Ольга" if callback.from_user.id == OLGA_ID else "Суперадмин"
+    by_mentor = {}
+    for student_id, mentor_id in pending.items():
+        student = users.get(student_id, {})
+        by_mentor.setdefault(str(mentor_id), []).append(f"{student.get('name', '?')} {student.get('surname', '')}".strip())
+    for mentor_id, names in by_mentor.items():
+        if mentor_id not in users:
+            continue
+        text = (f"⏰ <b>До срока сдачи задания ~{hours} ч</b> ({deadline})\n\n{title}\n\n"
+                f"Не сдали ({len(names)}): {', '.join(names[:30])}")
+        if len(names) > 30:
+            text += f" и еще {len(names) - 30}"
+        try:
+            await bot.send_message(mentor_id, text)
+        except Exception as e:
+            log_error(f"❌ Не удалось отправить сводку по сроку наставнику {mentor_id}: {e}")
+    
+    text = (f"⏰ <b>Напоминание о задании</b>\n\n{title}\n\n"
+            f"Срок сдачи: <b>{deadline}</b> (осталось ~{hours} ч)")
+    job = create_broadcast_job("reminder", assignment.get("admin_id", YOUR_ADMIN_ID), list(pending), "text", text,
+                               assignment_id=assignment_id)
+    counts = await run_broadcast_job(job)
+    log_info(f"⏰ Напоминание по {assignment_id} ({hours} ч): отправлено {counts['sent']} из {len(pending)}")
+
+async def deadline_scheduler():
+    """Запуск наступивших напоминаний о сроках"""
+    send_priority.set(PRIORITY_NOTIFICATION)
+    while True:
+        try:
+            now = now_ms()
+            # До ближайшего напоминания assignments.json не читаем
+            if deadline_next_due.is_due(now):
+                
+                def take(uow):
+                    due = take_due_reminders(uow.assignments, now)
+                    if due:
+                        uow.stage("assignments")
+                    return due, next_reminder_due(uow.assignments)
+                
+                # Снятие с сохранением до отправки: после перезапуска напоминание не повторится
+                ok, result = await run_transaction(take)
+                if ok:
+                    due, next_due = result
+                    deadline_next_due.set(next_due)
+                    for _, assignment_id, hours in due:
+                        asyncio.ensure_future(send_deadline_reminder(assignment_id, hours))
+        except Exception as e:
+            log_error(f"❌ Ошибка планировщика сроков: {e}")
+        await asyncio.sleep(SCHEDULER_INTERVAL)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("set_deadline:"))
+async def set_deadline_start(callback: types.CallbackQuery, state):
+    """Администратор задает срок сдачи задания"""
+    if callback.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        await callback.answer("Только для администраторов", show_alert=True)
+        return
+    await state.update_data(deadline_assignment=callback.data.split(":", 1)[1])
+    await Form.assignment_deadline.set()
+    await callback.message.answer(
+        "⏰ <b>Срок сдачи задания</b>\n\n"
+        "Отправьте дату и время: <code>25.12 18:00</code>, <code>25.12.2025 18:00</code> "
+        "или <code>18:00</code> (ближайшее).\n"
+        "Чтобы снять срок, отправьте <code>-</code>.\n\n"
+        f"Напоминания несдавшим: за {', '.join(str(h) for h in DEADLINE_REMINDER_HOURS)} ч до срока."
+    )
+    await callback.answer()
+
+@dp.message_handler(state=Form.assignment_deadline)
+async def set_deadline_time(message: types.Message, state):
+    text = (message.text or "").strip()
+    deadline = None if text == "-" else parse_schedule_time(text)
+    if text != "-" and deadline is None:
+        await message.answer("❌ Не понял время. Пример: <code>25.12 18:00</code>")
+        return
+    if deadline is not None and deadline <= now_ms():
+        await message.answer("❌ Это время уже прошло, укажите будущее")
+        return
+    
+    assignment_id = (await state.get_data()).get("deadline_assignment")
+    
+    def apply(uow):
+        if assignment_id not in uow.assignments.get("assignments", {}):
+            return None
+        uow.stage("assignments")
+        return set_assignment_deadline(uow.assignments, assignment_id, deadline)
+    
+    ok, planned = await run_transaction(apply)
+    await state.finish()
+    if not ok:
+        await message.answer("❌ Ошибка сохранения срока")
+    elif planned is None:
+        await message.answer("❌ Задание не найдено")
+    elif deadline is None:
+        await message.answer("✅ Срок сдачи снят, напоминания отменены")
+    else:
+        await message.answer(
+            f"✅ Срок сдачи: <b>{format_ms(deadline)}</b>\n"
+            f"Напоминаний запланировано: {len(planned)}"
+            + (f" (первое — {format_ms(planned[0])})" if planned else "")
+        )
+
+# --- ОТПРАВКА КАК ЗАДАНИЕ ---
+def create_assignment(admin_id, content_type, payload, caption=None, album=None, levels=None):
+    """Новое задание в assignments.json (получатели дописываются по ходу рассылки); None при ошибке"""
+    admin_name = "Ольга" if int(admin_id) == OLGA_ID else "Суперадмин"
+    assignments_data = load_assignments()
+    existing = assignments_data.setdefault("assignments", {})
+    # Задания, запланированные на одну минуту, создаются в одну секунду — им нужен суффикс
+    base_id = assignment_id = f"assignment_{admin_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    suffix = 1
+    while assignment_id in existing:
+        suffix += 1
+        assignment_id = f"{base_id}_{suffix}"
     
-    # Собираем информацию о задании
     assignment_info = {
         "assignment_id": assignment_id,
         "from_admin": True,
-        "admin_id": str(callback.from_user.id),
+        "admin_id": str(admin_id),
         "admin_name": admin_name,
-        "levels": selected_levels if not broadcast_to_all else ["ALL"],
-        "timestamp": str(datetime.now()),
-        "content_type": message.content_type,
+        "levels": levels or ["ALL"],
+        "timestamp": now_ms(),
+        "content_type": content_type,
         "sent_count": 0
     }
+    if content_type == "text":
+        assignment_info["text"] = payload
+    elif payload is not None:
+        assignment_info[LEGACY_FILE_FIELDS.get(content_type, f"{content_type}_data")] = payload
+        assignment_info["caption"] = caption
+    if album:
+        assignment_info["album"] = album
+    
+    existing[assignment_id] = assignment_info
+    assignments_data.setdefault("assignment_recipients", {})[assignment_id] = []
+    assignment_status(assignments_data, assignment_id)
+    return assignment_info if save_assignments(assignments_data) else None
+
+# Типы с подписью: заголовок задания и кнопка ставятся прямо в копию
+CAPTION_TYPES = ("photo", "video", "document", "audio", "voice", "animation")
+
+def assignment_job_sender(job):
+    """Функция отправки задания ученику (клавиатура собирается один раз на задание)"""
+    kb_student = InlineKeyboardMarkup()
+    kb_student.add(
+        InlineKeyboardButton("📤 Отправить решение наставнику", 
+                            callback_data=f"send_solution_to_mentor:{job['assignment_id']}")
+    )
+    header = f"📚 <b>НОВОЕ ЗАДАНИЕ ОТ {job['admin_name'].upper()}</b>"
+    footer = "<i>Нажмите кнопку ниже, чтобы отправить решение вашему наставнику</i>"
+    content_type = job["content_type"]
+    
+    # Текст копией не изменить — отправляем с заголовком
+    if content_type == "text" and not job.get("album"):
+        return payload_sender("text", f"{header}\n\n{job['payload']}\n\n{footer}", reply_markup=kb_student)
+    
+    caption = f"{header}\n\n{job.get('caption') or ''}\n\n{footer}"
+    if job.get("album"):
+        send_content = album_sender(job["album"])
+    elif not job.get("source"):
+        return payload_sender(content_type, job["payload"], caption, reply_markup=kb_student)
+    elif content_type in CAPTION_TYPES:
+        return copy_sender(job["source"], caption=caption, reply_markup=kb_student)
+    else:
+        send_content = copy_sender(job["source"])
     
-    if message.content_type == "text":
-        assignment_info["text"] = message.text
-    elif message.content_type == "photo":
-        assignment_info["photo_id"] = message.photo[-1].file_id
-        assignment_info["caption"] = message.caption
-    elif message.content_type == "document":
-        assignment_info["document_id"] = message.document.file_id
-        assignment_info["caption"] = message.caption
-    elif message.content_type == "voice":
-        assignment_info["voice_id"] = message.voice.file_id
-    elif message.content_type == "video":
-        assignment_info["video_id"] = message.video.file_id
-        assignment_info["caption"] = message.caption
-    
-    # Отправляем задание всем ученикам выбранных уровней
-    sent_to_students = []
-    failed_students = []
-    
-    for uid, u in users_data.items():
-        # Проверяем, что пользователь ученик (не админ) и его уровень в выбранных
-        if (broadcast_to_all or u.get("level") in selected_levels) and int(uid) not in [OLGA_ID, YOUR_ADMIN_ID]:
-            
-            try:
-                # Создаем клавиатуру для ученика
-                kb_student = InlineKeyboardMarkup()
-                kb_student.add(
-                    InlineKeyboardButton("📤 Отправить решение наставнику", 
-                                        callback_data=f"send_solution_to_mentor:{assignment_id}")
-                )
-                
-                # Отправляем задание ученику
-                if message.content_type == "text":
-                    await bot.send_message(
-                        uid,
-                        f"📚 <b>НОВОЕ ЗАДАНИЕ ОТ {admin_name.upper()}</b>\n\n"
-                        f"{message.text}\n\n"
-                        f"<i>Нажмите кнопку ниже, чтобы отправить решение вашему наставнику</i>",
-                        reply_markup=kb_student,
-                        parse_mode="HTML"
-                    )
-                elif message.content_type == "photo":
-                    await bot.send_photo(
-                        uid,
-                        message.photo[-1].file_id,
-                        caption=f"📚 <b>НОВОЕ ЗАДАНИЕ ОТ {admin_name.upper()}</b>\n\n"
-                               f"{message.caption or ''}\n\n"
-                               f"<i>Нажмите кнопку ниже, чтобы отправить решение вашему наставнику</i>",
-                        reply_markup=kb_student,
-                        parse_mode="HTML"
-                    )
-                
-                sent_to_students.append({
-                    "student_id": uid,
-                    "student_name": f"{u['name']} {u.get('surname','')}".strip(),
-                    "mentor_id": u.get("mentor"),
-                    "level": u.get("level")
-                })
-                
-                assignment_info["sent_count"] += 1
-                
-            except Exception as e:
-                failed_students.append(f"{u['name']} {u.get('surname','')}")
-                log_error(f"Ошибка отправки задания ученику {uid}: {e}")
+    if send_content is None:
+        return None
+    
+    # Альбом и типы без подписи: кнопка задания — отдельным сообщением следом
+    send_notice = payload_sender("text", f"{header}\n\n{footer}", reply_markup=kb_student)
+    
+    async def send(uid):
+        await send_content(uid)
+        await send_notice(uid)
+    return send
+
+def delivered_recipients(recipients):
+    """Получатели задания, которым оно действительно доставлено (старые записи — без статуса)"""
+    return [r for r in recipients if r.get("status", "sent") == "sent"]
+
+def record_assignment_recipients(job, results):
+    """Записать в assignment_recipients результат по каждому ученику пачки (sent/failed/blocked)"""
+    if not results:
+        return
+    
+    users_data = load_users()["users"]
+    assignments_data = load_assignments()
+    assignment_id = job["assignment_id"]
+    recipients = assignments_data.setdefault("assignment_recipients", {}).setdefault(assignment_id, [])
+    status_index = assignment_status(assignments_data, assignment_id)
+    
+    for uid, status in results.items():
+        u = users_data.get(uid, {})
+        entry = status_index["students"].get(uid)
+        # Ученик мог успеть сдать решение, пока шла пачка (RetryAfter, пауза) — его статус не откатываем
+        if status == "sent" and (entry is None or entry["state"] == "failed"):
+            index_student_assignment(assignments_data, uid, assignment_id)
+            set_recipient_state(status_index, uid, "sent", u.get("mentor"))
+        elif entry is None:
+            set_recipient_state(status_index, uid, "failed", u.get("mentor"))
+        recipients.append({
+            "student_id": uid,
+            "student_name": f"{u.get('name', '?')} {u.get('surname','')}".strip(),
+            "mentor_id": u.get("mentor"),
+            "level": u.get("level"),
+            "status": status,
+            "ts": now_ms()
+        })
+    
+    update_menu_counters(assignments_data, *results)
+    
+    delivered = sum(1 for status in results.values() if status == "sent")
+    assignment = assignments_data.get("assignments", {}).get(assignment_id)
+    if assignment is not None:
+        assignment["sent_count"] = assignment.get("sent_count", 0) + delivered
+    
+    save_assignments(assignments_data)
+
+@dp.callback_query_handler(lambda c: c.data == "send_as_assignment", state=Form.admin_message)
+async def send_as_assignment(callback: types.CallbackQuery, state):
+    """Администратор отправляет задание ученикам"""
+    data = await state.get_data()
+    message = data.get("message_to_send")
+    selected_levels = data.get("selected_levels", [])
+    broadcast_to_all = data.get("broadcast_to_all", False)
+    
+    await callback.message.edit_text(f"📚 Создаю задание...")
+    
+    content_type, payload, caption = message_payload(message)
+    assignment_info = create_assignment(callback.from_user.id, content_type, payload, caption, data.get("album"),
+                                        selected_levels if not broadcast_to_all else ["ALL"])
+    if assignment_info is None:
+        await callback.message.edit_text("❌ Ошибка сохранения задания")
+        await state.finish()
+        return
+    assignment_id = assignment_info["assignment_id"]
+    admin_name = assignment_info["admin_name"]
     
-    # Сохраняем задание
-    assignments_data.setdefault("assignments", {})[assignment_id] = assignment_info
+    # Ученики из выбранной аудитории (без администраторов)
+    recipients = [uid for uid in data.get("recipients", []) if int(uid) not in [OLGA_ID, YOUR_ADMIN_ID]]
     
-    # Сохраняем информацию о том, кому отправлено
-    assignments_data.setdefault("assignment_recipients", {})[assignment_id] = sent_to_students
+    job = create_broadcast_job("assignment", callback.from_user.id, recipients, content_type, payload, caption,
+                               assignment_id=assignment_id, admin_name=admin_name,
+                               source=[message.chat.id, message.message_id], album=data.get("album"),
+                               report=[callback.message.chat.id, callback.message.message_id])
+    if assignment_job_sender(job) is None:
+        log_error(f"❌ Тип задания {content_type} не поддерживается для рассылки")
+    
+    # Задача уже сохранена и сама правит сообщение о ходе: состояние администратора освобождаем
+    # сразу, иначе новое сообщение во время рассылки попало бы в этот черновик
+    await state.finish()
+    await callback.answer()
+    asyncio.ensure_future(finish_assignment_job(job, callback.message, selected_levels, broadcast_to_all))
+
+async def finish_assignment_job(job, report_message, selected_levels, broadcast_to_all):
+    """Разослать задание в фоне и заменить сообщение о ходе отчетом"""
+    try:
+        await run_broadcast_job(job, ProgressReporter(job, "📚 Рассылаю задание"))
+        report_text, kb_admin = render_assignment_report(job, selected_levels, broadcast_to_all)
+        await report_message.edit_text(report_text, reply_markup=kb_admin, parse_mode="HTML")
+    except Exception as e:
+        log_error(f"❌ Ошибка рассылки задания {job.get('assignment_id')}: {e}")
+
+def render_assignment_report(job, selected_levels, broadcast_to_all):
+    """Отчет администратору о разосланном задании: текст и кнопки"""
+    assignment_id = job["assignment_id"]
+    users_data = load_users()["users"]
+    recipient_records = load_assignments().get("assignment_recipients", {}).get(assignment_id, [])
+    sent_to_students = delivered_recipients(recipient_records)
+    failed_students = [r["student_name"] for r in recipient_records if r.get("status") in ("failed", "blocked")]
     
-    if save_assignments(assignments_data):
-        # Формируем отчет для администратора
+    # Формируем отчет для администратора
+    if job["state"] == "cancelled":
+        report_text = f"⏹ <b>Рассылка задания остановлена</b>\n\n"
+    else:
         report_text = f"✅ <b>Задание успешно отправлено!</b>\n\n"
-        report_text += f"• ID задания: <code>{assignment_id}</code>\n"
+    report_text += f"• ID задания: <code>{assignment_id}</code>\n"
+    
+    if broadcast_to_all:
+        report_text += f"• Все ученики\n"
+    else:
+        report_text += f"• Уровни: {', '.join(selected_levels)}\n"
         
-        if broadcast_to_all:
-            report_text += f"• Все ученики\n"
-        else:
-            report_text += f"• Уровни: {', '.join(selected_levels)}\n"
-            
-        report_text += f"• Отправлено ученикам: {len(sent_to_students)}\n"
-        
-        if sent_to_students:
-            report_text += f"\n<b>Получили задание:</b>\n"
-            for i, student in enumerate(sent_to_students[:20], 1):  # Показываем первые 20
-                mentor_info = ""
-                if student["mentor_id"] and student["mentor_id"] in users_data:
-                    mentor = users_data[student["mentor_id"]]
-                    mentor_info = f" → {mentor['name']}"
-                report_text += f"{i}. {student['student_name']}{mentor_info}\n"
-            
-            if len(sent_to_students) > 20:
-                report_text += f"... и еще {len(sent_to_students) - 20} учеников\n"
-        
-        if failed_students:
-            report_text += f"\n❌ <b>Не отправлено ({len(failed_students)}):</b>\n"
-            report_text += ", ".join(failed_students[:10])
-            if len(failed_students) > 10:
-                report_text += f"... и еще {len(failed_students) - 10}"
-        
-        # Кнопки для администратора
-        kb_admin = InlineKeyboardMarkup()
-        kb_admin.add(
-            InlineKeyboardButton("📊 Статус выполнения", callback_data=f"check_assignment:{assignment_id}"),
-            InlineKeyboardButton("📝 Новое задание", callback_data="admin_broadcast")
-        )
+    report_text += f"• Отправлено ученикам: {len(sent_to_students)}\n"
+    
+    if sent_to_students:
+        report_text += f"\n<b>Получили задание:</b>\n"
+        for i, student in enumerate(sent_to_students[:20], 1):  # Показываем первые 20
+            mentor_info = ""
+            if student["mentor_id"] and student["mentor_id"] in users_data:
+                mentor = users_data[student["mentor_id"]]
+                mentor_info = f" → {mentor['name']}"
+            report_text += f"{i}. {student['student_name']}{mentor_info}\n"
         
-        await callback.message.edit_text(report_text, reply_markup=kb_admin, parse_mode="HTML")
+        if len(sent_to_students) > 20:
+            report_text += f"... и еще {len(sent_to_students) - 20} учеников\n"
+    
+    if failed_students:
+        report_text += f"\n❌ <b>Не отправлено ({len(failed_students)}):</b>\n"
+        report_text += ", ".join(failed_students[:10])
+        if len(failed_students) > 10:
+            report_text += f"... и еще {len(failed_students) - 10}"
+    
+    # Кнопки для администратора
+    kb_admin = InlineKeyboardMarkup()
+    kb_admin.add(
+        InlineKeyboardButton("📊 Статус выполнения", callback_data=f"check_assignment:{assignment_id}"),
+        InlineKeyboardButton("📝 Новое задание", callback_data="admin_broadcast")
+    )
+    kb_admin.add(InlineKeyboardButton("⏰ Установить срок сдачи", callback_data=f"set_deadline:{assignment_id}"))
+    return report_text, kb_admin
+
+# --- ВХОДЯЩИЕ РЕШЕНИЯ НАСТАВНИКА ---
+# mentor_inbox[mentor_id]: решения в порядке поступления с флагами «прочитано» и «есть ответ»
+# и счетчик непрочитанных — список открывается без перебора всех решений
+INBOX_PAGE_SIZE = 5
+
+def mentor_inbox(assignments_data, mentor_id):
+    """Входящие наставника (создаются пустыми при первом обращении)"""
+    return assignments_data.setdefault("mentor_inbox", {}).setdefault(str(mentor_id), {"items": [], "unread": 0})
+
+def inbox_add_solution(assignments_data, mentor_id, solution_id):
+    """Новое решение — в конец входящих, непрочитанным"""
+    inbox = mentor_inbox(assignments_data, mentor_id)
+    inbox["items"].append({"id": solution_id, "read": 0, "replied": 0})
+    inbox["unread"] += 1
+    update_menu_counters(assignments_data, mentor_id)
+
+def inbox_mark_read(inbox, items):
+    """Отметить показанные решения прочитанными; True, если что-то изменилось"""
+    changed = False
+    for item in items:
+        if not item["read"]:
+            item["read"] = 1
+            inbox["unread"] -= 1
+            changed = True
+    return changed
+
+def inbox_mark_replied(assignments_data, mentor_id, student_id, assignment_id):
+    """Отметить решения ученика по заданию, ждущие ответа, как отвеченные; возвращает их ID"""
+    inbox = assignments_data.get("mentor_inbox", {}).get(str(mentor_id))
+    if not inbox:
+        return []
+    prefix = f"solution_{student_id}_{assignment_id}_"
+    replied = []
+    for item in reversed(inbox["items"]):
+        if item["id"].startswith(prefix):
+            if item["replied"]:
+                break
+            inbox_mark_read(inbox, [item])
+            item["replied"] = 1
+            replied.append(item["id"])
+    update_menu_counters(assignments_data, mentor_id)
+    return replied
+
+def inbox_page(inbox, page):
+    """Страница входящих, новые сначала"""
+    end = len(inbox["items"]) - page * INBOX_PAGE_SIZE
+    return list(reversed(inbox["items"][max(0, end - INBOX_PAGE_SIZE):max(0, end)]))
+
+def migrate_mentor_inbox(assignments_data):
+    """Собрать входящие из уже сохраненных решений (старые решения считаются прочитанными)"""
+    if "mentor_inbox" in assignments_data:
+        return False
+    
+    replied = {(rec.get("a"), str(rec["t"])) for rec in assignments_data.get("conversations", [])
+               if rec.get("r") and rec.get("a")}
+    solutions = sorted(assignments_data.get("solutions", {}).values(), key=lambda x: x.get("timestamp") or 0)
+    assignments_data["mentor_inbox"] = {}
+    for solution in solutions:
+        inbox = mentor_inbox(assignments_data, solution.get("mentor_id"))
+        inbox["items"].append({
+            "id": solution["solution_id"],
+            "read": 1,
+            "replied": int((solution.get("assignment_id"), solution.get("student_id")) in replied)
+        })
+    log_info(f"🔄 Собраны входящие наставников: {len(solutions)} решений")
+    return True
+
+def mentor_unread_count(mentor_id, assignments_data=None):
+    """Число непрочитанных решений наставника"""
+    assignments_data = assignments_data if assignments_data is not None else load_assignments()
+    inbox = assignments_data.get("mentor_inbox", {}).get(str(mentor_id))
+    return inbox["unread"] if inbox else 0
+
+# --- СЧЕТЧИКИ КНОПОК МЕНЮ ---
+# Непрочитанные решения наставника и несданные задания ученика для кнопок меню держим в памяти:
+# функции входящих и статусов заданий обновляют счетчики затронутых пользователей сразу при изменении,
+# поэтому меню не читает assignments.json. Если запись assignments.json не удалась, счетчики
+# сбрасываются и один раз собираются заново при следующем обращении.
+menu_counters = {}  # uid -> {"unread", "pending", "assignments"}
+menu_counters_state = {"ready": False}
+
+def count_menu_counters(assignments_data, user_id):
+    user_id = str(user_id)
+    return {
+        "unread": mentor_unread_count(user_id, assignments_data),
+        "pending": len(student_assignment_entries(assignments_data, user_id)["sent"]),
+        "assignments": len(assignments_data.get("student_assignments", {}).get(user_id, [])),
+    }
+
+def update_menu_counters(assignments_data, *user_ids):
+    """Пересчитать счетчики пользователей, чьи входящие или задания изменились"""
+    if menu_counters_state["ready"]:
+        for user_id in user_ids:
+            menu_counters[str(user_id)] = count_menu_counters(assignments_data, user_id)
+
+def reset_menu_counters():
+    menu_counters.clear()
+    menu_counters_state["ready"] = False
+
+def get_menu_counters(user_id):
+    """Счетчики для меню (при первом обращении собираются для всех пользователей одной загрузкой)"""
+    if not menu_counters_state["ready"]:
+        assignments_data = load_assignments()
+        user_ids = set(assignments_data.get("mentor_inbox", {})) | set(assignments_data.get("student_assignments", {}))
+        menu_counters.clear()
+        for uid in user_ids:
+            menu_counters[uid] = count_menu_counters(assignments_data, uid)
+        menu_counters_state["ready"] = True
+    return menu_counters.get(str(user_id), {"unread": 0, "pending": 0, "assignments": 0})
+
+# --- СВОДКИ ДЛЯ НАСТАВНИКОВ ---
+# В режиме сводки (users[mentor]["digest_minutes"]) новые решения не отправляются наставнику
+# по одному: их ID копятся в mentor_inbox[mentor]["digest"], и раз в окно уходит одно сообщение.
+# Срочные решения (с пометкой из URGENT_MARKERS) идут сразу.
+DIGEST_WINDOW_MINUTES = int(os.getenv("DIGEST_WINDOW_MINUTES", "15"))
+DIGEST_CHECK_INTERVAL = 60   # Секунд между проверками сводок
+DIGEST_MAX_LINES = 20
+DIGEST_MAX_BUTTONS = 10
+URGENT_MARKERS = tuple(marker.strip().lower() for marker in os.getenv("URGENT_MARKERS", "срочно,urgent,!!!").split(",")
+                       if marker.strip())
+
+digest_next_due = NextDue()
+
+def is_urgent_solution(solution):
+    """Решение с пометкой срочности в тексте или подписи"""
+    text = (solution.get("text") or solution.get("caption") or "").lower()
+    return any(marker in text for marker in URGENT_MARKERS)
+
+def queue_digest_item(assignments_data, mentor_id, solution_id, window_minutes):
+    """Отложить уведомление о решении до ближайшей сводки"""
+    inbox = mentor_inbox(assignments_data, mentor_id)
+    if not inbox.get("digest"):
+        inbox["digest_since"] = now_ms()
+    inbox.setdefault("digest", []).append(solution_id)
+    digest_next_due.lower(inbox["digest_since"] + window_minutes * 60000)
+
+def render_digest(solution_ids, solutions):
+    """Текст сводки и кнопки ответа (по последнему решению каждого ученика)"""
+    text = f"🗂 <b>Новые решения учеников: {len(solution_ids)}</b>\n\n"
+    for i, solution_id in enumerate(solution_ids[:DIGEST_MAX_LINES], 1):
+        solution = solutions.get(solution_id, {})
+        preview = solution.get("text") or solution.get("caption") or CONTENT_TYPE_LABELS.get(solution.get("content_type"), "")
+        preview = " ".join(str(preview).split())
+        text += (f"{i}. <b>{solution.get('student_name', 'Ученик')}</b> "
+                 f"({format_ms(solution.get('timestamp'), '%H:%M')})\n"
+                 f"   {html.escape(preview[:60])}\n")
+    if len(solution_ids) > DIGEST_MAX_LINES:
+        text += f"\n... и еще {len(solution_ids) - DIGEST_MAX_LINES}\n"
+    
+    latest = {}
+    for solution_id in solution_ids:
+        solution = solutions.get(solution_id)
+        if solution:
+            latest[solution["student_id"]] = solution
+    
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(*[InlineKeyboardButton(f"💬 {solution.get('student_name', 'Ученик')}",
+                                  callback_data=f"reply_to_student:{student_id}:{solution['assignment_id']}")
+             for student_id, solution in list(latest.items())[:DIGEST_MAX_BUTTONS]])
+    kb.add(InlineKeyboardButton("📥 Все решения", callback_data="view_student_solutions"))
+    return text, kb
+
+async def send_due_digests(now=None):
+    """Отправить сводки, окно которых истекло; возвращает число отправленных"""
+    now = now or now_ms()
+    # До ближайшего истечения окна assignments.json не читаем
+    if not digest_next_due.is_due(now):
+        return 0
+    
+    def take_due(uow):
+        inboxes = uow.assignments.get("mentor_inbox", {})
+        waiting = [mentor_id for mentor_id, inbox in inboxes.items() if inbox.get("digest")]
+        if not waiting:
+            return {}, {}, None
+        users = uow.users["users"]
+        due = {}
+        next_due = None
+        for mentor_id in waiting:
+            window = (users.get(mentor_id, {}).get("digest_minutes") or 0) * 60000
+            until = inboxes[mentor_id].get("digest_since", 0) + window
+            if now >= until:
+                due[mentor_id] = inboxes[mentor_id].pop("digest")
+                inboxes[mentor_id].pop("digest_since", None)
+            else:
+                next_due = until if next_due is None else min(next_due, until)
+        if due:
+            uow.stage("assignments")
+        return due, uow.assignments.get("solutions", {}), next_due
+    
+    # Сначала снимаем очередь сводки с сохранением, затем отправляем — без повторов после перезапуска
+    ok, result = await run_transaction(take_due)
+    if not ok:
+        return 0
+    due, solutions, next_due = result
+    digest_next_due.set(next_due)
+    for mentor_id, solution_ids in due.items():
+        text, kb = render_digest(solution_ids, solutions)
+        try:
+            await bot.send_message(mentor_id, text, reply_markup=kb)
+        except Exception as e:
+            log_error(f"❌ Не удалось отправить сводку наставнику {mentor_id}: {e}")
+    return len(due)
+
+async def mentor_digest_loop():
+    """Фоновая отправка сводок наставникам"""
+    send_priority.set(PRIORITY_NOTIFICATION)
+    while True:
+        await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+        try:
+            sent = await send_due_digests()
+            if sent:
+                log_info(f"🗂 Отправлено сводок наставникам: {sent}")
+        except Exception as e:
+            log_error(f"❌ Ошибка отправки сводок: {e}")
+
+@dp.callback_query_handler(lambda c: c.data == "toggle_digest")
+async def toggle_digest(callback: types.CallbackQuery):
+    """Наставник переключает уведомления о решениях: сразу или сводкой"""
+    user_id = str(callback.from_user.id)
+    users = load_users()["users"]
+    if user_id not in users:
+        await callback.answer("Вы не зарегистрированы", show_alert=True)
+        return
+    
+    if users[user_id].get("digest_minutes"):
+        update_user_record(user_id, unset=("digest_minutes",), users=users)
+        # Накопленная сводка уйдет при следующей проверке
+        digest_next_due.lower(now_ms())
+        text = "🔔 Решения учеников будут приходить сразу"
     else:
-        await callback.message.edit_text("❌ Ошибка сохранения задания")
+        update_user_record(user_id, {"digest_minutes": DIGEST_WINDOW_MINUTES}, users=users)
+        text = f"🗂 Решения учеников будут приходить сводкой раз в {DIGEST_WINDOW_MINUTES} мин. Срочные — сразу."
+    
+    await callback.answer(text, show_alert=True)
+    await mentor_main_menu(callback.from_user.id)
+
+# --- МЕТРИКИ НАСТАВНИКОВ ---
+# mentor_metrics[mentor_id] обновляется при каждом решении и ответе (без пересчета по истории):
+#   open — решений без ответа, replies — ответов всего, daily — ответов по дням (METRICS_DAYS),
+#   response_ms — время до первого ответа по последним RESPONSE_SAMPLE_SIZE решениям.
+METRICS_DAYS = 30
+RESPONSE_SAMPLE_SIZE = 200
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")        # Файл для node_exporter textfile collector
+METRICS_TEXTFILE_INTERVAL = 60
+
+def mentor_metrics(assignments_data, mentor_id):
+    """Метрики наставника (создаются пустыми при первом обращении)"""
+    return assignments_data.setdefault("mentor_metrics", {}).setdefault(
+        str(mentor_id), {"open": 0, "replies": 0, "daily": {}, "response_ms": []})
+
+def metrics_solution_submitted(assignments_data, mentor_id):
+    mentor_metrics(assignments_data, mentor_id)["open"] += 1
+
+def metrics_reply(assignments_data, mentor_id, solution_timestamps, now=None):
+    """Ответ наставника: время до первого ответа по каждому закрытому решению и счетчик за день"""
+    now = now or now_ms()
+    metrics = mentor_metrics(assignments_data, mentor_id)
+    metrics["replies"] += 1
+    day = ms_to_datetime(now).strftime("%Y-%m-%d")
+    metrics["daily"][day] = metrics["daily"].get(day, 0) + 1
+    if len(metrics["daily"]) > METRICS_DAYS:
+        for old_day in sorted(metrics["daily"])[:-METRICS_DAYS]:
+            del metrics["daily"][old_day]
+    for ts in solution_timestamps:
+        metrics["open"] = max(0, metrics["open"] - 1)
+        if ts:
+            metrics["response_ms"].append(max(0, now - ts))
+    del metrics["response_ms"][:-RESPONSE_SAMPLE_SIZE]
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу; None для пустого списка"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+def mentor_metrics_summary(metrics, now=None):
+    """Медиана и p90 времени ответа, открытые решения, ответов в день за 7 дней"""
+    today = ms_to_datetime(now).date() if now else date.today()
+    week = {(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)}
+    return {
+        "open": metrics["open"],
+        "replies": metrics["replies"],
+        "median_ms": percentile(metrics["response_ms"], 0.5),
+        "p90_ms": percentile(metrics["response_ms"], 0.9),
+        "per_day": sum(n for day, n in metrics["daily"].items() if day in week) / 7,
+    }
+
+def format_duration(value):
+    """мс → «2 ч 15 мин»"""
+    if value is None:
+        return "—"
+    minutes = int(value // 60000)
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours} ч {minutes} мин"
+    days, hours = divmod(hours, 24)
+    return f"{days} д {hours} ч"
+
+def migrate_mentor_metrics(assignments_data):
+    """Однократно посчитать метрики по уже сохраненным решениям и ответам"""
+    if "mentor_metrics" in assignments_data:
+        return False
+    assignments_data["mentor_metrics"] = {}
+    
+    replies = {}
+    for rec in assignments_data.get("conversations", []):
+        if rec.get("r") and rec.get("a"):
+            replies.setdefault((rec["a"], str(rec["t"])), []).append(rec["ts"])
+            metrics = mentor_metrics(assignments_data, rec["f"])
+            metrics["replies"] += 1
+            day = ms_to_datetime(rec["ts"]).strftime("%Y-%m-%d")
+            metrics["daily"][day] = metrics["daily"].get(day, 0) + 1
+    
+    solutions = sorted(assignments_data.get("solutions", {}).values(), key=lambda x: x.get("timestamp") or 0)
+    for solution in solutions:
+        metrics = mentor_metrics(assignments_data, solution.get("mentor_id"))
+        reply_times = sorted(replies.get((solution.get("assignment_id"), str(solution.get("student_id"))), []))
+        first = bisect.bisect_left(reply_times, solution.get("timestamp") or 0)
+        if first < len(reply_times):
+            metrics["response_ms"].append(reply_times[first] - (solution.get("timestamp") or 0))
+        else:
+            metrics["open"] += 1
+    for metrics in assignments_data["mentor_metrics"].values():
+        del metrics["response_ms"][:-RESPONSE_SAMPLE_SIZE]
+        for old_day in sorted(metrics["daily"])[:-METRICS_DAYS]:
+            del metrics["daily"][old_day]
+    log_info(f"🔄 Посчитаны метрики наставников: {len(assignments_data['mentor_metrics'])}")
+    return True
+
+def mentor_display_name(users, mentor_id):
+    user = users.get(str(mentor_id))
+    return f"{user['name']} {user.get('surname','')}".strip() if user else str(mentor_id)
+
+async def show_mentor_metrics(chat_id):
+    """Отчет для администратора: самые загруженные наставники сверху"""
+    metrics_all = load_assignments().get("mentor_metrics", {})
+    users = load_users()["users"]
+    summaries = [(mentor_id, mentor_metrics_summary(m)) for mentor_id, m in metrics_all.items()]
+    summaries.sort(key=lambda item: (item[1]["open"], item[1]["p90_ms"] or 0), reverse=True)
+    
+    if not summaries:
+        await bot.send_message(chat_id, "⏱ Пока нет данных о решениях и ответах наставников")
+        return
     
-    await state.finish()
+    text = "⏱ <b>Нагрузка и скорость ответов наставников</b>\n"
+    text += "<i>открыто — решений без ответа; время — до первого ответа (медиана / p90)</i>\n\n"
+    for mentor_id, summary in summaries[:25]:
+        text += (f"👤 <b>{mentor_display_name(users, mentor_id)}</b>\n"
+                 f"   Открыто: {summary['open']} • Ответов/день: {summary['per_day']:.1f}\n"
+                 f"   Время ответа: {format_duration(summary['median_ms'])} / {format_duration(summary['p90_ms'])}\n")
+    if len(summaries) > 25:
+        text += f"\n... и еще {len(summaries) - 25} наставников"
+    await safe_send_message(chat_id, text)
+
+@dp.callback_query_handler(lambda c: c.data == "mentor_metrics")
+async def mentor_metrics_callback(callback: types.CallbackQuery):
+    if callback.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        await callback.answer("Только для администраторов", show_alert=True)
+        return
+    await callback.answer()
+    await show_mentor_metrics(callback.from_user.id)
+
+@dp.message_handler(commands=["mentor_stats"], state="*")
+async def mentor_stats_command(message: types.Message, state=None):
+    if message.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        return
+    await show_mentor_metrics(message.from_user.id)
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def write_metrics_textfile(path):
+    """Метрики наставников в формате Prometheus (атомарная замена файла)"""
+    metrics_all = load_assignments().get("mentor_metrics", {})
+    users = load_users()["users"]
+    lines = [
+        "# HELP nastavnik_mentor_open_solutions Solutions waiting for a mentor reply",
+        "# TYPE nastavnik_mentor_open_solutions gauge",
+    ]
+    series = {"open": [], "replies": [], "per_day": [], "response": []}
+    for mentor_id, metrics in metrics_all.items():
+        summary = mentor_metrics_summary(metrics)
+        labels = f'mentor="{prometheus_label(mentor_id)}",name="{prometheus_label(mentor_display_name(users, mentor_id))}"'
+        series["open"].append(f"nastavnik_mentor_open_solutions{{{labels}}} {summary['open']}")
+        series["replies"].append(f"nastavnik_mentor_replies_total{{{labels}}} {summary['replies']}")
+        series["per_day"].append(f"nastavnik_mentor_replies_per_day{{{labels}}} {summary['per_day']:.3f}")
+        for quantile, key in (("0.5", "median_ms"), ("0.9", "p90_ms")):
+            if summary[key] is not None:
+                series["response"].append(
+                    f'nastavnik_mentor_response_seconds{{{labels},quantile="{quantile}"}} {summary[key] / 1000:.0f}')
+    lines += series["open"]
+    lines += ["# HELP nastavnik_mentor_replies_total Mentor replies to solutions",
+              "# TYPE nastavnik_mentor_replies_total counter"] + series["replies"]
+    lines += ["# HELP nastavnik_mentor_replies_per_day Average replies per day over the last 7 days",
+              "# TYPE nastavnik_mentor_replies_per_day gauge"] + series["per_day"]
+    lines += ["# HELP nastavnik_mentor_response_seconds Time to first reply over recent solutions",
+              "# TYPE nastavnik_mentor_response_seconds gauge"] + series["response"]
+    
+    temp_file = f"{path}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_file, path)
+
+async def metrics_textfile_loop():
+    """Периодическая выгрузка метрик для Prometheus (если задан METRICS_TEXTFILE)"""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, write_metrics_textfile, METRICS_TEXTFILE)
+        except Exception as e:
+            log_error(f"❌ Ошибка выгрузки метрик: {e}")
+        await asyncio.sleep(METRICS_TEXTFILE_INTERVAL)
 
 # --- ПРОСМОТР РЕШЕНИЙ УЧЕНИКОВ ---
-@dp.callback_query_handler(lambda c: c.data == "view_student_solutions")
+@dp.callback_query_handler(lambda c: c.data == "view_student_solutions" or c.data.startswith("inbox_page:"))
 async def view_student_solutions(callback: types.CallbackQuery):
     """Наставник просматривает решения от своих учеников"""
     mentor_id = str(callback.from_user.id)
+    page = int(callback.data.split(":")[1]) if callback.data.startswith("inbox_page:") else 0
     
     assignments_data = load_assignments()
     solutions = assignments_data.get("solutions", {})
+    inbox = assignments_data.get("mentor_inbox", {}).get(mentor_id)
     
-    # Фильтруем решения, предназначенные этому наставнику
-    mentor_solutions = []
-    for solution_id, solution in solutions.items():
-        if solution.get("mentor_id") == mentor_id:
-            mentor_solutions.append(solution)
-    
-    if not mentor_solutions:
+    if not inbox or not inbox["items"]:
         await callback.message.answer(
             "📭 <b>У вас пока нет решений от учеников</b>\n\n"
             "Когда ваши ученики отправят решения заданий от администраторов, "
@@ -3011,23 +6114,19 @@ async def view_student_solutions(callback: types.CallbackQuery):
         )
         return
     
-    # Сортируем по времени (новые сначала)
-    mentor_solutions.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
+    total = len(inbox["items"])
+    pages = (total + INBOX_PAGE_SIZE - 1) // INBOX_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    items = inbox_page(inbox, page)
+    unread = inbox["unread"]
     
     text = f"📥 <b>Решения от ваших учеников</b>\n\n"
-    text += f"Всего решений: {len(mentor_solutions)}\n\n"
+    text += f"Всего решений: {total}"
+    text += f" (новых: {unread})\n\n" if unread else "\n\n"
     
-    # Показываем последние 5 решений
-    for i, solution in enumerate(mentor_solutions[:5], 1):
-        timestamp = solution.get("timestamp", "")
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                time_str = dt.strftime("%d.%m %H:%M")
-            except:
-                time_str = timestamp
-        else:
-            time_str = "?"
+    for i, item in enumerate(items, page * INBOX_PAGE_SIZE + 1):
+        solution = solutions.get(item["id"], {})
+        time_str = format_ms(solution.get("timestamp"), "%d.%m %H:%M")
         
         student_name = solution.get("student_name", "Ученик")
         preview = ""
@@ -3037,15 +6136,97 @@ async def view_student_solutions(callback: types.CallbackQuery):
         elif solution.get("caption"):
             preview = solution["caption"][:50] + "..." if len(solution["caption"]) > 50 else solution["caption"]
         
-        text += f"{i}. <b>{student_name}</b> ({time_str})\n"
+        marks = ("🆕 " if not item["read"] else "") + ("✅ " if item["replied"] else "")
+        text += f"{i}. {marks}<b>{student_name}</b> ({time_str})\n"
         if preview:
             text += f"   {preview}\n"
         text += "\n"
     
-    kb = InlineKeyboardMarkup()
+    # Показанные решения становятся прочитанными
+    if inbox_mark_read(inbox, items):
+        update_menu_counters(assignments_data, mentor_id)
+        save_assignments(assignments_data)
+    
+    kb = InlineKeyboardMarkup(row_width=2)
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"inbox_page:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("Старее ➡️", callback_data=f"inbox_page:{page + 1}"))
+    if nav:
+        kb.row(*nav)
     kb.add(InlineKeyboardButton("🔄 Обновить", callback_data="view_student_solutions"))
     
-    await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
+    if callback.data.startswith("inbox_page:"):
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    else:
+        await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
+    await callback.answer()
+
+# --- МОИ ЗАДАНИЯ (УЧЕНИК) ---
+MY_ASSIGNMENTS_PAGE_SIZE = 8
+MY_ASSIGNMENT_MARKS = {"sent": "⏳ Не сдано", "submitted": "📤 Сдано", "replied": "💬 Есть ответ"}
+
+def student_assignment_entries(assignments_data, student_id):
+    """Задания ученика по состояниям, новые сначала — только по его списку заданий"""
+    grouped = {"sent": [], "submitted": [], "replied": []}
+    statuses = assignments_data.get("assignment_status", {})
+    for assignment_id in reversed(assignments_data.get("student_assignments", {}).get(str(student_id), [])):
+        entry = statuses.get(assignment_id, {}).get("students", {}).get(str(student_id))
+        if entry and entry["state"] in grouped:
+            grouped[entry["state"]].append(assignment_id)
+    return grouped
+
+def assignment_title(assignment, limit=50):
+    """Короткое название задания для списков"""
+    title = assignment.get("text") or assignment.get("caption") or f"Задание от {assignment.get('admin_name', 'администратора')}"
+    title = " ".join(title.split())
+    return html.escape(title[:limit] + "..." if len(title) > limit else title)
+
+@dp.callback_query_handler(lambda c: c.data == "my_assignments" or c.data.startswith("my_assignments:"))
+async def my_assignments(callback: types.CallbackQuery):
+    """Ученик смотрит свои задания: сначала несданные"""
+    student_id = str(callback.from_user.id)
+    page = int(callback.data.split(":")[1]) if ":" in callback.data else 0
+    
+    assignments_data = load_assignments()
+    grouped = student_assignment_entries(assignments_data, student_id)
+    ordered = [(aid, state) for state in ("sent", "submitted", "replied") for aid in grouped[state]]
+    
+    if not ordered:
+        await callback.answer("У вас пока нет заданий", show_alert=True)
+        return
+    
+    pages = (len(ordered) + MY_ASSIGNMENTS_PAGE_SIZE - 1) // MY_ASSIGNMENTS_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    start = page * MY_ASSIGNMENTS_PAGE_SIZE
+    
+    text = f"📚 <b>Мои задания</b>\n\n"
+    text += f"Всего: {len(ordered)}, не сдано: {len(grouped['sent'])}\n\n"
+    
+    kb = InlineKeyboardMarkup()
+    for i, (assignment_id, state) in enumerate(ordered[start:start + MY_ASSIGNMENTS_PAGE_SIZE], start + 1):
+        assignment = assignments_data.get("assignments", {}).get(assignment_id, {})
+        text += f"{i}. {MY_ASSIGNMENT_MARKS[state]} — {format_ms(assignment.get('timestamp'), '%d.%m')}"
+        text += f", срок до {format_ms(assignment['deadline'], '%d.%m %H:%M')}\n" if assignment.get("deadline") else "\n"
+        text += f"   {assignment_title(assignment)}\n\n"
+        if state == "sent":
+            kb.add(InlineKeyboardButton(f"📤 Сдать задание №{i}",
+                                        callback_data=f"send_solution_to_mentor:{assignment_id}"))
+    
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"my_assignments:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("Далее ➡️", callback_data=f"my_assignments:{page + 1}"))
+    if nav:
+        kb.row(*nav)
+    
+    if ":" in callback.data:
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    else:
+        await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
+    await callback.answer()
 
 # --- УЧЕНИК ОТПРАВЛЯЕТ РЕШЕНИЕ НАСТАВНИКУ ---
 @dp.callback_query_handler(lambda c: c.data.startswith("send_solution_to_mentor:"))
@@ -3098,6 +6279,7 @@ async def send_solution_to_mentor(callback: types.CallbackQuery):
         "• Фотографию/скриншот решения\n"
         "• Документ (PDF, Word)\n"
         "• Голосовое объяснение\n\n"
+        "Если нужна срочная проверка, добавьте слово «срочно».\n\n"
         "<i>Ваше решение будет отправлено вашему личному наставнику</i>"
     )
     
@@ -3118,9 +6300,19 @@ async def receive_solution_from_student(message: types.Message, state):
         await state.finish()
         return
     
-    # Загружаем данные
-    users_data = load_users()["users"]
-    assignments_data = load_assignments()
+    # Альбом (несколько фото или файлов) — одно решение; остальные части альбома не обрабатываются
+    album = None
+    if message.media_group_id:
+        album = await media_group_collector.collect(message)
+        if album is None:
+            return
+        message = next((m for m in album if m.caption), album[0])
+        album = album_items(album)
+    
+    # Загружаем данные: все изменения ниже записываются одним сохранением
+    uow = UnitOfWork()
+    users_data = uow.users["users"]
+    assignments_data = uow.assignments
     
     # Получаем информацию о пользователях
     student = users_data.get(student_id)
@@ -3147,7 +6339,7 @@ async def receive_solution_from_student(message: types.Message, state):
         "student_name": student_name,
         "mentor_id": mentor_id,
         "mentor_name": mentor_name,
-        "timestamp": str(datetime.now()),
+        "timestamp": now_ms(),
         "content_type": message.content_type,
         "from_admin_assignment": True,
         "admin_name": admin_name
@@ -3164,16 +6356,34 @@ async def receive_solution_from_student(message: types.Message, state):
         solution_info["caption"] = message.caption
     elif message.content_type == "voice":
         solution_info["voice_id"] = message.voice.file_id
+    if album:
+        solution_info["album"] = album
+        solution_info["caption"] = message.caption
     
     # Получаем текст задания для наставника
     assignment_text = assignment.get("text") or assignment.get("caption") or f"Задание от {admin_name}"
     if len(assignment_text) > 200:
         assignment_text = assignment_text[:200] + "..."
     
-    # Сохраняем решение
+    # Решение, входящие наставника и статистика задания — одной записью
     assignments_data.setdefault("solutions", {})[solution_id] = solution_info
+    inbox_add_solution(assignments_data, mentor_id, solution_id)
+    metrics_solution_submitted(assignments_data, mentor_id)
+    # Наставник в режиме сводки получит решение позже одним сообщением (срочные — сразу)
+    digest = bool(mentor.get("digest_minutes")) and not is_urgent_solution(solution_info)
+    if digest:
+        queue_digest_item(assignments_data, mentor_id, solution_id, mentor["digest_minutes"])
+    assignment["solutions_count"] = assignment.get("solutions_count", 0) + 1
+    assignment.setdefault("solutions_sent", []).append({
+        "student_id": student_id,
+        "student_name": student_name,
+        "mentor_id": mentor_id,
+        "timestamp": solution_info["timestamp"]
+    })
+    mark_assignment_submitted(assignments_data, assignment_id, student_id, mentor_id)
+    uow.stage("assignments")
     
-    if save_assignments(assignments_data):
+    if uow.commit():
         try:
             # Отправляем решение наставнику
             kb_mentor = InlineKeyboardMarkup(row_width=2)
@@ -3184,7 +6394,26 @@ async def receive_solution_from_student(message: types.Message, state):
                                    callback_data=f"view_assignment:{assignment_id}")
             )
             
-            if message.content_type == "text":
+            if digest:
+                log_info(f"🗂 Решение {solution_id} отложено до сводки наставнику {mentor_id}")
+            elif album:
+                # Заголовок — отдельным сообщением (подпись альбома ограничена 1024 символами),
+                # альбом — с подписями ученика как есть, кнопки — следом (у альбома не бывает клавиатуры)
+                await safe_send_message(
+                    mentor_id,
+                    f"📤 <b>РЕШЕНИЕ ОТ ВАШЕГО УЧЕНИКА</b>\n\n"
+                    f"👤 <b>Ученик:</b> {student_name}\n"
+                    f"📚 <b>Задание от {admin_name}:</b>\n{assignment_text}\n\n"
+                    f"<b>Решение ученика:</b> альбом, {len(album)} файлов"
+                )
+                await album_sender(album)(mentor_id)
+                await bot.send_message(
+                    mentor_id,
+                    f"<i>Вы можете ответить ученику {student_name} или просмотреть полное задание</i>",
+                    reply_markup=kb_mentor,
+                    parse_mode="HTML"
+                )
+            elif message.content_type == "text":
                 await bot.send_message(
                     mentor_id,
                     f"📤 <b>РЕШЕНИЕ ОТ ВАШЕГО УЧЕНИКА</b>\n\n"
@@ -3214,24 +6443,6 @@ async def receive_solution_from_student(message: types.Message, state):
                 f"Ожидайте обратной связи. Наставник может ответить вам здесь."
             )
             
-            # Обновляем статистику задания
-            if assignment_id in assignments_data.get("assignments", {}):
-                if "solutions_count" not in assignments_data["assignments"][assignment_id]:
-                    assignments_data["assignments"][assignment_id]["solutions_count"] = 0
-                assignments_data["assignments"][assignment_id]["solutions_count"] += 1
-                
-                # Сохраняем, кто отправил решение
-                if "solutions_sent" not in assignments_data["assignments"][assignment_id]:
-                    assignments_data["assignments"][assignment_id]["solutions_sent"] = []
-                assignments_data["assignments"][assignment_id]["solutions_sent"].append({
-                    "student_id": student_id,
-                    "student_name": student_name,
-                    "mentor_id": mentor_id,
-                    "timestamp": str(datetime.now())
-                })
-                
-                save_assignments(assignments_data)
-                
         except Exception as e:
             log_error(f"Ошибка отправки решения наставнику: {e}")
             await message.answer(f"❌ Ошибка отправки решения: {e}")
@@ -3283,50 +6494,65 @@ async def receive_mentor_reply(message: types.Message, state):
         await state.finish()
         return
     
-    # Загружаем данные
-    users_data = load_users()["users"]
-    
-    # Проверяем, что наставник действительно наставник этого ученика
-    student = users_data.get(student_id)
-    if not student or student.get("mentor") != mentor_id:
+    # Альбом ответа собираем целиком: в переписку — все части, ученику — одним альбомом
+    album = None
+    if message.media_group_id:
+        album = await media_group_collector.collect(message)
+        if album is None:
+            return
+        message = next((m for m in album if m.caption), album[0])
+        album = album_items(album)
+    
+    content_type, payload, caption = message_payload(message)
+    
+    def save_reply(uow):
+        # Проверяем, что наставник действительно наставник этого ученика
+        users_data = uow.users["users"]
+        student = users_data.get(student_id)
+        if not student or student.get("mentor") != mentor_id:
+            return None
+        
+        # Сохраняем ответ в истории переписки вместе с отметками задания и входящих
+        assignments_data = uow.assignments
+        for item_type, item_payload, item_caption in album or [(content_type, payload, caption)]:
+            reply_record = make_conversation_record(
+                mentor_id, student_id, item_type, item_payload, item_caption,
+                assignment_id=assignment_id, is_reply=True
+            )
+            assignments_data.setdefault("conversations", []).append(reply_record)
+        if assignment_id:
+            mark_assignment_replied(assignments_data, assignment_id, student_id)
+            replied = inbox_mark_replied(assignments_data, mentor_id, student_id, assignment_id)
+            metrics_reply(assignments_data, mentor_id,
+                          [assignments_data["solutions"][sid].get("timestamp") for sid in replied
+                           if sid in assignments_data.get("solutions", {})])
+        uow.stage("assignments")
+        return users_data
+    
+    ok, users_data = await run_transaction(save_reply)
+    if ok and users_data is None:
         await message.answer("❌ Ошибка: вы не являетесь наставником этого ученика")
         await state.finish()
         return
     
-    mentor = users_data.get(mentor_id)
-    student_name = f"{student['name']} {student.get('surname','')}".strip()
-    mentor_name = f"{mentor['name']} {mentor.get('surname','')}".strip()
-    
-    # Сохраняем ответ в истории
-    assignments_data = load_assignments()
-    
-    reply_id = f"reply_{mentor_id}_{student_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    
-    reply_info = {
-        "reply_id": reply_id,
-        "assignment_id": assignment_id,
-        "from_mentor": True,
-        "mentor_id": mentor_id,
-        "mentor_name": mentor_name,
-        "student_id": student_id,
-        "student_name": student_name,
-        "timestamp": str(datetime.now()),
-        "content_type": message.content_type
-    }
-    
-    if message.content_type == "text":
-        reply_info["text"] = message.text
-    elif message.content_type == "photo":
-        reply_info["photo_id"] = message.photo[-1].file_id
-        reply_info["caption"] = message.caption
-    
-    # Сохраняем в истории переписки
-    assignments_data.setdefault("conversations", {})[reply_id] = reply_info
-    
-    if save_assignments(assignments_data):
+    if ok:
+        student = users_data[student_id]
+        mentor = users_data.get(mentor_id)
+        student_name = f"{student['name']} {student.get('surname','')}".strip()
+        mentor_name = f"{mentor['name']} {mentor.get('surname','')}".strip()
+        
         try:
             # Отправляем ответ ученику
-            if message.content_type == "text":
+            if album:
+                # Заголовок — отдельным сообщением: подпись альбома ограничена 1024 символами
+                await bot.send_message(
+                    student_id,
+                    f"💬 <b>ОТВЕТ ОТ ВАШЕГО НАСТАВНИКА</b>\n\n"
+                    f"👤 <b>Наставник:</b> {mentor_name}\n\n"
+                    f"<i>Вы можете продолжить диалог, просто отправляя сообщения сюда</i>"
+                )
+                await album_sender(album)(student_id)
+            elif message.content_type == "text":
                 await bot.send_message(
                     student_id,
                     f"💬 <b>ОТВЕТ ОТ ВАШЕГО НАСТАВНИКА</b>\n\n"
@@ -3381,9 +6607,12 @@ async def view_assignment_handler(callback: types.CallbackQuery):
     text = f"📚 <b>ЗАДАНИЕ ОТ {admin_name.upper()}</b>\n\n"
     text += f"• ID: <code>{assignment_id}</code>\n"
     text += f"• Уровни: {', '.join(levels) if levels else 'Все ученики'}\n"
-    text += f"• Время: {assignment.get('timestamp', '?')}\n"
+    text += f"• Время: {format_ms(assignment.get('timestamp'))}\n"
     text += f"• Отправлено ученикам: {assignment.get('sent_count', 0)}\n"
-    text += f"• Решений получено: {assignment.get('solutions_count', 0)}\n\n"
+    text += f"• Решений получено: {assignment.get('solutions_count', 0)}\n"
+    if assignment.get("deadline"):
+        text += f"• Срок сдачи: {format_ms(assignment['deadline'])}\n"
+    text += "\n"
     
     if assignment.get("text"):
         text += f"<b>Текст задания:</b>\n{assignment['text']}\n"
@@ -3400,7 +6629,7 @@ async def view_assignment_handler(callback: types.CallbackQuery):
         
         if mentor_students:
             for i, solution in enumerate(mentor_students, 1):
-                text += f"{i}. {solution.get('student_name', '?')} - {solution.get('timestamp', '?')}\n"
+                text += f"{i}. {solution.get('student_name', '?')} - {format_ms(solution.get('timestamp'))}\n"
         else:
             text += "Ваши ученики еще не отправляли решения\n"
     
@@ -3424,8 +6653,9 @@ async def check_assignment_status(callback: types.CallbackQuery):
         await callback.answer("Задание не найдено", show_alert=True)
         return
     
-    # Получаем всех получателей
-    recipients = assignments_data.get("assignment_recipients", {}).get(assignment_id, [])
+    # Счетчики уже посчитаны в индексе статусов — получателей и решения не перебираем
+    status = assignment_status(assignments_data, assignment_id)
+    total = status["total"]
     
     admin_name = assignment.get("admin_name", "Администратора")
     
@@ -3438,47 +6668,39 @@ async def check_assignment_status(callback: types.CallbackQuery):
     else:
         text += f"• Уровни: {', '.join(levels)}\n"
         
-    text += f"• Всего учеников: {len(recipients)}\n"
-    text += f"• Отправили решения: {assignment.get('solutions_count', 0)}\n\n"
-    
-    # Группируем по наставникам
-    mentors_summary = {}
-    
-    for recipient in recipients:
-        mentor_id = recipient.get("mentor_id")
-        if mentor_id:
-            if mentor_id not in mentors_summary:
-                mentor_name = ""
-                if mentor_id in users_data:
-                    mentor = users_data[mentor_id]
-                    mentor_name = f"{mentor['name']} {mentor.get('surname','')}".strip()
-                mentors_summary[mentor_id] = {
-                    "name": mentor_name,
-                    "students": [],
-                    "solutions": 0
-                }
-            mentors_summary[mentor_id]["students"].append(recipient["student_name"])
-    
-    # Считаем решения по наставникам
-    solutions_sent = assignment.get("solutions_sent", [])
-    for solution in solutions_sent:
-        mentor_id = solution.get("mentor_id")
-        if mentor_id in mentors_summary:
-            mentors_summary[mentor_id]["solutions"] += 1
+    text += f"• Всего учеников: {total['sent'] + total['submitted'] + total['replied']}\n"
+    text += f"• Отправили решения: {total['submitted'] + total['replied']}\n"
+    text += f"• Получили ответ наставника: {total['replied']}\n"
+    if total["failed"]:
+        text += f"• Не доставлено: {total['failed']}\n"
+    if assignment.get("deadline"):
+        text += f"• Срок сдачи: {format_ms(assignment['deadline'])}\n"
+    text += "\n"
+    
+    # Сначала наставники, у которых больше всего учеников ждут
+    mentors_summary = {mentor_id: counts for mentor_id, counts in status["mentors"].items()
+                       if counts["sent"] + counts["submitted"] + counts["replied"]}
+    shown = heapq.nlargest(15, mentors_summary.items(), key=lambda item: item[1]["sent"])
     
     text += "<b>По наставникам:</b>\n"
-    for mentor_id, info in list(mentors_summary.items())[:15]:  # Ограничиваем вывод
-        text += f"\n👤 <b>{info['name'] or 'Без наставника'}</b>\n"
-        text += f"   Учеников: {len(info['students'])}\n"
-        text += f"   Решений: {info['solutions']}\n"
-        if info['solutions'] < len(info['students']):
-            missing = len(info['students']) - info['solutions']
-            text += f"   ❌ Ждут: {missing} учеников\n"
+    for mentor_id, counts in shown:
+        mentor = users_data.get(mentor_id)
+        mentor_name = f"{mentor['name']} {mentor.get('surname','')}".strip() if mentor else ""
+        solutions = counts["submitted"] + counts["replied"]
+        text += f"\n👤 <b>{mentor_name or 'Без наставника'}</b>\n"
+        text += f"   Учеников: {counts['sent'] + solutions}\n"
+        text += f"   Решений: {solutions}"
+        text += f" (с ответом: {counts['replied']})\n" if counts["replied"] else "\n"
+        if counts["sent"]:
+            text += f"   ❌ Ждут: {counts['sent']} учеников\n"
     
     if len(mentors_summary) > 15:
         text += f"\n... и еще {len(mentors_summary) - 15} наставников"
     
-    await callback.message.answer(text, parse_mode="HTML")
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("⏰ Изменить срок сдачи" if assignment.get("deadline") else "⏰ Установить срок сдачи",
+                                callback_data=f"set_deadline:{assignment_id}"))
+    await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
 
 # --- ОБЫЧНАЯ РАССЫЛКА ---
 @dp.callback_query_handler(lambda c: c.data == "confirm_send", state=Form.admin_message)
@@ -3487,48 +6709,150 @@ async def confirm_send(callback: types.CallbackQuery, state):
     message = data.get("message_to_send")
     recipients = data.get("recipients", [])
     
-    await callback.message.edit_text(f"🔄 Отправляю {len(recipients)} сообщений...")
-    
-    sent_count = 0
-    failed_count = 0
-    
-    for i, uid in enumerate(recipients):
-        try:
-            if message.content_type == "text":
-                await bot.send_message(uid, message.text)
-            elif message.content_type == "photo":
-                await bot.send_photo(uid, message.photo[-1].file_id, caption=message.caption)
-            elif message.content_type == "video":
-                await bot.send_video(uid, message.video.file_id, caption=message.caption)
-            elif message.content_type == "document":
-                await bot.send_document(uid, message.document.file_id, caption=message.caption)
-            elif message.content_type == "voice":
-                await bot.send_voice(uid, message.voice.file_id)
-            
-            sent_count += 1
-            
-            if i % 10 == 0:
-                await asyncio.sleep(0.5)
-                
-        except Exception as e:
-            failed_count += 1
-            log_info(f"Ошибка отправки {uid}: {e}")
+    content_type, payload, caption = message_payload(message)
     
-    await callback.message.edit_text(
-        f"✅ Рассылка завершена!\n\n"
-        f"• Отправлено: {sent_count}\n"
-        f"• Не отправлено: {failed_count}"
-    )
+    await callback.message.edit_text(f"🔄 Отправляю {len(recipients)} сообщений...")
     
+    # Рассылка сохраняется как задача: после перезапуска продолжится с того же места.
+    # Получателям уходит копия исходного сообщения (copy_message) или альбом одним запросом.
+    job = create_broadcast_job("message", callback.from_user.id, recipients, content_type, payload, caption,
+                               source=[message.chat.id, message.message_id], album=data.get("album"),
+                               report=[callback.message.chat.id, callback.message.message_id])
+    # Рассылка идет в фоне (сообщение о ходе правит ProgressReporter, итоги придут по окончании):
+    # состояние администратора не держим на время рассылки и пауз
     await state.finish()
+    await callback.answer()
+    asyncio.ensure_future(finish_background_job(job, "📢 Рассылка"))
     await admin_main_menu(callback.from_user.id)
 
+@dp.callback_query_handler(lambda c: c.data.split(":")[0] in ("broadcast_pause", "broadcast_resume", "broadcast_cancel"),
+                           state="*")
+async def broadcast_control(callback: types.CallbackQuery):
+    """Пауза, продолжение и отмена идущей рассылки"""
+    action, job_id = callback.data.split(":", 1)
+    job = broadcast_jobs.get(job_id)
+    if job is None:
+        await callback.answer("Рассылка не найдена", show_alert=True)
+        return
+    if str(callback.from_user.id) != job["admin_id"] and callback.from_user.id != YOUR_ADMIN_ID:
+        await callback.answer("Управлять рассылкой может только ее автор", show_alert=True)
+        return
+    if job["state"] not in ("running", "paused"):
+        await callback.answer("Рассылка уже завершена", show_alert=True)
+        return
+    
+    if action == "broadcast_pause":
+        job["state"] = "paused"
+        answer = "⏸ Рассылка приостановлена"
+    elif action == "broadcast_resume":
+        job["state"] = "running"
+        answer = "▶️ Рассылка продолжается"
+    else:
+        job["state"] = "cancelled"
+        answer = "⏹ Рассылка отменяется..."
+    log_broadcast_progress(job)
+    wake_broadcast_job(job_id)
+    await callback.answer(answer)
+
 @dp.callback_query_handler(lambda c: c.data == "cancel_send", state=Form.admin_message)
 async def cancel_send(callback: types.CallbackQuery, state):
     await callback.message.edit_text("❌ Рассылка отменена.")
     await state.finish()
     await admin_main_menu(callback.from_user.id)
 
+# --- ЗАПЛАНИРОВАННЫЕ РАССЫЛКИ ---
+@dp.callback_query_handler(lambda c: c.data.startswith("schedule_send:"), state=Form.admin_message)
+async def schedule_send(callback: types.CallbackQuery, state):
+    """Отложить подготовленную рассылку или задание"""
+    await state.update_data(schedule_kind=callback.data.split(":")[1])
+    await Form.schedule_time.set()
+    await callback.message.answer(
+        "🕒 Когда отправить? Укажите время в формате\n"
+        "<code>ДД.ММ.ГГГГ ЧЧ:ММ</code>, <code>ДД.ММ ЧЧ:ММ</code> или <code>ЧЧ:ММ</code> (ближайшее)."
+    )
+
+@dp.message_handler(state=Form.schedule_time)
+async def schedule_send_time(message: types.Message, state):
+    run_at = parse_schedule_time(message.text)
+    if run_at is None:
+        await message.answer("❌ Не понял время. Пример: <code>25.12 09:30</code>")
+        return
+    if run_at <= now_ms():
+        await message.answer("❌ Это время уже прошло, укажите будущее")
+        return
+    
+    data = await state.get_data()
+    source_message = data.get("message_to_send")
+    kind = data.get("schedule_kind", "message")
+    audience = data.get("audience")
+    if audience is None:
+        audience = {"levels": [] if data.get("broadcast_to_all") else data.get("selected_levels", [])}
+    
+    content_type, payload, caption = message_payload(source_message)
+    job = create_broadcast_job(kind, message.from_user.id, [], content_type, payload, caption,
+                               state="scheduled", run_at=run_at, audience=audience,
+                               levels=audience.get("levels") or ["ALL"],
+                               source=[source_message.chat.id, source_message.message_id],
+                               album=data.get("album"), assignment_id=None)
+    await state.finish()
+    
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("🕒 Запланированные", callback_data="scheduled_list"))
+    kb.add(InlineKeyboardButton("❌ Отменить эту", callback_data=f"sched_cancel:{job['job_id']}"))
+    await message.answer(
+        f"✅ {'Задание' if kind == 'assignment' else 'Рассылка'} запланировано на {format_ms(run_at)}\n"
+        f"• Получателей сейчас: {count_audience(audience)} (список уточнится в момент отправки)",
+        reply_markup=kb
+    )
+
+async def show_scheduled_list(chat_id):
+    jobs = sorted((job for job in broadcast_jobs.values() if job.get("state") == "scheduled"),
+                  key=lambda job: job["run_at"])
+    if not jobs:
+        await bot.send_message(chat_id, "🕒 Запланированных рассылок нет")
+        return
+    
+    users_data = load_users()["users"]
+    text = "🕒 <b>Запланированные рассылки</b>\n\n"
+    kb = InlineKeyboardMarkup()
+    for i, job in enumerate(jobs[:20], 1):
+        kind = "📚 Задание" if job["kind"] == "assignment" else "📢 Рассылка"
+        preview = job["payload"] if job["content_type"] == "text" else (job.get("caption") or f"[{job['content_type']}]")
+        text += (f"{i}. {kind} — {format_ms(job['run_at'])}\n"
+                 f"   Получателей: ~{count_audience(job.get('audience') or {}, users_data)}\n"
+                 f"   {html.escape(str(preview or '')[:60])}\n\n")
+        kb.add(InlineKeyboardButton(f"❌ Отменить №{i} ({format_ms(job['run_at'], '%d.%m %H:%M')})",
+                                    callback_data=f"sched_cancel:{job['job_id']}"))
+    await bot.send_message(chat_id, text, reply_markup=kb)
+
+@dp.message_handler(commands=["scheduled"], state="*")
+async def scheduled_command(message: types.Message, state=None):
+    if message.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        await message.answer("⚠️ Эта команда доступна только администраторам")
+        return
+    await show_scheduled_list(message.chat.id)
+
+@dp.callback_query_handler(lambda c: c.data == "scheduled_list", state="*")
+async def scheduled_list(callback: types.CallbackQuery):
+    if callback.from_user.id not in [OLGA_ID, YOUR_ADMIN_ID]:
+        return
+    await callback.answer()
+    await show_scheduled_list(callback.from_user.id)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("sched_cancel:"), state="*")
+async def scheduled_cancel(callback: types.CallbackQuery):
+    job = broadcast_jobs.get(callback.data.split(":", 1)[1])
+    if job is None or job.get("state") != "scheduled":
+        await callback.answer("Рассылка уже запущена или отменена", show_alert=True)
+        return
+    if str(callback.from_user.id) != job["admin_id"] and callback.from_user.id != YOUR_ADMIN_ID:
+        await callback.answer("Отменить может только автор", show_alert=True)
+        return
+    job["state"] = "cancelled"
+    job["finished"] = now_ms()
+    save_broadcasts()
+    await callback.answer("❌ Запланированная рассылка отменена", show_alert=True)
+
 # ДОБАВЛЕНО: Глобальный обработчик для сохранения ВСЕХ личных сообщений
 @dp.message_handler(content_types=types.ContentTypes.ANY, state="*")
 async def save_all_private_messages(message: types.Message, state=None):
@@ -3542,9 +6866,9 @@ async def save_all_private_messages(message: types.Message, state=None):
         users = data["users"]
         
         if user_id in users:
-            users[user_id]["active_today"] = str(date.today())
-            users[user_id]["last_activity"] = str(datetime.now())
-            save_users(data)
+            # Пишет боту — значит, снова доступен для рассылок
+            update_user_record(user_id, {"active_today": now_ms(), "last_activity": now_ms()},
+                               unset=("unreachable", "unreachable_since", "unreachable_probe"), users=users)
         
         # Если это ответ в рамках диалога с наставником/учеником
         if state:
@@ -3584,6 +6908,7 @@ async def save_callback_state(callback: types.CallbackQuery, state=None):
 
 # --- ЕЖЕДНЕВНЫЙ ОТЧЕТ ---
 async def daily_report():
+    send_priority.set(PRIORITY_NOTIFICATION)
     await asyncio.sleep(5)
     while True:
         now = datetime.now()
@@ -3593,20 +6918,20 @@ async def daily_report():
         wait_seconds = (target_time - now).total_seconds()
         await asyncio.sleep(wait_seconds)
 
-        today_str = str(date.today())
+        today_ms = day_start_ms()
         data = load_users()
         users = data["users"]
 
-        new_users = [f"{u.get('name','')} {u.get('surname','')}".strip() for u in users.values() if u.get("registration_date") == today_str]
+        new_users = [f"{u.get('name','')} {u.get('surname','')}".strip() for u in users.values() if (u.get("registration_date") or 0) >= today_ms]
 
-        text = f"📊 <b>Ежедневный отчет по активности пользователей ({today_str})</b>\n\n"
+        text = f"📊 <b>Ежедневный отчет по активности пользователей ({date.today():%d.%m.%Y})</b>\n\n"
         text += f"Всего пользователей: {len(users)}\n"
         text += f"Новых сегодня: {len(new_users)} — " + (", ".join(new_users) if new_users else "—") + "\n\n"
 
         for level in LEVELS_ORDER:
             level_users = [u for u in users.values() if u.get("level") == level]
-            active = [f"{u.get('name','')} {u.get('surname','')}".strip() for u in level_users if u.get("active_today") == today_str]
-            inactive = [f"{u.get('name','')} {u.get('surname','')}".strip() for u in level_users if u.get("active_today") != today_str]
+            active = [f"{u.get('name','')} {u.get('surname','')}".strip() for u in level_users if (u.get("active_today") or 0) >= today_ms]
+            inactive = [f"{u.get('name','')} {u.get('surname','')}".strip() for u in level_users if (u.get("active_today") or 0) < today_ms]
 
             text += f"🔹 <b>{level}</b> ({len(level_users)} чел.)\n"
             text += f"✅ Были сегодня ({len(active)}): " + (", ".join(active) if active else "—") + "\n"
@@ -3626,11 +6951,18 @@ if __name__ == "__main__":
     print(f"📊 Уровни: {LEVELS_ORDER}")
     print("="*50)
     
+    # Однократно переводим строковые даты в числовой формат
+    migrate_timestamps()
+    
     # Загружаем данные
     data = load_users()
     user_count = len(data.get('users', {}))
     print(f"✅ Загружено пользователей: {user_count}")
     
+    # Строим поисковый индекс заранее, чтобы первый поиск был мгновенным
+    user_search_index.sync(data.get('users', {}))
+    print("🔍 Поисковый индекс пользователей построен")
+    
     # Проверяем backup файлы
     backup_files = [f for f in os.listdir('.') if f.startswith('users_backup_')]
     corrupted_files = [f for f in os.listdir('.') if f.startswith('users_corrupted_')]
@@ -3642,10 +6974,11 @@ if __name__ == "__main__":
     
     # Проверяем файл заданий
     if os.path.exists(ASSIGNMENTS_FILE):
+        migrate_conversation_storage()
         assignments_data = load_assignments()
         assignments_count = len(assignments_data.get('assignments', {}))
         solutions_count = len(assignments_data.get('solutions', {}))
-        conversations_count = len(assignments_data.get('conversations', {}))
+        conversations_count = len(assignments_data.get('conversations', []))
         print(f"📚 Загружено заданий: {assignments_count}")
         print(f"📝 Загружено решений: {solutions_count}")
         print(f"💬 Загружено сообщений: {conversations_count}")
@@ -3662,6 +6995,22 @@ if __name__ == "__main__":
     loop.create_task(daily_report())
     print("✅ Задача ежедневного отчета запущена")
     
+    load_broadcasts()
+    loop.create_task(resume_broadcast_jobs())
+    loop.create_task(broadcast_scheduler())
+    loop.create_task(deadline_scheduler())
+    print(f"📨 Незавершенных рассылок: {sum(1 for job in broadcast_jobs.values() if job.get('state') == 'running')}")
+    
+    loop.create_task(archive_job())
+    print(f"🗄 Архивация диалогов старше {ARCHIVE_AFTER_DAYS} дней запущена ({ARCHIVE_COMPRESSION})")
+    
+    loop.create_task(mentor_digest_loop())
+    print(f"🗂 Сводки для наставников: окно {DIGEST_WINDOW_MINUTES} мин")
+    
+    if METRICS_TEXTFILE:
+        loop.create_task(metrics_textfile_loop())
+        print(f"📈 Метрики наставников выгружаются в {METRICS_TEXTFILE}")
+    
     print("="*50)
     print("🚀 Бот запущен и готов к работе!")
     print("🛡️  Данные защищены от потери (блокировки файлов, атомарные операции)")